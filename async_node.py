@@ -0,0 +1,230 @@
+# asyncio runtime for a node, an alternative to the threads of node.py
+# the router and peer messages, the quorums, the hint deliveries and the timers are coroutines on one event loop,
+# the messages are the same so it runs alongside the threaded nodes and the routers
+# usage: python async_node.py <port> [weight]
+import asyncio
+import atexit
+import json
+import sys
+import threading
+import time
+
+import zmq
+import zmq.asyncio
+
+from key_ordered_pool import AsyncKeyOrderedPool
+from failure_detector import FailureDetector
+from gossip import Membership
+from node import Node, DynamoNode
+from push_pool import PushPool
+from utils import *
+
+
+async def run_steps(steps):
+    """node.run_steps with the calls awaited, the waits of AsyncNode are coroutines"""
+    try:
+        method, args = next(steps)
+        while True:
+            method, args = steps.send(await method(*args))
+    except StopIteration as stop:
+        return stop.value
+
+
+class AsyncNode(Node):
+    """Node on an asyncio loop. The handling of the messages, the ring, the storage and the steps of the quorums and
+    maintenance rounds are the ones of Node, what waits is a coroutine: a quorum waits on an event set by the
+    listener and a health check on a future per node, so an operation in flight only costs its state"""
+
+    def __init__(self, node_address, weight=DEFAULT_NODE_WEIGHT, placement=PLACEMENT):
+        router_addresses = [ROUTER_ADDRESS, ROUTER_BACKUP_ADDRESS]
+        self.context = zmq.asyncio.Context()
+        self.address = node_address
+        self.weight = weight
+
+        self.node_sockets = []
+        for router_address in router_addresses:
+            socket = self.context.socket(zmq.DEALER)
+            socket.setsockopt(zmq.IDENTITY, node_address.encode('utf-8'))
+            socket.connect(router_address)
+            self.node_sockets.append(socket)
+
+        self.reply_socket = self.context.socket(zmq.PULL)
+        self.reply_socket.setsockopt(zmq.IDENTITY, node_address.encode('utf-8'))
+        self.reply_socket.bind(f"tcp://*:{node_address.rsplit(':', 1)[1]}")
+        # sends never block, so plain sockets used from the loop thread do
+        self.push_pool = PushPool(zmq.Context(), threaded=False)
+
+        self.write_quorum_requests_state = {}
+        self.read_quorum_requests_state = {}
+        self.delete_quorum_requests_state = {}
+        self.coordinator_pool = AsyncKeyOrderedPool(self.coordinate_quorum)
+
+        self.dynamo_node = DynamoNode(node_address, placement=placement)
+
+        self.nodes_health = {}
+        self.failure_detector = FailureDetector()
+        self.membership = Membership(node_address, weight)
+        self.ring_lock = threading.Lock()  # uncontended as well
+        self.health_waiters = {}  # k: node, v: futures of the health checks waiting for it
+        self.hints_lock = threading.Lock()  # uncontended here, the methods shared with Node take it
+        self.write_hints = {}
+        self.delete_hints = {}
+        self.handoffs = {}
+        self.replica_activity = {}
+        self.collection_activity = {}
+        self.migrated = set()
+        self.last_request_t = time.time()
+
+    def start(self):
+        asyncio.run(self.run())
+
+    async def run(self):
+        self.dynamo_node.get_database_data()
+        for socket in self.node_sockets:
+            # send a first message to the router to register the node
+            await socket.send_json(build_register_request(self.address, self.weight))
+        await asyncio.gather(*[self.serve_router(socket) for socket in self.node_sockets],
+                             self.listen_for_nodes(), self.heartbeat_timer(), self.gossip_timer(),
+                             self.hints_timer(), self.compaction_timer(), self.gc_timer())
+
+    async def serve_router(self, socket):
+        while True:
+            request = await socket.recv_json()
+            self.last_request_t = time.time()
+            self.handle_router_message(socket, request)
+
+    async def listen_for_nodes(self):
+        print("listening for nodes")
+        while True:
+            sender_identity, message = await self.reply_socket.recv_multipart()
+            self.handle_node_message(sender_identity, json.loads(message))
+
+    async def heartbeat_timer(self):
+        while True:
+            self.heartbeat_peers()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def gossip_timer(self):
+        while True:
+            await asyncio.sleep(GOSSIP_INTERVAL)
+            self.gossip()
+
+    async def hints_timer(self):
+        while True:
+            await asyncio.sleep(HINT_CHECK_INTERVAL)
+            healthy, _ = await self.check_nodes_health(self.hinted_nodes())
+            self.deliver_hints(healthy)
+            if self.dynamo_node.hash_ring.previous is not None:
+                await run_steps(self.migrate_lists())
+
+    async def compaction_timer(self):
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            self.coordinator_pool.submit(MAINTENANCE_KEY, {"type": MessageType.COMPACT})
+
+    async def gc_timer(self):
+        gc_t = time.time()
+        while True:
+            await asyncio.sleep(GC_IDLE_TIME)
+            if (time.time() - self.last_request_t > GC_IDLE_TIME and time.time() - gc_t > GC_INTERVAL
+                    and self.coordinator_pool.idle()):
+                self.coordinator_pool.submit(MAINTENANCE_KEY, {"type": MessageType.GC})
+                gc_t = time.time()
+
+    def record_health(self, node):
+        self.failure_detector.heartbeat(node)
+        self.nodes_health[node] = True
+        for future in self.health_waiters.pop(node, []):
+            if not future.done():
+                future.set_result(True)
+
+    async def check_nodes_health(self, nodes):
+        nodes_set = set(nodes)
+        loop = asyncio.get_running_loop()
+        waiters = {}
+        for node in nodes_set:
+            waiters[node] = loop.create_future()
+            self.health_waiters.setdefault(node, []).append(waiters[node])
+            self.send_push_message(self.address, node, json.dumps({"type": MessageType.HEALTH_CHECK}))
+
+        if len(waiters) > 0:
+            await asyncio.wait(waiters.values(), timeout=HEALTH_CHECK_TIMEOUT)
+
+        healthy = [node for node, future in waiters.items() if future.done()]
+        unhealthy = [node for node, future in waiters.items() if not future.done()]
+        for node in unhealthy:
+            waiting = self.health_waiters.get(node, [])
+            waiting.remove(waiters[node])
+            if len(waiting) == 0:
+                self.health_waiters.pop(node, None)
+        if len(unhealthy) > 0:
+            print("Some nodes are not healthy.", file=sys.stderr)
+            print(f"Unhealthy nodes: {unhealthy}")
+        return healthy, unhealthy
+
+    def response_arrived(self, state, json_request):
+        if self.record_response(state, json_request):
+            state['arrived'].set()
+
+    async def send_request_to_other_nodes(self, request_type, request, nodes, timeout, max_retries, quorum_size,
+                                          by_node=False):
+        quorum_id = request['quorum_id']
+        quorum_size = min(quorum_size, len(set(nodes)))
+        quorum_states = self.quorum_states(request_type)
+        current_quorum_state = build_quorum_request_state(nodes, timeout, max_retries, quorum_size)
+        current_quorum_state['arrived'] = asyncio.Event()
+        quorum_states[quorum_id] = current_quorum_state
+
+        deadline = time.time() + timeout
+        retries = [(0, node) for node in set(nodes)]
+        arrived = current_quorum_state['arrived']
+        while len(current_quorum_state['responses']) < quorum_size:
+            now = time.time()
+            if now >= deadline:
+                break
+            next_send = self.send_due_requests(request, current_quorum_state, retries, max_retries, now)
+            arrived.clear()
+            try:
+                await asyncio.wait_for(arrived.wait(), min(deadline, next_send) - time.time())
+            except asyncio.TimeoutError:
+                pass
+
+        del quorum_states[quorum_id]
+        if by_node:
+            return dict(current_quorum_state['nodes_with_reply'])
+        return current_quorum_state['responses'].copy()
+
+    async def send_put_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size):
+        return await self.send_request_to_other_nodes(MessageType.PUT, request, nodes, timeout, max_retries, quorum_size)
+
+    async def send_get_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size, by_node=False):
+        return await self.send_request_to_other_nodes(MessageType.GET, request, nodes, timeout, max_retries, quorum_size,
+                                                      by_node)
+
+    async def send_delete_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size):
+        return await self.send_request_to_other_nodes(MessageType.DELETE, request, nodes, timeout, max_retries,
+                                                      quorum_size)
+
+    def send_to_router(self, router_index, message):
+        self.node_sockets[router_index].send_json(message)
+
+    async def coordinate_quorum(self, task):
+        """Node.coordinate_quorum with the waits awaited"""
+        await run_steps(self.coordination(task))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python async_node.py <port> [weight]")
+        sys.exit(1)
+
+    port = sys.argv[1]
+    node_address = f"tcp://localhost:{port}"
+    weight = float(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_NODE_WEIGHT
+
+    node = AsyncNode(node_address, weight)
+
+    # ensure that at exit the database is saved
+    atexit.register(node.dynamo_node.save_all_database_data)
+
+    node.start()
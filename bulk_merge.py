@@ -0,0 +1,119 @@
+# Vectorized merge of many ShoppingListCRDT states at once, it pays off when the states don't share their counters,
+# e.g. lists decoded from the wire or the database, otherwise ShoppingListCRDT.merge_many skips the shared ones
+# numpy is optional, without it the functions fall back to ShoppingListCRDT.merge_many
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from crdt import ShoppingListCRDT, PNCounter, GCounter
+
+
+def available():
+    return np is not None
+
+
+def pack(groups):
+    """Packs groups of states into sparse entries, rows are (group, item). Returns the row keys and the inc and
+    dec entries as (row, replica index, total) arrays sorted by row and replica index, each total is the max
+    of that replica over the states of the group. Memory is linear in the entries, each group has its own
+    replicas and there is no cell for the replicas an item doesn't have
+    """
+    row_keys = []  # (group index, item id) of each row
+    buffers = ([], [])  # entries of the inc and dec counters
+    rows = ([], [])  # row of each inc and dec counter
+    counts = ([], [])  # number of entries of each inc and dec counter
+    for group_index, states in enumerate(groups):
+        group_rows = {}
+        for state in states:
+            for id, counter in state.counters.items():
+                row = group_rows.get(id)
+                if row is None:
+                    row = group_rows[id] = len(row_keys)
+                    row_keys.append((group_index, id))
+                for is_dec, entries in ((0, counter.inc_counter.entries), (1, counter.dec_counter.entries)):
+                    if entries:
+                        buffers[is_dec].append(entries)
+                        rows[is_dec].append(row)
+                        counts[is_dec].append(len(entries) >> 1)
+
+    sides = []
+    for is_dec in (0, 1):
+        entries = np.frombuffer(b''.join(buffers[is_dec]), dtype=np.int64).reshape(-1, 2)
+        entry_rows = np.repeat(np.array(rows[is_dec], dtype=np.int64), np.array(counts[is_dec], dtype=np.int64))
+        order = np.lexsort((entries[:, 0], entry_rows))
+        entry_rows, replicas, totals = entry_rows[order], entries[order, 0], entries[order, 1]
+        if len(totals) == 0:
+            sides.append((entry_rows, replicas, totals))
+            continue
+        # the first entry of each (row, replica) run, the max of the run is its merged total
+        starts = np.flatnonzero(np.concatenate(([True], (entry_rows[1:] != entry_rows[:-1]) | (replicas[1:] != replicas[:-1]))))
+        sides.append((entry_rows[starts], replicas[starts], np.maximum.reduceat(totals, starts)))
+    return row_keys, sides[0], sides[1]
+
+
+def values(row_count, inc, dec):
+    """Value of each row of packed entries, same as PNCounter.value"""
+    sums = []
+    for rows, _, totals in (inc, dec):
+        row_sums = np.zeros(row_count, dtype=np.int64)
+        np.add.at(row_sums, rows, totals)
+        sums.append(row_sums)
+    return np.maximum(sums[0] - sums[1], 0)
+
+
+def unpack(row_count, side):
+    """The GCounter of each row of packed entries"""
+    rows, replicas, totals = side
+    entries = np.column_stack((replicas, totals)).tobytes()
+    ends = np.searchsorted(rows, np.arange(1, row_count + 1)).tolist()
+    counters = []
+    start = 0
+    for end in ends:
+        counters.append(GCounter.from_entries(array('q', entries[start * 16:end * 16])) if end > start else GCounter.zero())
+        start = end
+    return counters
+
+
+def align(groups):
+    """Brings the states of each group to the latest compaction and collection of the group, see ShoppingListCRDT.align"""
+    return [ShoppingListCRDT.align(states) for states in groups]
+
+
+def merge_many_bulk(groups):
+    """For each group of states, the same result as ShoppingListCRDT.merge_many(group)"""
+    groups = [list(states) for states in groups]
+    if np is None:
+        return [ShoppingListCRDT.merge_many(states) for states in groups]
+
+    aligned = align(groups)
+    groups = [states for states, *_ in aligned]
+    row_keys, inc, dec = pack(groups)
+    merged = [ShoppingListCRDT({}, {}, archived, gc, absorbed, expired) for _, archived, gc, absorbed, expired in aligned]
+    for (group_index, id), inc_counter, dec_counter in zip(row_keys, unpack(len(row_keys), inc),
+                                                           unpack(len(row_keys), dec)):
+        merged[group_index].counters[id] = PNCounter(inc_counter, dec_counter)
+
+    for group_index, states in enumerate(groups):
+        version = merged[group_index].version
+        for state in states:
+            for replica, clock in state.version.items():
+                if clock > version.get(replica, 0):
+                    version[replica] = clock
+    return merged
+
+
+def values_bulk(groups):
+    """For each group of states, a dict with the value of each item of the merged state"""
+    groups = [list(states) for states in groups]
+    if np is None:
+        merged = [ShoppingListCRDT.merge_many(states) for states in groups]
+        return [{id: counter.value() for id, counter in state.counters.items()} for state in merged]
+
+    row_keys, inc, dec = pack([states for states, *_ in align(groups)])
+    result = [{} for _ in groups]
+    for (group_index, id), value in zip(row_keys, values(len(row_keys), inc, dec).tolist()):
+        result[group_index][id] = value
+    return result
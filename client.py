@@ -33,6 +33,8 @@ class Client:
         self.socket.connect(self.routers[self.router_nbr])
 
         self.shopping_lists = []
+        self.pending_deltas = {}  # a dict k: list id, v: ShoppingListCRDT with the changes not yet stored online
+        self.stored_digests = {}  # a dict k: list id, v: digest of the list when it was last stored online
         self.TIMEOUT = 3 #seconds
         self.SETTLE_DELAY = 2 #seconds
 
@@ -40,8 +42,15 @@ class Client:
         id = str(uuid4())
         shopping_list = ShoppingList(id, name, items, self.username)
         self.shopping_lists.append(shopping_list)
+        self.record_delta(id, shopping_list.items)
         return shopping_list
 
+    def record_delta(self, list_id, delta: ShoppingListCRDT):
+        if list_id in self.pending_deltas:
+            self.pending_deltas[list_id] = self.pending_deltas[list_id].merge(delta)
+        else:
+            self.pending_deltas[list_id] = delta
+
     # Functions for database handling
     def create_database_and_table(self):
         transformed_username = self.username.replace(' ', '_').replace(":", "_").replace("/", "-")
@@ -91,6 +100,8 @@ class Client:
                 "items": items_dict
             }
             self.shopping_lists.append(ShoppingList.from_dict(shopping_list))
+            # we don't know what reached the cloud before, so the whole list is pending
+            self.record_delta(shopping_list["id"], self.shopping_lists[-1].items)
 
     def save_database_data(self):
         transformed_username = transformed_username = self.username.replace(' ', '_').replace(":", "_").replace("/",
@@ -114,9 +125,7 @@ class Client:
     def merge_shopping_lists(self, shopping_lists):
         list_id = shopping_lists[0].id
         list_name = shopping_lists[0].name
-        merged_crdt = ShoppingListCRDT.zero()
-        for shopping_list in shopping_lists:
-            merged_crdt = merged_crdt.merge(shopping_list.items)
+        merged_crdt = ShoppingListCRDT.merge_many(shopping_list.items for shopping_list in shopping_lists)
 
         merged_data = ShoppingList(list_id, list_name, merged_crdt)
         return merged_data
@@ -160,17 +169,32 @@ class Client:
 
     def store_shopping_list_online(self, list_id):
         shopping_list = next(filter(lambda x: x.id == list_id, self.shopping_lists), None)
+        if self.stored_digests.get(list_id) == shopping_list.digest():
+            print("Shopping list unchanged since it was last stored")
+            return True
 
+        # only the changes since the last successful store are sent, the first store sends the whole list
+        stored = list_id in self.stored_digests
+        delta = self.pending_deltas.get(list_id, ShoppingListCRDT.zero())
         request = {
             "type": MessageType.PUT,
             "key": shopping_list.id,
-            "value": json.dumps(shopping_list, default=lambda x: x.__dict__)
+            "value": (ShoppingList(shopping_list.id, shopping_list.name, delta) if stored else shopping_list).to_wire(),
+            "delta": stored
         }
 
         response = self.send_message_to_router(request)
+        if response is False and stored:
+            # the replicas refuse a delta of a list they don't have, they get the whole list instead
+            print("Delta refused, sending the whole shopping list")
+            request["value"] = shopping_list.to_wire()
+            request["delta"] = False
+            response = self.send_message_to_router(request)
 
         if response:
             print("Shopping list stored successfully")
+            self.pending_deltas.pop(list_id, None)
+            self.stored_digests[list_id] = shopping_list.digest()
             return True
         else:
             print("Shopping list storage failed")
@@ -197,7 +221,7 @@ class Client:
 
         if response:
             print("Shopping list fetched successfully")
-            shopping_list_fetched = ShoppingList.from_dict(json.loads(response))
+            shopping_list_fetched = ShoppingList.from_wire(response)
             # get index of shopping list with the same id
             shopping_list_ids = [shopping_list.id for shopping_list in self.shopping_lists]
             try:
@@ -207,6 +231,9 @@ class Client:
             if index != -1:
                 # merge the shopping list
                 self.shopping_lists[index] = self.merge_shopping_lists([self.shopping_lists[index], shopping_list_fetched])
+                if list_id in self.pending_deltas:
+                    # the replicas may have compacted the list, the changes not stored yet are sent in its terms
+                    self.pending_deltas[list_id] = self.shopping_lists[index].items.delta_since(self.pending_deltas[list_id])
                 self.update_negative_quantities(self.shopping_lists[index])
                 print(f"Shopping list {shopping_list_fetched.name} updated successfully!\n")
             else:
@@ -243,6 +270,8 @@ class Client:
         shopping_list = next(filter(lambda x: x.id == list_id, self.shopping_lists), None)
 
         self.shopping_lists.remove(shopping_list)
+        self.pending_deltas.pop(list_id, None)
+        self.stored_digests.pop(list_id, None)
         response = self.send_message_to_router(request)
 
         if response:
@@ -259,7 +288,7 @@ class Client:
             print("Shopping list does not exist")
             return False
 
-        shopping_list.add_item(item, self.username)
+        self.record_delta(list_id, shopping_list.add_item(item, self.username))
 
         return shopping_list
     
@@ -270,7 +299,7 @@ class Client:
             print("Shopping list does not exist")
             return False
 
-        shopping_list.remove_item(item)
+        self.record_delta(list_id, shopping_list.remove_item(item, self.username))
 
         return shopping_list
     
@@ -281,7 +310,7 @@ class Client:
             print("Shopping list does not exist")
             return False
 
-        shopping_list.change_item_quantity(item, self.username)
+        self.record_delta(list_id, shopping_list.change_item_quantity(item, self.username))
 
         return shopping_list
 
@@ -289,7 +318,8 @@ class Client:
         for item in shopping_list.items.counters:
             value = shopping_list.items.value(item)
             if value < 0:
-                shopping_list.items = shopping_list.items.inc(item, self.username, -value)
+                self.record_delta(shopping_list.id,
+                                  shopping_list.apply_delta(shopping_list.items.inc_delta(item, self.username, -value)))
 
 
 def ask_for_items():
@@ -389,7 +419,7 @@ if __name__ == "__main__":
 
             quantity = get_int_from_user("Enter the quantity: ")
 
-            shopping_list.add_item((item, quantity), client.username)
+            client.add_item_to_shopping_list(shopping_list.id, (item, quantity))
             print(f'Shopping list updated')
 
         elif choice == '3':
@@ -420,7 +450,7 @@ if __name__ == "__main__":
                 break
 
             quantity = get_int_from_user("Enter the increase or decrease value: ")
-            shopping_list.change_item_quantity((item, quantity), client.username)
+            client.change_item_quantity(shopping_list.id, (item, quantity))
 
         elif choice == '5':
             (min, max) = show_available_lists(client)
@@ -1,8 +1,13 @@
+import hashlib
 import json
-from typing import Dict
-from collections import defaultdict
+import sys
+import threading
+from array import array
+from typing import Dict, Tuple
 
 ReplicaId = str
+VTime = Dict[ReplicaId, int]
+MClock = Dict[ReplicaId, VTime]
 
 Lt = -1
 Eq = 0
@@ -10,92 +15,279 @@ Gt = 1
 Cc = 2
 
 
+class ReplicaTable:
+    """Interns replica ids (e.g. tcp://localhost:5000) into small integers.
+    There is one table per process, so every counter of a node shares the same strings
+    """
+    __slots__ = ('indices', 'names', 'lock')
+
+    def __init__(self):
+        self.indices: Dict[ReplicaId, int] = {}
+        self.names: list[ReplicaId] = []
+        self.lock = threading.Lock()
+
+    def intern(self, replica: ReplicaId) -> int:
+        index = self.indices.get(replica)
+        if index is None:
+            with self.lock:
+                index = self.indices.get(replica)
+                if index is None:
+                    index = len(self.names)
+                    self.names.append(replica)
+                    self.indices[replica] = index
+        return index
+
+    def name(self, index: int) -> ReplicaId:
+        return self.names[index]
+
+
+REPLICA_TABLE = ReplicaTable()
+# replica of the entry where compaction folds the totals of retired replicas, see ShoppingListCRDT.compact
+ARCHIVED_REPLICA = '~archived'
+# counters with a small total are most of the counters (a few clients adding a few of an item), they are never
+# modified in place so equal ones are shared, up to SHARED_GCOUNTERS_LIMIT of them, see GCounter.from_entries
+SHARED_TOTAL_LIMIT = 16
+SHARED_GCOUNTERS_LIMIT = 1 << 16
+SHARED_GCOUNTERS = {}  # k: bytes of the entries
+
+
 class GCounter:
-    def __init__(self, counter_map, replica_clock=None):
-        self.counter_map = counter_map
-        self.replica_clock = defaultdict(int) if replica_clock is None else replica_clock
+    """Per replica totals, a flat array of (replica index, count) pairs sorted by replica index,
+    replica indices come from REPLICA_TABLE. The constructor still takes the dict of the json format.
+    A replica total only grows, so the merge is the max of each entry, the clocks of the replicas are kept
+    once for the whole list in ShoppingListCRDT.version.
+    total is the sum of the entries, kept up to date by inc and merge so value() doesn't walk the entries
+    """
+    __slots__ = ('entries', 'total')
 
+    def __init__(self, counter_map):
+        replicas = sorted((REPLICA_TABLE.intern(replica), replica) for replica in counter_map)
+        self.entries = array('q', [field for index, replica in replicas for field in (index, counter_map[replica])])
+        self.total = sum(counter_map.values())
+
+    @staticmethod
+    def from_entries(entries, total=None):
+        counter = GCounter.__new__(GCounter)
+        counter.entries = entries
+        counter.total = sum(entries[1::2]) if total is None else total
+        if 0 < counter.total <= SHARED_TOTAL_LIMIT:
+            key = entries.tobytes()
+            shared = SHARED_GCOUNTERS.get(key)
+            if shared is not None:
+                return shared
+            if len(SHARED_GCOUNTERS) < SHARED_GCOUNTERS_LIMIT:
+                SHARED_GCOUNTERS[key] = counter
+        return counter
 
     @staticmethod
     def zero():
-        return GCounter({}, {})
+        # counters are never modified in place, so every empty counter can be the same object
+        return EMPTY_GCOUNTER
 
     @staticmethod
     def from_dict(d):
-        return GCounter(d['counter_map'], d['replica_clock'])
+        # the replica_clock of the older format is not needed anymore
+        if not d['counter_map']:
+            return GCounter.zero()
+        counter = GCounter(d['counter_map'])
+        return GCounter.from_entries(counter.entries, counter.total)
+
+    def to_dict(self):
+        return {"counter_map": self.counter_map}
 
     def __repr__(self):
-        return f"GCounter(value={self.value()}, counter_map={self.counter_map}, replica_clock={self.replica_clock})"
+        return f"GCounter(value={self.value()}, counter_map={self.counter_map})"
+
+    @property
+    def counter_map(self):
+        return {REPLICA_TABLE.name(self.entries[i]): self.entries[i + 1] for i in range(0, len(self.entries), 2)}
 
     # @property
     def value(self):
-        return sum(self.counter_map.values())
+        return self.total
+
+    def get(self, index):
+        """Total of the replica index, 0 when it has no entry"""
+        i = self.find(index)
+        return self.entries[i + 1] if i < len(self.entries) and self.entries[i] == index else 0
+
+    def find(self, index):
+        """Position of the pair of the replica index, or where it should be inserted"""
+        for i in range(0, len(self.entries), 2):
+            if self.entries[i] >= index:
+                return i
+        return len(self.entries)
 
     def inc(self, replica, value):
-        updated_counter_map = self.counter_map.copy()
-        updated_counter_map[replica] = updated_counter_map.get(replica, 0) + value
+        index = REPLICA_TABLE.intern(replica)
+        i = self.find(index)
+        entries = array('q', self.entries)
+        if i < len(entries) and entries[i] == index:
+            entries[i + 1] += value
+        else:
+            entries[i:i] = array('q', (index, value))
+        return GCounter.from_entries(entries, self.total + value)
 
-        updated_replica_clock = self.replica_clock.copy()
-        updated_replica_clock[replica] = updated_replica_clock.get(replica, 0) + 1
+    def inc_delta(self, replica, value):
+        """Same as inc but only returns the entry of the replica that changed"""
+        index = REPLICA_TABLE.intern(replica)
+        i = self.find(index)
+        if i < len(self.entries) and self.entries[i] == index:
+            return GCounter.from_entries(array('q', (index, self.entries[i + 1] + value)), self.entries[i + 1] + value)
+        return GCounter.from_entries(array('q', (index, value)), value)
+
+    def merge(self, other_counter):
+        """Returns self when other_counter adds nothing, so callers can tell a no-op merge"""
+        a, b = self.entries, other_counter.entries
+        if not b:
+            return self
+        if not a:
+            return other_counter
+        i, j = 0, 0
+        merged_entries = []
+        grew = False
+        # the merged total is the sum of both totals minus the smaller entry of each shared replica
+        total = self.total + other_counter.total
+        while i < len(a) and j < len(b):
+            if a[i] < b[j]:
+                merged_entries += (a[i], a[i + 1])
+                i += 2
+            elif a[i] > b[j]:
+                merged_entries += (b[j], b[j + 1])
+                grew = True
+                j += 2
+            else:
+                merged_entries += (a[i], max(a[i + 1], b[j + 1]))
+                grew = grew or b[j + 1] > a[i + 1]
+                total -= min(a[i + 1], b[j + 1])
+                i += 2
+                j += 2
+        if not grew and j == len(b):
+            return self
+        merged_entries.extend(a[i:])
+        merged_entries.extend(b[j:])
+        return GCounter.from_entries(array('q', merged_entries), total)
 
-        return GCounter(updated_counter_map, updated_replica_clock)
+    def covers(self, other_counter):
+        """True when every entry of other_counter is at most the same entry of this counter"""
+        a, b = self.entries, other_counter.entries
+        i = 0
+        for j in range(0, len(b), 2):
+            while i < len(a) and a[i] < b[j]:
+                i += 2
+            if i == len(a) or a[i] != b[j] or a[i + 1] < b[j + 1]:
+                return False
+        return True
 
-    def compare_clocks(self, clock_a, clock_b):
-        keys = set(clock_a.keys()) | set(clock_b.keys())
-        prev = Eq
+    def fold(self, indices, into):
+        """Moves the totals of the replica indices into the entry of the replica index into, the value is unchanged"""
+        entries = self.entries
+        folded = 0
+        kept = []
+        for i in range(0, len(entries), 2):
+            if entries[i] in indices:
+                folded += entries[i + 1]
+            elif entries[i] != into:
+                kept.append((entries[i], entries[i + 1]))
+        if folded == 0 and len(kept) << 1 == len(entries):
+            return self
+        i = self.find(into)
+        if i < len(entries) and entries[i] == into:
+            folded += entries[i + 1]
+        kept.append((into, folded))
+        kept.sort()
+        return GCounter.from_entries(array('q', [field for pair in kept for field in pair]), self.total)
 
-        # ex: clock_a = {'a': 1, 'b': 2, 'c': 1}, clock_b = {'a': 1, 'b': 1, 'c': 2} are concurrent
-        # the merge of these two clocks is {'a': 1, 'b': 2, 'c': 2}
+    def without(self, indices):
+        """The counter without the entries of the replica indices"""
+        entries = self.entries
+        if not any(entries[i] in indices for i in range(0, len(entries), 2)):
+            return self
+        kept = [field for i in range(0, len(entries), 2) if entries[i] not in indices for field in entries[i:i + 2]]
+        return GCounter.from_entries(array('q', kept)) if kept else GCounter.zero()
 
-        for k in keys:
-            va = clock_a.get(k, 0)
-            vb = clock_b.get(k, 0)
+    def forget(self, covered, returned, into, archived_total=0):
+        """Drops the entries of the covered replica indices, a compaction folded them into the entry of into.
+        It also folded what the returned ones had then, and they wrote again since: what archived_total, the
+        entry of into after the compaction, has beyond this counter's and the covered entries is taken out of
+        the returned entries, so they keep what was written since"""
+        entries = self.entries
+        if not any(entries[i] in covered or entries[i] in returned for i in range(0, len(entries), 2)):
+            return self
+        totals = dict(zip(entries[0::2], entries[1::2]))
+        folded = archived_total - totals.get(into, 0) - sum(totals.get(index, 0) for index in covered)
+        kept = []
+        for i in range(0, len(entries), 2):
+            index, total = entries[i], entries[i + 1]
+            if index in covered:
+                continue
+            if index in returned and folded > 0:
+                taken = min(total, folded)
+                folded -= taken
+                total -= taken
+            if total > 0:
+                kept += (index, total)
+        return GCounter.from_entries(array('q', kept)) if kept else GCounter.zero()
 
-            if prev == Eq:
-                if va > vb:
-                    prev = Gt
-                elif va < vb:
-                    prev = Lt
-            elif prev == Lt and va > vb:
-                return Cc
-            elif prev == Gt and va < vb:
-                return Cc
+    def plus(self, other_counter):
+        """Entry by entry sum of the two counters"""
+        if not other_counter.entries:
+            return self
+        if not self.entries:
+            return other_counter
+        totals = dict(zip(self.entries[0::2], self.entries[1::2]))
+        for i in range(0, len(other_counter.entries), 2):
+            totals[other_counter.entries[i]] = totals.get(other_counter.entries[i], 0) + other_counter.entries[i + 1]
+        return GCounter.from_entries(array('q', [field for index in sorted(totals) for field in (index, totals[index])]),
+                                     self.total + other_counter.total)
 
-        return prev
+    def rebase(self, base, own):
+        """Takes out of each entry what base absorbed beyond own, the entries left at zero or below are dropped.
+        base and own are absorbed totals of the same item, see ShoppingListCRDT.absorbed"""
+        own_totals = dict(zip(own.entries[0::2], own.entries[1::2]))
+        absorbed = {base.entries[i]: base.entries[i + 1] - own_totals.get(base.entries[i], 0)
+                    for i in range(0, len(base.entries), 2)}
+        entries = self.entries
+        if not any(absorbed.get(entries[i], 0) > 0 for i in range(0, len(entries), 2)):
+            return self
+        kept = []
+        for i in range(0, len(entries), 2):
+            total = entries[i + 1] - max(absorbed.get(entries[i], 0), 0)
+            if total > 0:
+                kept += (entries[i], total)
+        return GCounter.from_entries(array('q', kept)) if kept else GCounter.zero()
 
-    def merge(self, other_counter):
-        comparison_result = self.compare_clocks(self.replica_clock, other_counter.replica_clock)
+    @staticmethod
+    def merge_many(counters):
+        """Join of any number of counters in one pass"""
+        totals = {}
+        result = None
+        for counter in counters:
+            entries = counter.entries
+            if not entries:
+                continue
+            result = counter if result is None else True  # the only non empty counter is already the join
+            for i in range(0, len(entries), 2):
+                if entries[i + 1] > totals.get(entries[i], -1):
+                    totals[entries[i]] = entries[i + 1]
+        if result is None:
+            return GCounter.zero()
+        if result is not True:
+            return result
+        return GCounter.from_entries(array('q', [field for index in sorted(totals) for field in (index, totals[index])]),
+                                     sum(totals.values()))
 
-        if comparison_result == Lt:
-            merged_replica_clock = other_counter.replica_clock.copy()
-        elif comparison_result == Gt:
-            merged_replica_clock = self.replica_clock.copy()
-        else:
-            # Concurrent, resolve conflicts based on the maximum values
-            merged_replica_clock = {k: max(self.replica_clock.get(k, 0), other_counter.replica_clock.get(k, 0))
-                                    for k in set(self.replica_clock) | set(other_counter.replica_clock)}
-
-        merged_counter_map = self.counter_map.copy()
-
-        # use the merged replica clock to resolve conflicts
-        keys = set(self.replica_clock.keys()) | set(other_counter.replica_clock.keys())
-        for replica in keys:
-            if self.replica_clock.get(replica, 0) == merged_replica_clock.get(replica, -1):
-                merged_counter_map[replica] = self.counter_map.get(replica, 0)
-            elif other_counter.replica_clock.get(replica, 0) == merged_replica_clock.get(replica, -1):
-                merged_counter_map[replica] = other_counter.counter_map.get(replica, 0)
-            else:
-                print("This should never happen")
-                merged_counter_map[replica] = max(self.counter_map.get(replica, 0),
-                                                  other_counter.counter_map.get(replica, 0))
 
-        return GCounter(merged_counter_map, merged_replica_clock)
+EMPTY_GCOUNTER = GCounter.from_entries(array('q'), 0)
 
 
 class PNCounter:
+    __slots__ = ('inc_counter', 'dec_counter', '_digest')
+
     def __init__(self, inc, dec):
         self.inc_counter = inc
         self.dec_counter = dec
+        self._digest = None
 
     def __repr__(self):
         return f"PNCounter(value={self.value()}, inc={self.inc_counter}, dec={self.dec_counter})"
@@ -104,9 +296,12 @@ class PNCounter:
     def zero():
         return PNCounter(GCounter.zero(), GCounter.zero())
 
+    def to_dict(self):
+        return {"inc_counter": self.inc_counter.to_dict(), "dec_counter": self.dec_counter.to_dict()}
+
     # @property
     def value(self):
-        return max(GCounter.value(self.inc_counter) - GCounter.value(self.dec_counter), 0)
+        return max(self.inc_counter.total - self.dec_counter.total, 0)
 
     def inc(self, replica, value):
         return PNCounter(GCounter.inc(self.inc_counter, replica, value), self.dec_counter)
@@ -114,76 +309,733 @@ class PNCounter:
     def dec(self, replica, value):
         return PNCounter(self.inc_counter, GCounter.inc(self.dec_counter, replica, value))
 
+    def inc_delta(self, replica, value):
+        return PNCounter(self.inc_counter.inc_delta(replica, value), GCounter.zero())
+
+    def dec_delta(self, replica, value):
+        return PNCounter(GCounter.zero(), self.dec_counter.inc_delta(replica, value))
+
     def merge(self, other_counter):
-        merged_inc = GCounter.merge(self.inc_counter, other_counter.inc_counter)
-        merged_dec = GCounter.merge(other_counter.dec_counter, self.dec_counter)
+        merged_inc = self.inc_counter.merge(other_counter.inc_counter)
+        merged_dec = self.dec_counter.merge(other_counter.dec_counter)
+        if merged_inc is self.inc_counter and merged_dec is self.dec_counter:
+            return self
         return PNCounter(merged_inc, merged_dec)
 
+    def covers(self, other_counter):
+        return self.inc_counter.covers(other_counter.inc_counter) and self.dec_counter.covers(other_counter.dec_counter)
+
+    def plus(self, other_counter):
+        return PNCounter(self.inc_counter.plus(other_counter.inc_counter), self.dec_counter.plus(other_counter.dec_counter))
+
+    def rebase(self, base, own):
+        inc = self.inc_counter.rebase(base.inc_counter, own.inc_counter)
+        dec = self.dec_counter.rebase(base.dec_counter, own.dec_counter)
+        if inc is self.inc_counter and dec is self.dec_counter:
+            return self
+        return PNCounter(inc, dec)
+
+    def forget(self, covered, returned, into, others=()):
+        """See GCounter.forget, the archived totals are the largest entries of into among others, the counters
+        of the item in the states that saw the compaction"""
+        inc = self.inc_counter.forget(covered, returned, into, max((c.inc_counter.get(into) for c in others), default=0))
+        dec = self.dec_counter.forget(covered, returned, into, max((c.dec_counter.get(into) for c in others), default=0))
+        if inc is self.inc_counter and dec is self.dec_counter:
+            return self
+        return PNCounter(inc, dec)
+
+    def is_zero(self):
+        return not self.inc_counter.entries and not self.dec_counter.entries
+
+    def digest(self):
+        """Order independent hash of the entries, the counter is immutable so it is computed once"""
+        if self._digest is None:
+            digest = 0
+            for side, entries in (('+', self.inc_counter.entries), ('-', self.dec_counter.entries)):
+                for i in range(0, len(entries), 2):
+                    digest += digest_of(side, REPLICA_TABLE.name(entries[i]), entries[i + 1])
+            self._digest = digest & DIGEST_MASK
+        return self._digest
+
+    @staticmethod
+    def merge_many(counters):
+        counters = list(counters)
+        return PNCounter(GCounter.merge_many(counter.inc_counter for counter in counters),
+                         GCounter.merge_many(counter.dec_counter for counter in counters))
+
+
+ZERO_PNCOUNTER = PNCounter.zero()
+
 
 class ShoppingListCRDT:
-    """This is essentially a PNCounterMap"""
+    """This is essentially a PNCounterMap.
+    version is the causal context of the whole list: for each replica, the number of its operations
+    (inc, dec or delete on any item) folded into this state. Deltas carry the version of their operations.
+    archived has the clock of every replica retired by compact, their entries live in the ARCHIVED_REPLICA
+    entry of each counter and they are no longer in version, a state that missed a compaction drops them, see forget.
+    absorbed has, for each item removed by collect, the round of the collection and the totals of every replica
+    taken out of its entries, so the entries of a replica are its operations on the item minus what was absorbed.
+    A state that missed a collection is brought to the same terms by taking out the difference, see drop_collected.
+    Once every replica has seen a collection its totals are no longer needed, expired is the last round dropped.
+    gc is the horizon of the last tombstone collection, the state has every operation it covers and the
+    items deleted before it are gone, see collect
+    """
+    __slots__ = ('counters', 'version', 'archived', 'gc', 'absorbed', 'expired', '_digest')
 
     def __repr__(self):
-        return f"ShoppingListCRDT(counters={self.counters})"
+        return (f"ShoppingListCRDT(counters={self.counters}, version={self.version}, archived={self.archived}, "
+                f"gc={self.gc}, absorbed={self.absorbed}, expired={self.expired})")
 
     @staticmethod
     def zero():
         return ShoppingListCRDT({})
 
-    def __init__(self, counters):
+    def __init__(self, counters, version=None, archived=None, gc=None, absorbed=None, expired=0):
         self.counters: Dict[str, PNCounter] = counters
-
-    def get_or_create(self, id):
-        if id not in self.counters:
-            self.counters[id] = PNCounter.zero()
-        return self.counters[id]
+        self.version: VTime = {} if version is None else version
+        self.archived: VTime = {} if archived is None else archived
+        self.gc: VTime = {} if gc is None else gc
+        self.absorbed: Dict[str, Tuple[int, PNCounter]] = {} if absorbed is None else absorbed
+        self.expired = expired
+        self._digest = None
 
     def inc(self, id, replica, value):
-        assert value >= 0
-        counter = self.get_or_create(id)
-        updated_counters = self.counters.copy()
-        updated_counters.update({id: counter.inc(replica, value)})
-        return ShoppingListCRDT(updated_counters)
+        return self.merge(self.inc_delta(id, replica, value))
 
     def dec(self, id, replica, value):
+        return self.merge(self.dec_delta(id, replica, value))
+
+    def next_version(self, replica):
+        # a retired replica that writes again continues after its archived clock, its entries only
+        # count what it did since, the rest is in the archived entries
+        return {replica: max(self.version.get(replica, 0), self.archived.get(replica, 0)) + 1}
+
+    def delta_of(self, counters, version):
+        """A delta of this state, it carries the clocks of the compactions and collections it was made after and
+        the absorbed totals of its own items, so a replica that saw later ones can bring its entries to their
+        terms. A replica that missed some of them can't take the delta, see missed"""
+        absorbed = {id: self.absorbed[id] for id in counters if id in self.absorbed}
+        return ShoppingListCRDT(counters, version, self.archived, self.gc, absorbed, self.expired)
+
+    def missed(self, other):
+        """True when other was made after a compaction or a collection this state hasn't seen. Such a delta can't
+        be merged into it: forget takes the archived entries of the items from the states it is merged with and
+        drop_collected needs the absorbed totals of every item, a delta only has its own"""
+        if any(clock > self.archived.get(replica, 0) for replica, clock in other.archived.items()):
+            return True
+        # compaction drops the retired replicas from the gc horizon
+        return any(clock > self.gc.get(replica, 0) and clock > self.archived.get(replica, 0)
+                   for replica, clock in other.gc.items())
+
+    def delta_since(self, delta):
+        """The entries of this state for the items and replicas of an older delta it has merged, in the terms of
+        the compactions of this state, so it can be sent instead of the delta"""
+        return self.delta_of({id: self.counters[id] for id in delta.counters if id in self.counters},
+                             {replica: clock for replica, clock in self.version.items() if replica in delta.version})
+
+    def inc_delta(self, id, replica, value):
+        """Returns a delta with only the changed entry of the item, it can be merged like any other state"""
         assert value >= 0
-        counter = self.get_or_create(id)
-        updated_counters = self.counters.copy()
-        updated_counters.update({id: counter.dec(replica, value)})
-        return ShoppingListCRDT(updated_counters)
+        counter = self.counters.get(id, PNCounter.zero())
+        return self.delta_of({id: counter.inc_delta(replica, value)}, self.next_version(replica))
+
+    def dec_delta(self, id, replica, value):
+        assert value >= 0
+        counter = self.counters.get(id, PNCounter.zero())
+        return self.delta_of({id: counter.dec_delta(replica, value)}, self.next_version(replica))
 
     def merge(self, other):
-        merged_counters = {}
-        for id, counter in self.counters.items():
-            if id in other.counters:
-                merged_counters[id] = counter.merge(other.counters[id])
-            else:
-                merged_counters[id] = counter
+        """Returns self (or other) when the other state adds nothing to it"""
+        if self._digest is not None and self._digest == other._digest:
+            return self
+        if self.archived != other.archived:
+            archived = merge_archived((self, other))
+            self, other = self.forget(archived, (other,)), other.forget(archived, (self,))
+        if self.expired != other.expired:
+            expired = max(self.expired, other.expired)
+            self, other = self.expire(expired), other.expire(expired)
+        if self.gc != other.gc:
+            gc = merge_clocks((self.gc, other.gc))
+            absorbed = merge_absorbed((self, other))
+            if gc != other.gc:
+                other = other.drop_collected(gc, absorbed)
+            if gc != self.gc:
+                self = self.drop_collected(gc, absorbed)
+        # walk the smaller of the two states, so merging a delta costs the size of the delta,
+        # unless only this state has a digest to carry over
+        if len(self.counters) < len(other.counters) and (self._digest is None or other._digest is not None):
+            self, other = other, self
+        changed = []  # (item id, counter before, counter after)
+        for id, counter in other.counters.items():
+            current = self.counters.get(id)
+            if current is None:
+                changed.append((id, None, counter))
+            elif current is not counter:
+                merged = current.merge(counter)
+                if merged is not current:
+                    changed.append((id, current, merged))
+        # a single join of the list versions, then the max of each entry of the items
+        newer = {replica: clock for replica, clock in other.version.items() if clock > self.version.get(replica, 0)}
+        archived = other.archived if other.archived and not self.archived else self.archived
+        gc = other.gc if other.gc and not self.gc else self.gc
+        absorbed = self.absorbed
+        if other.absorbed and other.absorbed is not absorbed:
+            # a delta only has the totals of its items, which the whole state already has
+            larger, smaller = (absorbed, other.absorbed) if len(absorbed) >= len(other.absorbed) else (other.absorbed, absorbed)
+            absorbed = larger if all(larger.get(id) == entry for id, entry in smaller.items()) else merge_absorbed((self, other))
+        if not changed and not newer and archived is self.archived and gc is self.gc and absorbed is self.absorbed:
+            return self
+
+        merged_counters = self.counters.copy()
+        for id, _, counter in changed:
+            merged_counters[id] = counter
+        result = ShoppingListCRDT(merged_counters, {**self.version, **newer} if newer else self.version, archived, gc,
+                                  absorbed, self.expired)
+        if self._digest is not None and archived is self.archived and gc is self.gc and absorbed is self.absorbed:
+            # only the changed items and clocks are hashed
+            digest = self._digest
+            for id, before, after in changed:
+                digest += item_digest(id, after) - (item_digest(id, before) if before is not None else 0)
+            for replica, clock in newer.items():
+                digest += digest_of('v', replica, clock)
+                if replica in self.version:
+                    digest -= digest_of('v', replica, self.version[replica])
+            result._digest = digest & DIGEST_MASK
+        return result
+
+    def covers(self, other):
+        """True when other adds nothing to this state, without building the merge"""
+        if (other.archived and other.archived != self.archived) or (other.gc and other.gc != self.gc):
+            return False
+        if any(clock > self.version.get(replica, 0) for replica, clock in other.version.items()):
+            return False
         for id, counter in other.counters.items():
-            if id not in merged_counters:
-                merged_counters[id] = counter
-        return ShoppingListCRDT(merged_counters)
+            current = self.counters.get(id)
+            if current is None or (current is not counter and not current.covers(counter)):
+                return False
+        return True
+
+    def digest(self):
+        """Stable hash of the canonical state, the same in every process. It is computed once and
+        then carried over by merge, which only hashes what changed, so inc and dec keep it up to date"""
+        if self._digest is None:
+            digest = sum(item_digest(id, counter) for id, counter in self.counters.items())
+            for tag, clocks in (('v', self.version), ('a', self.archived), ('g', self.gc)):
+                digest += sum(digest_of(tag, replica, clock) for replica, clock in clocks.items())
+            digest += sum(digest_of('b', id, round, counter.digest()) for id, (round, counter) in self.absorbed.items())
+            digest += digest_of('e', self.expired)
+            self._digest = digest & DIGEST_MASK
+        return self._digest
+
+    @staticmethod
+    def merge_many(states):
+        """Join of any number of states in one pass, each item is merged once no matter how many states have it"""
+        states, archived, gc, absorbed, expired = ShoppingListCRDT.align(states)
+        if len(states) == 0:
+            return ShoppingListCRDT.zero()
+        version = {}
+        for state in states:
+            for replica, clock in state.version.items():
+                if clock > version.get(replica, 0):
+                    version[replica] = clock
+
+        # counters are immutable and shared between versions of a list, so only the items
+        # that differ from the largest state are merged, and the same object is merged once
+        base = max(states, key=lambda state: len(state.counters))
+        counters = base.counters.copy()
+        conflicts = {}  # k: item id, v: the distinct counters of that item
+        for state in states:
+            if state is base:
+                continue
+            for id, counter in state.counters.items():
+                current = counters.get(id)
+                if current is None:
+                    counters[id] = counter
+                elif current is not counter:
+                    group = conflicts.setdefault(id, [current])
+                    if not any(counter is other for other in group):
+                        group.append(counter)
+        for id, group in conflicts.items():
+            counters[id] = PNCounter.merge_many(group)
+        return ShoppingListCRDT(counters, version, archived, gc, absorbed, expired)
+
+    @staticmethod
+    def align(states):
+        """Brings the states to the latest compaction and collection among them before merging them,
+        returns the aligned states and the merged archived clocks, gc horizon, absorbed totals and expired round"""
+        states = list(states)
+        archived = merge_archived(states)
+        states = [state.forget(archived, states) for state in states]
+        expired = max((state.expired for state in states), default=0)
+        states = [state.expire(expired) for state in states]
+        absorbed = merge_absorbed(states)
+        gc = merge_clocks(state.gc for state in states)
+        if any(state.gc != gc for state in states):
+            states = [state if state.gc == gc else state.drop_collected(gc, absorbed) for state in states]
+        return states, archived, gc, absorbed, expired
+
+    def compact(self, retired: VTime):
+        """Folds the entries of the retired replicas into the ARCHIVED_REPLICA entry of each counter, so each item
+        keeps a single entry for all of them. retired has the clock of each replica, which every live replica must
+        have already observed: a state still holding their entries drops them when merged with this one (see
+        forget), and the archived entries of two compactions are merged with max, so each one must include the
+        previous.
+        Compaction rounds are run by the primary node of the list, see Node.compact_list
+        """
+        retired = {replica: clock for replica, clock in retired.items() if replica != ARCHIVED_REPLICA}
+        if not retired:
+            return self
+        indices = {REPLICA_TABLE.intern(replica) for replica in retired}
+        into = REPLICA_TABLE.intern(ARCHIVED_REPLICA)
+        counters = {id: PNCounter(counter.inc_counter.fold(indices, into), counter.dec_counter.fold(indices, into))
+                    for id, counter in self.counters.items()}
+        version = {replica: clock for replica, clock in self.version.items() if replica not in retired}
+        # forget drops their entries from older states, so the gc horizon doesn't need them either
+        gc = {replica: clock for replica, clock in self.gc.items() if replica not in retired}
+        return ShoppingListCRDT(counters, version, Version.merge(self.archived, retired), gc,
+                                self.folded_absorbed(indices, into), self.expired)
+
+    def forget(self, archived: VTime, states=()):
+        """Aligns the state with the archived clocks of a compaction it hasn't seen, states are the ones it is
+        merged with. The replicas that it only knows up to their archived clock are dropped, their entries are in
+        the archived entries. A retired replica with newer operations wrote again from a state that missed the
+        compaction, it keeps what its entries have beyond what was folded from it: the growth of the archived
+        entry of the item among states, less the entries of the replicas dropped with it. That is exact when the
+        state had observed their clocks, which compact requires from every live replica
+        """
+        if self.archived is archived or self.archived == archived:
+            return self
+        newly = {replica: clock for replica, clock in archived.items() if self.archived.get(replica, 0) < clock}
+        version = {replica: clock for replica, clock in self.version.items()
+                   if not (replica in newly and clock <= newly[replica])}
+        covered = {REPLICA_TABLE.intern(replica) for replica in newly if replica not in version}
+        returned = {REPLICA_TABLE.intern(replica) for replica in newly if replica in version}
+        into = REPLICA_TABLE.intern(ARCHIVED_REPLICA)
+        counters = {}
+        for id, counter in self.counters.items():
+            others = [state.counters[id] for state in states if id in state.counters] if returned else ()
+            counter = counter.forget(covered, returned, into, others)
+            if not counter.is_zero():
+                counters[id] = counter
+        # the absorbed totals of a collection never grow, so theirs are folded like compact did
+        return ShoppingListCRDT(counters, version, archived, self.gc, self.folded_absorbed(covered | returned, into),
+                                self.expired)
+
+    def folded_absorbed(self, indices, into):
+        return {id: (round, PNCounter(counter.inc_counter.fold(indices, into), counter.dec_counter.fold(indices, into)))
+                for id, (round, counter) in self.absorbed.items()}
+
+    def rebased(self, absorbed):
+        """The counters with what absorbed has beyond the absorbed totals of this state taken out of their entries,
+        the items left without entries are dropped"""
+        if absorbed is self.absorbed:
+            return self.counters
+        counters = {}
+        for id, counter in self.counters.items():
+            base = absorbed.get(id)
+            if base is not None and base is not self.absorbed.get(id):
+                own = self.absorbed.get(id)
+                counter = counter.rebase(base[1], ZERO_PNCOUNTER if own is None else own[1])
+                if counter.is_zero():
+                    continue
+            counters[id] = counter
+        return counters
+
+    def collect(self, ids):
+        """Removes the tombstones of the items, which should be at zero in every replica of the list, their entries
+        go to the absorbed totals of the items under a new round and the gc horizon moves up to the version of the
+        state.
+        Collection rounds are run by the primary node of the list, see Node.collect_list
+        """
+        round = self.seen_round() + 1
+        counters = {}
+        absorbed = dict(self.absorbed)
+        for id, counter in self.counters.items():
+            if id not in ids:
+                counters[id] = counter
+            elif not counter.is_zero():
+                # an item collected again absorbs its whole history, so a state that missed both rounds is covered
+                absorbed[id] = (round, absorbed[id][1].plus(counter) if id in absorbed else counter)
+        return ShoppingListCRDT(counters, self.version, self.archived, Version.merge(self.gc, self.version), absorbed,
+                                self.expired)
+
+    def expire(self, round):
+        """Drops the absorbed totals of the collections up to round, every replica must have seen them: a state
+        that missed one of them would keep its items, see Node.collected_list"""
+        if round <= self.expired:
+            return self
+        absorbed = {id: (collected, counter) for id, (collected, counter) in self.absorbed.items() if collected > round}
+        return ShoppingListCRDT(self.counters, self.version, self.archived, self.gc, absorbed, round)
+
+    def seen_round(self):
+        """The last collection round this state has seen"""
+        return max(self.expired, max((round for round, _ in self.absorbed.values()), default=0))
+
+    def drop_collected(self, gc, absorbed):
+        """Aligns the state with a collection it hasn't seen. The decision is per item and per replica: what the
+        collection absorbed from an entry is taken out of it, so an item the state only knows up to its deletion
+        is dropped, and the operations of a replica that the collection didn't see are kept on their own, whether
+        the item was added again or never deleted there
+        """
+        return ShoppingListCRDT(self.rebased(absorbed), self.version, self.archived, gc, absorbed, self.expired)
+
+    def is_empty(self):
+        return len(self.counters) == 0
 
     def value(self, key):
-        return self.get_or_create(key).value()
+        # reading doesn't add the item, the state may be shared and its digest cached
+        counter = self.counters.get(key)
+        return 0 if counter is None else counter.value()
 
-    def delete(self, key):
+    def delete(self, key, replica=None):
+        return self.merge(self.delete_delta(key, replica))
+
+    def delete_delta(self, key, replica=None):
+        """replica defaults to the key itself, which is what older clients used"""
+        replica = key if replica is None else replica
 #         decrement by the current value
-        counter = self.get_or_create(key)
-        updated_counters = self.counters.copy()
-        updated_counters.update({key: counter.dec(key, counter.value())})
-        return ShoppingListCRDT(updated_counters)
+        counter = self.counters.get(key, PNCounter.zero())
+        return self.delta_of({key: counter.dec_delta(replica, counter.value())}, self.next_version(replica))
+
+    def mutate(self):
+        return ShoppingListBuilder(self)
 
     @staticmethod
     def from_dict(counters):
-        counters = {k: PNCounter(GCounter.from_dict(v['inc_counter']), GCounter.from_dict(v['dec_counter'])) for k, v in counters['counters'].items()}
-        return ShoppingListCRDT(counters)
+        archived = counters.get('archived', {})
+        gc = counters.get('gc', {})
+        expired = counters.get('expired', 0)
+        # format 4 had no rounds, and also kept what compaction took from the items still in the list
+        absorbed = {sys.intern(k): (v.get('round', 1), PNCounter(GCounter.from_dict(v['inc_counter']),
+                                                                 GCounter.from_dict(v['dec_counter'])))
+                    for k, v in counters.get('absorbed', {}).items() if 'round' in v or k not in counters['counters']}
+        version = counters.get('version')
+        if version is None:
+            # stored before the list version existed, rebuild it from the clocks that every counter kept
+            version = {}
+            for v in counters['counters'].values():
+                for counter in (v['inc_counter'], v['dec_counter']):
+                    for replica, clock in counter.get('replica_clock', {}).items():
+                        version[replica] = version.get(replica, 0) + clock
+        counters = {sys.intern(k): PNCounter(GCounter.from_dict(v['inc_counter']), GCounter.from_dict(v['dec_counter'])) for k, v in counters['counters'].items()}
+        return ShoppingListCRDT(counters, version, archived, gc, absorbed, expired)
+
+    def to_dict(self):
+        return {"counters": {k: v.to_dict() for k, v in self.counters.items()}, "version": self.version,
+                "archived": self.archived, "gc": self.gc,
+                "absorbed": {k: {"round": round, **v.to_dict()} for k, (round, v) in self.absorbed.items()},
+                "expired": self.expired}
 
     def to_json_string(self):
-        return json.dumps(self, indent=2, default=lambda x: x.__dict__)
+        return json.dumps(self, indent=2, default=to_serializable)
+
+    def to_bytes(self):
+        out = bytearray(BINARY_MAGIC)
+        out.append(BINARY_FORMAT_VERSION)
+        self.write_binary(out)
+        return bytes(out)
+
+    @staticmethod
+    def from_bytes(data):
+        format_version, pos = read_binary_header(data)
+        state, _ = ShoppingListCRDT.read_binary(data, pos, format_version)
+        return state
+
+    def write_binary(self, out: bytearray):
+        """The replica ids of the state are written once and then referred to by their position"""
+        version = {REPLICA_TABLE.intern(replica): clock for replica, clock in self.version.items()}
+        archived = {REPLICA_TABLE.intern(replica): clock for replica, clock in self.archived.items()}
+        gc = {REPLICA_TABLE.intern(replica): clock for replica, clock in self.gc.items()}
+        used = set(version) | set(archived) | set(gc)
+        for counter in (*self.counters.values(), *(counter for _, counter in self.absorbed.values())):
+            used.update(counter.inc_counter.entries[0::2])
+            used.update(counter.dec_counter.entries[0::2])
+        replicas = sorted(used)
+        positions = {index: position for position, index in enumerate(replicas)}
+
+        write_varint(out, len(replicas))
+        for index in replicas:
+            write_string(out, REPLICA_TABLE.name(index))
+        for clocks in (version, archived, gc):
+            write_varint(out, len(clocks))
+            for index, clock in clocks.items():
+                write_varint(out, positions[index])
+                write_varint(out, clock)
+        for counters in (self.counters, self.absorbed):
+            if counters is self.absorbed:
+                write_varint(out, self.expired)
+            write_varint(out, len(counters))
+            for id, counter in counters.items():
+                write_string(out, id)
+                if counters is self.absorbed:
+                    round, counter = counter
+                    write_varint(out, round)
+                for gcounter in (counter.inc_counter, counter.dec_counter):
+                    entries = gcounter.entries
+                    write_varint(out, len(entries) >> 1)
+                    for i in range(0, len(entries), 2):
+                        write_varint(out, positions[entries[i]])
+                        write_varint(out, entries[i + 1])
+
+    @staticmethod
+    def read_binary(data, pos, format_version=None):
+        """Returns the state and the position after it, format 1 has no archived clocks, format 2 no gc horizon,
+        format 3 no absorbed totals and format 4 no collection rounds"""
+        count, pos = read_varint(data, pos)
+        indices = []
+        for _ in range(count):
+            replica, pos = read_string(data, pos)
+            indices.append(REPLICA_TABLE.intern(replica))
+        # the positions were written in the order of the sender's table, which may not be the order of ours
+        ordered = all(indices[i] < indices[i + 1] for i in range(len(indices) - 1))
+
+        version = {}
+        count, pos = read_varint(data, pos)
+        for _ in range(count):
+            position, pos = read_varint(data, pos)
+            version[REPLICA_TABLE.name(indices[position])], pos = read_varint(data, pos)
+        archived = {}
+        gc = {}
+        for clocks, since in ((archived, 2), (gc, 3)):
+            if format_version is not None and format_version < since:
+                continue
+            count, pos = read_varint(data, pos)
+            for _ in range(count):
+                position, pos = read_varint(data, pos)
+                clocks[REPLICA_TABLE.name(indices[position])], pos = read_varint(data, pos)
+
+        counters = {}
+        absorbed = {}
+        expired = 0
+        rounds = format_version is None or format_version >= 5
+        for items in (counters, absorbed):
+            if items is absorbed and format_version is not None and format_version < 4:
+                continue
+            if items is absorbed and rounds:
+                expired, pos = read_varint(data, pos)
+            count, pos = read_varint(data, pos)
+            for _ in range(count):
+                id, pos = read_string(data, pos)
+                round = 1
+                if items is absorbed and rounds:
+                    round, pos = read_varint(data, pos)
+                gcounters = []
+                for _ in range(2):
+                    entry_count, pos = read_varint(data, pos)
+                    if entry_count == 0:
+                        gcounters.append(GCounter.zero())
+                        continue
+                    entries = []
+                    for _ in range(entry_count):
+                        # most positions and totals fit in one byte, so that case skips the call
+                        position = data[pos]
+                        if position < 0x80:
+                            pos += 1
+                        else:
+                            position, pos = read_varint(data, pos)
+                        total = data[pos]
+                        if total < 0x80:
+                            pos += 1
+                        else:
+                            total, pos = read_varint(data, pos)
+                        entries += (indices[position], total)
+                    if not ordered:
+                        pairs = sorted(zip(entries[0::2], entries[1::2]))
+                        entries = [field for pair in pairs for field in pair]
+                    gcounters.append(GCounter.from_entries(array('q', entries)))
+                counter = PNCounter(gcounters[0], gcounters[1])
+                if items is counters:
+                    counters[sys.intern(id)] = counter
+                elif rounds or id not in counters:
+                    # format 4 also kept what compaction took from the items still in the list
+                    absorbed[sys.intern(id)] = (round, counter)
+        return ShoppingListCRDT(counters, version, archived, gc, absorbed, expired), pos
+
+
+# Binary format: magic, format version and then unsigned varints, strings are a varint length and utf-8 bytes
+BINARY_MAGIC = b'SL'
+BINARY_FORMAT_VERSION = 5  # 2 added the archived clocks, 3 the gc horizon, 4 the absorbed totals, 5 their rounds
+
+
+def write_varint(out: bytearray, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    result = data[pos]
+    pos += 1
+    if result < 0x80:
+        return result, pos
+    result &= 0x7f
+    shift = 7
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_string(out: bytearray, value):
+    encoded = value.encode('utf-8')
+    write_varint(out, len(encoded))
+    out += encoded
+
+
+def read_string(data, pos):
+    length, pos = read_varint(data, pos)
+    return data[pos:pos + length].decode('utf-8'), pos + length
+
+
+def read_binary_header(data):
+    """Checks the magic and format version, returns the format version and the position after them"""
+    if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("Not a binary encoded shopping list")
+    format_version = data[len(BINARY_MAGIC)]
+    if not 1 <= format_version <= BINARY_FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary format version {format_version}")
+    return format_version, len(BINARY_MAGIC) + 1
+
+
+DIGEST_MASK = (1 << 64) - 1
+
 
+def digest_of(*fields):
+    """64 bit hash of the fields, unlike hash() it is the same on every process"""
+    data = '\0'.join(map(str, fields)).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
 
-# """Things that are not actually used but may serve as inspiration for any tweaks"""
+
+def item_digest(id, counter):
+    return digest_of('i', id, counter.digest())
+
+
+def merge_clocks(clocks):
+    """Join of version vectors, without copying when at most one of them is not empty"""
+    result = None
+    for vv in clocks:
+        if vv and vv is not result:
+            result = vv if result is None else Version.merge(result, vv)
+    return {} if result is None else result
+
+
+def merge_archived(states):
+    return merge_clocks(state.archived for state in states)
+
+
+def merge_absorbed(states):
+    """Join of the absorbed totals of the states, item by item the later round wins, it has the whole history"""
+    result = None
+    for state in states:
+        absorbed = state.absorbed
+        if not absorbed or absorbed is result:
+            continue
+        if result is None:
+            result = absorbed
+            continue
+        result = dict(result)
+        for id, (round, counter) in absorbed.items():
+            current = result.get(id)
+            if current is None or current[0] < round:
+                result[id] = (round, counter)
+            elif current[0] == round and current[1] is not counter:
+                result[id] = (round, current[1].merge(counter))
+    return {} if result is None else result
+
+
+def to_serializable(x):
+    """json default for the CRDTs and the classes holding them, the slotted classes have no __dict__"""
+    return x.to_dict() if hasattr(x, 'to_dict') else x.__dict__
+
+
+class ShoppingListBuilder:
+    """Mutable counterpart of ShoppingListCRDT, meant for many edits at once:
+
+        with crdt.mutate() as m:
+            m.inc('milk', replica, 2)
+            m.inc('eggs', replica, 6)
+        crdt = m.result
+
+    Each touched item is copied once and then edited in place, so n edits cost O(n) instead of O(n^2).
+    The base CRDT is never modified.
+    """
+
+    def __init__(self, base: ShoppingListCRDT):
+        self.base = base
+        self.items = {}  # k: item id, v: [inc_map, dec_map] of the touched items
+        self.version = dict(base.version)
+        self.archived = base.archived
+        self.gc = base.gc
+        self.absorbed = base.absorbed
+        self.expired = base.expired
+        self.changed = set()  # (item id, is_dec, replica) entries changed since the builder was created
+        self.result = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.freeze()
+        return False
+
+    def __contains__(self, id):
+        return id in self.items or id in self.base.counters
+
+    def get_or_thaw(self, id):
+        assert self.result is None, "the builder was already frozen"
+        if id not in self.items:
+            counter = self.base.counters.get(id, PNCounter.zero())
+            self.items[id] = [counter.inc_counter.counter_map, counter.dec_counter.counter_map]
+        return self.items[id]
+
+    def add(self, id, replica, value, is_dec):
+        assert value >= 0
+        counter_map = self.get_or_thaw(id)[is_dec]
+        counter_map[replica] = counter_map.get(replica, 0) + value
+        self.version[replica] = max(self.version.get(replica, 0), self.archived.get(replica, 0)) + 1
+        self.changed.add((id, is_dec, replica))
+        return self
+
+    def inc(self, id, replica, value):
+        return self.add(id, replica, value, False)
+
+    def dec(self, id, replica, value):
+        return self.add(id, replica, value, True)
+
+    def delete(self, key, replica=None):
+        return self.dec(key, key if replica is None else replica, self.value(key))
+
+    def value(self, id):
+        if id not in self.items:
+            return self.base.counters[id].value() if id in self.base.counters else 0
+        inc_map, dec_map = self.items[id]
+        return max(sum(inc_map.values()) - sum(dec_map.values()), 0)
+
+    def freeze(self):
+        """Builds the immutable CRDT, the builder can't be edited afterwards"""
+        if self.result is None:
+            counters = self.base.counters.copy()
+            for id, (inc_map, dec_map) in self.items.items():
+                counters[id] = PNCounter(GCounter(inc_map), GCounter(dec_map))
+            self.result = ShoppingListCRDT(counters, self.version, self.archived, self.gc, self.absorbed, self.expired)
+        return self.result
+
+    def delta(self):
+        """Only the entries changed through the builder, in the same form as ShoppingListCRDT.inc_delta"""
+        changes = {}  # k: item id, v: [inc_map, dec_map] with the changed entries only
+        for id, is_dec, replica in self.changed:
+            changes.setdefault(id, [{}, {}])[is_dec][replica] = self.items[id][is_dec][replica]
+        replicas = {replica for _, _, replica in self.changed}
+        return self.base.delta_of({id: PNCounter(GCounter(inc_map), GCounter(dec_map)) for id, (inc_map, dec_map) in changes.items()},
+                                  {replica: self.version[replica] for replica in replicas})
+
+
+# """Helpers, Version is the version vector of ShoppingListCRDT"""
 
 def upsert(k, v, fn, my_map):
     if k not in my_map:
@@ -201,10 +1053,6 @@ def upsert_list(k, v, my_map):
     return my_map
 
 
-VTime = Dict[ReplicaId, int]
-MClock = Dict[ReplicaId, VTime]
-
-
 class Version:
     zero = {}
 
@@ -219,11 +1067,11 @@ class Version:
 
     @staticmethod
     def max(vv1, vv2):
-        return {k: vv2[k] if k in vv2 else max(vv1[k], vv2[k]) for k in vv1.keys() | vv2.keys()}
+        return {k: max(vv1.get(k, 0), vv2.get(k, 0)) for k in vv1.keys() | vv2.keys()}
 
     @staticmethod
     def min(vv1, vv2):
-        return {k: vv2[k] if k in vv2 else min(vv1[k], vv2[k]) for k in vv1.keys() | vv2.keys()}
+        return {k: min(vv1.get(k, 0), vv2.get(k, 0)) for k in vv1.keys() | vv2.keys()}
 
     @staticmethod
     def merge(a, b):
@@ -268,11 +1116,48 @@ if __name__ == '__main__':
     gcounter = gcounter.inc('a', 5)
     gcounter = gcounter.inc('a', 5)
     print(gcounter.value())
-    gcounter2 = GCounter({'a': 8}, {'a': 4})
+    gcounter2 = GCounter({'a': 8})
     gcounter3 = gcounter.merge(gcounter2)
     gcounter3 = gcounter3.merge(gcounter2)
     print(gcounter3.value())
+
+    # a retired replica that writes from a state that never saw the compaction is counted once
+    shopping_list = ShoppingListCRDT.zero().inc('milk', 'alice', 3).inc('milk', 'bob', 2)
+    compacted = shopping_list.compact({'alice': shopping_list.version['alice']})
+    offline = shopping_list.inc('milk', 'alice', 1)
+    print(compacted.merge(offline).value('milk'), offline.merge(compacted).value('milk'),
+          ShoppingListCRDT.merge_many([compacted, offline]).value('milk'))
+    assert compacted.merge(offline).value('milk') == offline.merge(compacted).value('milk') == 6
+    assert ShoppingListCRDT.merge_many([compacted, offline]).value('milk') == 6
+    # each item keeps a single entry for the retired replicas, so compaction shrinks the list
+    with ShoppingListCRDT.zero().mutate() as m:
+        for i in range(100):
+            for writer in range(50):
+                m.inc(f'item{i}', f'writer{writer}', 1)
+    compacted = m.result.compact({f'writer{writer}': m.result.version[f'writer{writer}'] for writer in range(1, 50)})
+    print(len(m.result.to_bytes()), len(compacted.to_bytes()))
+    assert len(compacted.to_bytes()) < len(m.result.to_bytes()) // 2 and compacted.value('item0') == 50
+    # alice went offline before the primary collected the milk bob deleted, her state must not bring it back
+    alice = ShoppingListCRDT.zero().inc('milk', 'alice', 2)
+    collected = alice.merge(alice.delete('milk', 'bob')).collect({'milk'})
+    offline = alice.inc('eggs', 'alice', 1)
+    for merged in (collected.merge(offline), offline.merge(collected),
+                   ShoppingListCRDT.merge_many([collected, offline])):
+        print({id: merged.value(id) for id in merged.counters})
+        assert 'milk' not in merged.counters and merged.value('eggs') == 1
+    # once every replica has seen the collection its absorbed totals expire, and stay expired after merges
+    with ShoppingListCRDT.zero().mutate() as m:
+        for i in range(1010):
+            m.inc(f'item{i}', 'alice', 2)
+        for i in range(1000):
+            m.delete(f'item{i}', 'bob')
+    collected = m.result.collect({f'item{i}' for i in range(1000)})
+    expired = collected.expire(collected.seen_round())
+    print(len(m.result.to_bytes()), len(collected.to_bytes()), len(expired.to_bytes()))
+    assert len(expired.to_bytes()) < len(m.result.to_bytes()) // 10
+    assert len(collected.merge(expired).to_bytes()) == len(expired.merge(collected).to_bytes()) == len(expired.to_bytes())
 #     write an example of 2 concorrent gcounters with 3 different replicas
 {'a': 5, 'b': 3, 'c': 2}
 {'a': 4, 'b': 3, 'c': 2}
 
+
@@ -0,0 +1,51 @@
+# Benchmarks for the shopping list CRDTs
+# usage: python crdt_benchmark.py [items] [repetitions]
+import sys
+import time
+
+from crdt import ShoppingListCRDT
+from shopping_list import ShoppingList
+
+REPLICA_COUNTS = [1, 10, 100, 1000]
+
+
+def build_shopping_list(items, replicas):
+    """A list where every item was incremented and decremented by every replica"""
+    with ShoppingListCRDT.zero().mutate() as builder:
+        for i in range(items):
+            for r in range(replicas):
+                builder.inc(f"item{i}", f"tcp://localhost:{5000 + r}", 2)
+                builder.dec(f"item{i}", f"tcp://localhost:{5000 + r}", 1)
+    return ShoppingList("benchmark", "benchmark", builder.result)
+
+
+def serialize_summing(shopping_list):
+    """serialize as it was before the totals were cached, summing every entry of both counters"""
+    def value(counter):
+        return max(sum(counter.inc_counter.entries[1::2]) - sum(counter.dec_counter.entries[1::2]), 0)
+    items = [{'item': item, 'quantity': value(counter)} for item, counter in shopping_list.items.counters.items()]
+    return {'id': shopping_list.id, 'name': shopping_list.name, 'items': items}
+
+
+def time_it(fn, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        fn()
+    return (time.perf_counter() - start) / repetitions
+
+
+def benchmark_serialize(items, repetitions):
+    print(f"ShoppingList.serialize, {items} items, mean of {repetitions} runs")
+    print(f"{'replicas':>10} {'cached (ms)':>12} {'summing (ms)':>13} {'speedup':>8}")
+    for replicas in REPLICA_COUNTS:
+        shopping_list = build_shopping_list(items, replicas)
+        cached = time_it(shopping_list.serialize, repetitions)
+        summing = time_it(lambda: serialize_summing(shopping_list), repetitions)
+        assert shopping_list.serialize() == serialize_summing(shopping_list)
+        print(f"{replicas:>10} {cached * 1000:>12.3f} {summing * 1000:>13.3f} {summing / cached:>7.1f}x")
+
+
+if __name__ == '__main__':
+    items = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    benchmark_serialize(items, repetitions)
@@ -0,0 +1,118 @@
+# Phi accrual failure detector, the suspicion of each peer is computed from the arrival times of its heartbeats
+# the node sends a HEALTH_CHECK to its peers every HEARTBEAT_INTERVAL, each HEALTH_CHECK_RESPONSE is a heartbeat
+import collections
+import math
+import threading
+import time
+
+from utils import *
+
+
+class HeartbeatHistory:
+    """The last intervals between the heartbeats of a peer, with running sums for their mean and deviation"""
+    def __init__(self, window, first_interval):
+        self.window = window
+        self.intervals = collections.deque()
+        self.total = 0.0
+        self.squares = 0.0
+        self.add(first_interval)
+
+    def add(self, interval):
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+        if len(self.intervals) > self.window:
+            dropped = self.intervals.popleft()
+            self.total -= dropped
+            self.squares -= dropped * dropped
+
+    def mean(self):
+        return self.total / len(self.intervals)
+
+    def std_deviation(self):
+        mean = self.mean()
+        return math.sqrt(max(self.squares / len(self.intervals) - mean * mean, 0.0))
+
+
+class FailureDetector:
+    """phi(node) = -log10(probability of a heartbeat arriving later than now), with the intervals taken as normally
+    distributed. A node is suspected once its phi goes over the threshold, nodes never watched are not suspected.
+    Heartbeats come from the listener and the suspicions are read by the coordinators, so it has its own lock"""
+    def __init__(self, threshold=PHI_THRESHOLD, window=HEARTBEAT_WINDOW, min_std_deviation=MIN_HEARTBEAT_STD,
+                 acceptable_pause=ACCEPTABLE_HEARTBEAT_PAUSE, first_interval=HEARTBEAT_INTERVAL):
+        self.threshold = threshold
+        self.window = window
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause
+        self.first_interval = first_interval
+        self.lock = threading.Lock()
+        self.histories = {}  # k: node, v: HeartbeatHistory
+        self.last_heartbeat = {}  # k: node, v: arrival time of its last heartbeat
+
+    def watch(self, node, now=None):
+        """Starts following a node as if it had just sent a heartbeat, so one that never answers gets suspected"""
+        with self.lock:
+            if node not in self.last_heartbeat:
+                self.last_heartbeat[node] = time.time() if now is None else now
+                self.histories[node] = HeartbeatHistory(self.window, self.first_interval)
+
+    def forget(self, node):
+        with self.lock:
+            self.last_heartbeat.pop(node, None)
+            self.histories.pop(node, None)
+
+    def watched(self):
+        with self.lock:
+            return list(self.last_heartbeat)
+
+    def heartbeat(self, node, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            last = self.last_heartbeat.get(node)
+            if last is None:
+                self.histories[node] = HeartbeatHistory(self.window, self.first_interval)
+            elif now > last:
+                self.histories[node].add(now - last)
+            self.last_heartbeat[node] = now
+
+    def phi(self, node, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            last = self.last_heartbeat.get(node)
+            if last is None:
+                return 0.0
+            history = self.histories[node]
+            mean = history.mean() + self.acceptable_pause
+            std_deviation = max(history.std_deviation(), self.min_std_deviation)
+        return self.phi_of(now - last, mean, std_deviation)
+
+    @staticmethod
+    def phi_of(elapsed, mean, std_deviation):
+        # logistic approximation of the normal cumulative distribution, as in the phi accrual paper's implementations
+        y = (elapsed - mean) / std_deviation
+        x = y * (1.5976 + 0.070566 * y * y)
+        # exp is only taken of -|x|, an early heartbeat far from the mean would overflow it
+        if elapsed > mean:
+            e = math.exp(-x)
+            if e == 0.0:
+                return math.inf  # so late that the probability underflows
+            return -math.log10(e / (1.0 + e))
+        return math.log10(1.0 + math.exp(x))
+
+    def is_available(self, node, now=None):
+        return self.phi(node, now) < self.threshold
+
+    def suspected(self, nodes, now=None):
+        """The nodes over the threshold, no messages are sent"""
+        now = time.time() if now is None else now
+        return [node for node in dict.fromkeys(nodes) if not self.is_available(node, now)]
+
+
+if __name__ == '__main__':
+    # on-time heartbeats of a very regular peer are far below the mean, phi must stay finite and low
+    detector = FailureDetector()
+    for beat in range(150):
+        detector.heartbeat('peer', now=beat * 2.0)
+    print(detector.phi('peer', now=149 * 2.0), detector.phi('peer', now=149 * 2.0 + 60))
+    assert detector.phi('peer', now=149 * 2.0) < 0.01 and detector.suspected(['peer'], now=149 * 2.0) == []
+    assert detector.suspected(['peer'], now=149 * 2.0 + 60) == ['peer']
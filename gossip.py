@@ -0,0 +1,88 @@
+# Membership of the nodes spread by gossip, the router only seeds it on registration and reports removals to a few nodes
+# every GOSSIP_INTERVAL a node sends its table to GOSSIP_FANOUT random peers, which merge it and answer with theirs,
+# so a change reaches all the nodes in O(log n) rounds. Only membership is spread, the health of the replicas comes
+# from each node's own failure detector since the coordinators need to reach them
+import random
+import threading
+import time
+
+from utils import *
+
+
+def entry_version(entry):
+    """Entries of a later incarnation of a node win, within one a removal wins and then the latest heartbeat"""
+    return entry['incarnation'], entry['removed'], entry['heartbeat']
+
+
+def build_entry(weight, incarnation=0, heartbeat=0, removed=False):
+    return {
+        "weight": weight,
+        "incarnation": incarnation,
+        "heartbeat": heartbeat,
+        "removed": removed
+    }
+
+
+class Membership:
+    """Table of the known nodes, k: node, v: entry, each node only bumps the incarnation and heartbeat of its own.
+    The entries of nodes learnt from the router have incarnation 0 until their own gossip reaches us"""
+    def __init__(self, address, weight=DEFAULT_NODE_WEIGHT):
+        self.address = address
+        self.lock = threading.Lock()
+        # a restarted node gets a later incarnation than the one that may have been removed
+        self.entries = {address: build_entry(weight, int(time.time() * 1000))}
+
+    def seed(self, weights):
+        """The nodes the router knows about, they don't override what gossip already brought"""
+        with self.lock:
+            for node, weight in weights.items():
+                self.entries.setdefault(node, build_entry(weight))
+
+    def beat(self):
+        with self.lock:
+            self.entries[self.address]['heartbeat'] += 1
+
+    def remove(self, node):
+        """Marks the known incarnation of the node as removed, returns False when it was already"""
+        with self.lock:
+            entry = self.entries.get(node)
+            if entry is None or entry['removed']:
+                return False
+            self.entries[node] = {**entry, "removed": True}
+            return True
+
+    def merge(self, entries):
+        """Keeps the latest version of each entry, returns whether the membership changed and whether this node
+        was found removed, which is overruled with a new incarnation since it is alive after all. A newer
+        heartbeat alone is kept but changes nothing, it only orders the entries"""
+        changed = False
+        rejoined = False
+        with self.lock:
+            for node, entry in entries.items():
+                ours = self.entries.get(node)
+                if ours is not None and entry_version(entry) <= entry_version(ours):
+                    continue
+                if node == self.address:
+                    print(f"{node} was removed, rejoining with a new incarnation")
+                    ours['incarnation'] = max(ours['incarnation'], entry['incarnation']) + 1
+                    ours['heartbeat'] = 0
+                    ours['removed'] = False
+                    rejoined = True
+                    continue
+                self.entries[node] = dict(entry)
+                changed = changed or ours is None or any(entry[field] != ours[field]
+                                                         for field in ('incarnation', 'removed', 'weight'))
+        return changed, rejoined
+
+    def table(self):
+        with self.lock:
+            return {node: dict(entry) for node, entry in self.entries.items()}
+
+    def members(self):
+        """Weight of each node not removed"""
+        with self.lock:
+            return {node: entry['weight'] for node, entry in self.entries.items() if not entry['removed']}
+
+    def pick_peers(self, fanout=GOSSIP_FANOUT):
+        peers = [node for node in self.members() if node != self.address]
+        return random.sample(peers, min(fanout, len(peers)))
@@ -1,139 +1,439 @@
+import abc
+import bisect
+import copy
 import hashlib
+import math
 import sys
+from functools import lru_cache
 
-from utils import REPLICA_COUNT, N
+from utils import REPLICA_COUNT, N, HASH_FUNCTION, PREVIOUS_HASH_FUNCTION, KEY_TOKEN_CACHE_SIZE, DEFAULT_NODE_WEIGHT, \
+    PLACEMENT
 
 
-class HashRing:
-    def __init__(self, nodes=[], replica_count=REPLICA_COUNT):
-        self.ring = {}
+def sha256_token(key):
+    """The original placement, 256 bit tokens that sort like the hex digests did"""
+    return int.from_bytes(hashlib.sha256(key.encode()).digest(), 'big')
+
+
+def blake2b_token(key):
+    """64 bit tokens, cheaper to hash and to compare in the bisect"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+HASH_FUNCTIONS = {
+    'sha256': sha256_token,
+    'blake2b': blake2b_token,
+}
+TOKEN_SPACE = {
+    'sha256': 1 << 256,
+    'blake2b': 1 << 64,
+}
+
+
+class Placement(abc.ABC):
+    """Where the lists are placed, shared by every placement engine.
+    get_node gives the primary of a key and a position, the preference list of the position is the primary
+    followed by its N distinct successors and walk_distinct goes on past them to find substitutes.
+    The engines also have the nodes, weights, hash_function and previous attributes"""
+
+    @abc.abstractmethod
+    def get_node(self, string_key):
+        """The primary node of the key and its position"""
+
+    @abc.abstractmethod
+    def get_preference_list(self, pos):
+        """The node at the position followed by its N distinct successors"""
+
+    @abc.abstractmethod
+    def walk_distinct(self, pos, count=None):
+        """The distinct nodes from the position on, up to count of them"""
+
+    @abc.abstractmethod
+    def add_node(self, node, weight=DEFAULT_NODE_WEIGHT):
+        """Adds the node, its share of the keys follows its weight"""
+
+    @abc.abstractmethod
+    def remove_node(self, node):
+        """Removes the node, its keys go to the nodes that follow it"""
+
+    @abc.abstractmethod
+    def copy(self):
+        """A placement with the same nodes that can be changed without changing this one"""
+
+    @abc.abstractmethod
+    def ownership(self):
+        """The share of the keys owned by each node as primary"""
+
+    def get_all_nodes(self):
+        return list(self.nodes)
+
+    def get_other_nodes(self, node):
+        return [n for n in self.nodes if n != node]
+
+    def get_replica_nodes(self, primary_node, primary_node_position, unhealthy_nodes=[]):
+        """The healthy successors of the primary, the unhealthy ones and the healthy nodes after them that
+        stand in for those, the replicas also include the substitutes"""
+        if not self.nodes:
+            return [], [], []
+        successors = self.get_preference_list(primary_node_position)[1:]
+        replicas = [node for node in successors if node not in unhealthy_nodes]
+        failed_nodes = [node for node in successors if node in unhealthy_nodes]
+
+        substitute_nodes = []
+        if len(failed_nodes) > 0:
+            print(f"Unhealthy count: {len(failed_nodes)}")
+            # gather the next healthy nodes after the preference list, walking is only needed in this case
+            for node in self.walk_distinct(primary_node_position):
+                if len(substitute_nodes) == len(failed_nodes):
+                    break
+                if node != primary_node and node not in successors and node not in unhealthy_nodes:
+                    substitute_nodes.append(node)
+            replicas += substitute_nodes
+
+        return replicas, failed_nodes, substitute_nodes
+
+    def get_ideal_replica_nodes(self, primary_node, primary_node_position):
+        """Do not consider failed nodes and add the primary node to the list"""
+        if not self.nodes:
+            return []
+        return list(self.get_preference_list(primary_node_position)[1:]) + [primary_node]
+
+    def get_owners(self, key):
+        """The nodes that should hold the key, the primary and its successors"""
+        primary_node, pos = self.get_node(key)
+        return self.get_ideal_replica_nodes(primary_node, pos)
+
+    def is_owner(self, key, node):
+        """Whether the node should hold the key, while migrating under either hash function"""
+        if node in self.get_owners(key):
+            return True
+        return self.previous is not None and node in self.previous.get_owners(key)
+
+    def moved_keys(self, before, key_index):
+        """The keys of the index whose owners changed since the before placement, with the nodes that gained each.
+        Engines without token ranges compare the owners of every key"""
+        moved = []
+        for key in key_index.keys:
+            old, new = set(before.get_owners(key)), set(self.get_owners(key))
+            if old != new:
+                moved.append((key, new - old))
+        return moved
+
+    def token_count(self, node):
+        """Tokens of the node, proportional to its weight"""
+        return max(1, round(self.replica_count * self.weights[node]))
+
+    def balance_report(self):
+        """For each node its weight, tokens, ownership and ownership relative to its share of the total weight"""
+        ownership = self.ownership()
+        total_weight = sum(self.weights.values())
+        return [{
+            "node": node,
+            "weight": self.weights[node],
+            "tokens": self.token_count(node),
+            "ownership": ownership[node],
+            "skew": ownership[node] / (self.weights[node] / total_weight),
+        } for node in sorted(self.nodes)]
+
+    def print_balance_report(self):
+        print(f"{'node':<28} {'weight':>7} {'tokens':>7} {'ownership':>10} {'skew':>6}")
+        for row in self.balance_report():
+            print(f"{row['node']:<28} {row['weight']:>7.2f} {row['tokens']:>7} {row['ownership']:>9.2%} {row['skew']:>6.2f}")
+
+
+class HashRing(Placement):
+    """Consistent hashing ring, tokens are integers given by one of HASH_FUNCTIONS.
+    While migrating from another hash function, previous is the ring placed with it, so the lists
+    placed before the change can still be found and handed off"""
+    def __init__(self, nodes=[], replica_count=REPLICA_COUNT, hash_function=HASH_FUNCTION,
+                 previous_hash_function=PREVIOUS_HASH_FUNCTION, weights=None):
+        self.ring = {}  # k: token, v: node
         self.replica_count = replica_count
-        self.sorted_keys = []
+        self.sorted_keys = []  # tokens of the ring, sorted
         self.nodes = set(nodes)
+        self.weights = {node: (weights or {}).get(node, DEFAULT_NODE_WEIGHT) for node in self.nodes}
+        self.preference_cache = []  # k: token position, v: preference list of the position or None
+        self.hash_function = hash_function
+        self.token = HASH_FUNCTIONS[hash_function]
+        # routers and nodes look up the same list ids over and over
+        self.key_token = lru_cache(maxsize=KEY_TOKEN_CACHE_SIZE)(self.token)
+        self.previous = None
+        if previous_hash_function is not None and previous_hash_function != hash_function:
+            self.previous = HashRing(nodes, replica_count, previous_hash_function, None, weights)
         self.generate_ring(self.nodes)
 
     def generate_ring(self, nodes):
         for node in nodes:
-            for i in range(self.replica_count):
+            for i in range(self.token_count(node)):
                 key = self.get_node_key(node, i)
                 self.ring[key] = node
                 self.sorted_keys.append(key)
 
         self.sorted_keys.sort()
+        self.membership_changed()
 
-        # print(self.sorted_keys)
-        # print(self.ring)
-
-    def get_all_nodes(self):
-        return list(self.nodes)
-
-    def get_other_nodes(self, node):
-        return [n for n in self.nodes if n != node]
+    def membership_changed(self):
+        # a new list, so a lookup running in another thread fills the old one
+        self.preference_cache = [None] * len(self.sorted_keys)
 
     def get_node(self, string_key):
         """Given a string key a corresponding node in the hash ring is returned.
         If the hash ring is empty, `None` is returned.
         """
         pos = self.get_node_pos(string_key)
-        print(f"pos: {pos}")
         return self.ring[self.sorted_keys[pos]], pos
 
     def get_node_key(self, node, replica_index):
-        return hashlib.sha256(f"{node}-{replica_index}".encode()).hexdigest()
+        return self.token(f"{node}-{replica_index}")
 
     def get_node_pos(self, key):
-        hash_key = self.hash_key(key)
-        for i, ring_key in enumerate(self.sorted_keys):
-            if hash_key <= ring_key:
-                return i
+        """Position of the first token at or after the hash of the key, O(log n)"""
+        return self.get_node_pos_of_token(self.hash_key(key))
 
+    def get_node_pos_of_token(self, token):
+        pos = bisect.bisect_left(self.sorted_keys, token)
         # If the hash is greater than all keys, loop back to the first node
-        print(self.sorted_keys)
-        return 0
-
-    def get_replica_nodes(self, primary_node, primary_node_position, unhealthy_nodes=[]):
-        if not self.ring:
-            return []
-        # skip the primary node
-        i = 0  # number of nodes found
-        j = 0  # number of nodes checked
-        failed_nodes = []
-        replica_indices = []
-        index = (primary_node_position + 1) % len(self.sorted_keys)
-        while j < len(self.sorted_keys) and i < N:
-            # get the node at the next index, clockwise
-            next_node = self.ring[self.sorted_keys[index]]
-            if next_node != primary_node:
-                if next_node not in unhealthy_nodes:
-                    replica_indices.append(index)
-                else:
-                    failed_nodes.append(next_node)
-                i += 1
-            index = (index + 1) % len(self.sorted_keys)
-            j += 1
+        return pos if pos < len(self.sorted_keys) else 0
 
+    def get_preference_list(self, pos):
+        """The node at the token position followed by its N distinct physical successors clockwise.
+        Cached per position, the cache is only dropped when the membership changes"""
+        cache = self.preference_cache
+        preference = cache[pos]
+        if preference is None:
+            preference = cache[pos] = tuple(self.walk_distinct(pos, N + 1))
+        return preference
 
-        substitute_nodes = []
-        if len(failed_nodes) > 0:
-            print(f"Unhealthy count: {len(failed_nodes)}")
-        #     start on the last replica index and gather the remaining nodes
-            index = replica_indices[-1] if len(replica_indices) > 0 else (primary_node_position + 1) % len(self.sorted_keys)
-            while i < N and j < len(self.sorted_keys):
-                next_node = self.ring[self.sorted_keys[index]]
-                if next_node != primary_node:
-                    if next_node not in unhealthy_nodes:
-                        replica_indices.append(index)
-                        substitute_nodes.append(next_node)
-                    i += 1
-                index = (index + 1) % len(self.sorted_keys)
-                j += 1
-
-        return [self.ring[self.sorted_keys[i]] for i in replica_indices], failed_nodes, substitute_nodes
-
-    def get_ideal_replica_nodes(self, primary_node, primary_node_position):
-        """Do not consider failed nodes and add the primary node to the list"""
-        if not self.ring:
-            return []
+    def walk_distinct(self, pos, count=None):
+        """Distinct physical nodes clockwise from the token position"""
+        seen = set()
+        for j in range(len(self.sorted_keys)):
+            node = self.ring[self.sorted_keys[(pos + j) % len(self.sorted_keys)]]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == count:
+                    return
 
-        # skip the primary node
-        i = 0
-        j = 0
-        replica_indices = []
-        index = (primary_node_position + 1) % len(self.sorted_keys)
-        while j < len(self.sorted_keys) and i < N:
-            # get the node at the next index, clockwise
-            next_node = self.ring[self.sorted_keys[index]]
-            if next_node != primary_node:
-                replica_indices.append(index)
-                i += 1
-            index = (index + 1) % len(self.sorted_keys)
-            j += 1
-
-        return [self.ring[self.sorted_keys[i]] for i in replica_indices] + [primary_node]
     def hash_key(self, key):
-        return hashlib.sha256(key.encode()).hexdigest()
+        return self.key_token(key)
 
-    def add_node(self, node):
+    def add_node(self, node, weight=DEFAULT_NODE_WEIGHT):
+        if self.previous is not None:
+            self.previous.add_node(node, weight)
         if node in self.nodes:
             return
-        for i in range(self.replica_count):
+        self.weights[node] = weight
+        for i in range(self.token_count(node)):
             key = self.get_node_key(node, i)
             self.ring[key] = node
-            self.sorted_keys.append(key)
-
-        self.sorted_keys.sort()
+            bisect.insort(self.sorted_keys, key)
         self.nodes.add(node)
+        self.membership_changed()
 
     def remove_node(self, node):
+        if self.previous is not None:
+            self.previous.remove_node(node)
         if node not in self.nodes:
             return
-        for i in range(self.replica_count):
+        for i in range(self.token_count(node)):
             key = self.get_node_key(node, i)
             del self.ring[key]
-            self.sorted_keys.remove(key)
+            del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
         self.nodes.remove(node)
+        self.weights.pop(node)
+        self.membership_changed()
+
+    def ownership(self):
+        """Fraction of the token space each node is the primary of"""
+        space = TOKEN_SPACE[self.hash_function]
+        owned = {node: 0 for node in self.nodes}
+        for i, token in enumerate(self.sorted_keys):
+            # a token owns the range from the token before it, the first one wraps around
+            owned[self.ring[token]] += (token - self.sorted_keys[i - 1]) % space
+        if len(self.sorted_keys) == 1:
+            owned[self.ring[self.sorted_keys[0]]] = space
+        return {node: share / space for node, share in owned.items()}
+
+    def copy(self):
+        """A copy to change the membership of, while the lookups in other threads keep using this one"""
+        ring = copy.copy(self)
+        ring.ring = dict(self.ring)
+        ring.sorted_keys = list(self.sorted_keys)
+        ring.nodes = set(self.nodes)
+        ring.weights = dict(self.weights)
+        ring.preference_cache = list(self.preference_cache)
+        ring.previous = self.previous.copy() if self.previous is not None else None
+        return ring
+
+    def moved_keys(self, before, key_index):
+        """Only the keys of the token ranges whose owners changed are looked at"""
+        moved = []
+        for start, end, old, new in moved_ranges(before, self):
+            gained = new - old
+            for key in key_index.keys_in_range(start, end):
+                moved.append((key, gained))
+        return moved
+
+    def owners_of_token(self, token):
+        return frozenset(self.get_preference_list(self.get_node_pos_of_token(token)))
 
     def print_ring(self):
         print("Hash Ring:")
         for key in self.sorted_keys:
-            print(f"{key}: {self.ring[key]}")
+            print(f"{key:064x}: {self.ring[key]}")
+
+
+class RendezvousHashing(Placement):
+    """Rendezvous (highest random weight) placement, every node scores every key and the highest scores own it.
+    There are no tokens to keep, a lookup hashes the key with each node instead, so the top N + 1 of recently
+    looked up keys are cached. The position of a key is the key itself.
+    Weighted with the logarithmic method, a node owns a share of the keys proportional to its weight"""
+    def __init__(self, nodes=[], replica_count=REPLICA_COUNT, hash_function=HASH_FUNCTION,
+                 previous_hash_function=PREVIOUS_HASH_FUNCTION, weights=None):
+        self.replica_count = replica_count  # unused, there are no vnodes
+        self.nodes = set(nodes)
+        self.weights = {node: (weights or {}).get(node, DEFAULT_NODE_WEIGHT) for node in self.nodes}
+        self.hash_function = hash_function
+        self.token = HASH_FUNCTIONS[hash_function]
+        self.space = TOKEN_SPACE[hash_function]
+        self.preference_cache = lru_cache(maxsize=KEY_TOKEN_CACHE_SIZE)(self.rank)
+        self.previous = None
+        if previous_hash_function is not None and previous_hash_function != hash_function:
+            self.previous = RendezvousHashing(nodes, replica_count, previous_hash_function, None, weights)
+
+    def membership_changed(self):
+        self.preference_cache.cache_clear()
+
+    def score(self, node, key):
+        # a uniform draw in (0, 1) from the hash of the pair, -weight / ln(u) is max for a node with probability
+        # proportional to its weight
+        u = (self.token(f"{node}-{key}") + 0.5) / self.space
+        return -self.weights[node] / math.log(u)
+
+    def rank(self, key, count=N + 1):
+        return tuple(sorted(self.nodes, key=lambda node: (self.score(node, key), node), reverse=True)[:count])
+
+    def get_node(self, string_key):
+        """Given a string key the node with its highest score is returned, with the key as the position"""
+        return self.get_preference_list(string_key)[0], string_key
+
+    def get_preference_list(self, pos):
+        return self.preference_cache(pos)
+
+    def walk_distinct(self, pos, count=None):
+        """Nodes by decreasing score for the key, only ranks them all when asked past the preference list"""
+        preference = self.get_preference_list(pos)
+        if count is not None and count <= len(preference):
+            yield from preference[:count]
+            return
+        yield from self.rank(pos, count)
+
+    def add_node(self, node, weight=DEFAULT_NODE_WEIGHT):
+        if self.previous is not None:
+            self.previous.add_node(node, weight)
+        if node in self.nodes:
+            return
+        self.weights[node] = weight
+        self.nodes.add(node)
+        self.membership_changed()
+
+    def remove_node(self, node):
+        if self.previous is not None:
+            self.previous.remove_node(node)
+        if node not in self.nodes:
+            return
+        self.nodes.remove(node)
+        self.weights.pop(node)
+        self.membership_changed()
+
+    def token_count(self, node):
+        return 0
+
+    def ownership(self, samples=10000):
+        """Fraction of a sample of keys each node is the primary of, there is no token space to measure"""
+        owned = {node: 0 for node in self.nodes}
+        for i in range(samples):
+            owned[self.rank(f"sample-{i}", 1)[0]] += 1
+        return {node: share / samples for node, share in owned.items()}
+
+    def copy(self):
+        """A copy to change the membership of, while the lookups in other threads keep using this one"""
+        placement = RendezvousHashing(self.nodes, self.replica_count, self.hash_function, None, self.weights)
+        placement.previous = self.previous.copy() if self.previous is not None else None
+        return placement
+
+
+PLACEMENTS = {
+    'ring': HashRing,
+    'rendezvous': RendezvousHashing,
+}
+
+
+def build_placement(nodes=[], replica_count=REPLICA_COUNT, placement=PLACEMENT, **kwargs):
+    """The placement engine named in PLACEMENTS, they are interchangeable but every router and node
+    of a cluster has to use the same one"""
+    return PLACEMENTS[placement](nodes, replica_count, **kwargs)
+
+
+def moved_ranges(before, after):
+    """The token ranges whose owners differ between two placements, as (start, end, old owners, new owners)
+    where a range holds the tokens after start up to and including end, wrapping around the ring.
+    Only walks the tokens of both rings, so it costs the same whatever the number of keys"""
+    if not before.sorted_keys or not after.sorted_keys:
+        return []
+    # between two consecutive boundaries of either ring the owners in both rings are constant
+    boundaries = sorted(set(before.sorted_keys) | set(after.sorted_keys))
+    ranges = []
+    for i, end in enumerate(boundaries):
+        old, new = before.owners_of_token(end), after.owners_of_token(end)
+        if old == new:
+            continue
+        start = boundaries[i - 1]
+        if ranges and ranges[-1][1] == start and ranges[-1][2] == old and ranges[-1][3] == new:
+            ranges[-1] = (ranges[-1][0], end, old, new)
+        else:
+            ranges.append((start, end, old, new))
+    return ranges
+
+
+class KeyIndex:
+    """The keys held by a node sorted by their ring token, so the keys of a token range are found
+    without scanning them all"""
+    def __init__(self, keys=(), hash_function=HASH_FUNCTION):
+        self.token = HASH_FUNCTIONS[hash_function]
+        entries = sorted((self.token(key), key) for key in keys)
+        self.tokens = [token for token, _ in entries]
+        self.keys = [key for _, key in entries]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, token, key):
+        pos = bisect.bisect_left(self.tokens, token)
+        while pos < len(self.tokens) and self.tokens[pos] == token:
+            if self.keys[pos] == key:
+                return pos, True
+            pos += 1
+        return pos, False
+
+    def add(self, key):
+        token = self.token(key)
+        pos, found = self.find(token, key)
+        if not found:
+            self.tokens.insert(pos, token)
+            self.keys.insert(pos, key)
+
+    def remove(self, key):
+        pos, found = self.find(self.token(key), key)
+        if found:
+            del self.tokens[pos]
+            del self.keys[pos]
+
+    def keys_in_range(self, start, end):
+        """Keys with a token after start up to and including end, wrapping around when end is not after start"""
+        lo = bisect.bisect_right(self.tokens, start)
+        hi = bisect.bisect_right(self.tokens, end)
+        if start < end:
+            return self.keys[lo:hi]
+        return self.keys[lo:] + self.keys[:hi]
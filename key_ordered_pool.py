@@ -0,0 +1,87 @@
+# Pool of threads running tasks in parallel for different keys and in order for the same key
+import asyncio
+import collections
+import queue
+import sys
+import threading
+
+
+class KeyOrderedPool:
+    """Runs the tasks submitted with a key on a pool of worker threads. Tasks of different keys run in parallel,
+    tasks of the same key run one at a time in the order they were submitted, so a slow task only holds back
+    the ones of its own key"""
+    def __init__(self, handler, workers, name='worker'):
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.pending = {}  # k: key with a task running, v: deque of the tasks of the key waiting for it
+        self.ready = queue.Queue()  # (key, task) that can run now
+        self.threads = [threading.Thread(target=self.run, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, task):
+        with self.lock:
+            waiting = self.pending.get(key)
+            if waiting is not None:
+                waiting.append(task)
+                return
+            self.pending[key] = collections.deque()
+        self.ready.put((key, task))
+
+    def idle(self):
+        with self.lock:
+            return len(self.pending) == 0
+
+    def stop(self):
+        for _ in self.threads:
+            self.ready.put((None, None))  # poison pill
+
+    def run(self):
+        while True:
+            key, task = self.ready.get()
+            if task is None:
+                break
+            try:
+                self.handler(task)
+            except Exception as e:
+                print(f"Task for key {key} failed: {e!r}", file=sys.stderr)
+            # the next task of the key, if any, can run now
+            with self.lock:
+                waiting = self.pending[key]
+                if len(waiting) > 0:
+                    self.ready.put((key, waiting.popleft()))
+                else:
+                    del self.pending[key]
+
+
+class AsyncKeyOrderedPool:
+    """The same ordering for coroutines on an asyncio loop, each key with tasks has a coroutine running them in turn
+    and the keys run concurrently, handler is a coroutine function"""
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending = {}  # k: key with a task running, v: deque of the tasks of the key waiting for it
+        self.running = set()  # the loop only keeps weak references to its tasks
+
+    def submit(self, key, task):
+        waiting = self.pending.get(key)
+        if waiting is not None:
+            waiting.append(task)
+            return
+        waiting = self.pending[key] = collections.deque([task])
+        runner = asyncio.get_running_loop().create_task(self.run(key, waiting))
+        self.running.add(runner)
+        runner.add_done_callback(self.running.discard)
+
+    def idle(self):
+        return len(self.pending) == 0
+
+    async def run(self, key, waiting):
+        while len(waiting) > 0:
+            task = waiting.popleft()
+            try:
+                await self.handler(task)
+            except Exception as e:
+                print(f"Task for key {key} failed: {e!r}", file=sys.stderr)
+        del self.pending[key]
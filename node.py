@@ -1,5 +1,5 @@
+import heapq
 import json
-import queue
 import sys
 import threading
 import os
@@ -9,58 +9,110 @@ import atexit
 import zmq
 
 from crdt import ShoppingListCRDT, upsert_list
-from hash_ring import HashRing
+from hash_ring import Placement, KeyIndex, build_placement
+from push_pool import PushPool
+from key_ordered_pool import KeyOrderedPool
+from failure_detector import FailureDetector
+from gossip import Membership
 from shopping_list import ShoppingList
 from utils import *
 
 
+def run_steps(steps):
+    """Runs a generator of steps on this thread. The steps yield each wait for other nodes as (method, args),
+    the call is made here and its result sent back, so the asyncio node runs the same steps awaiting the calls"""
+    try:
+        method, args = next(steps)
+        while True:
+            method, args = steps.send(method(*args))
+    except StopIteration as stop:
+        return stop.value
+
+
 class DynamoNode:
-    def __init__(self, name, data: dict = {}):
+    def __init__(self, name, data: dict = {}, placement=PLACEMENT):
         self.name = name
         self.data: dict = data  # a dict k: list id, v: ShoppingList[]
         self.dirty: dict = {}  # a dict k: list id, v: True if dirty, False otherwise
+        self.buffered_since: dict = {}  # a dict k: list id, v: time of its oldest unmerged write
 
         self.read_quorum_requests_state = {}
         self.write_quorum_requests_state = {}
         self.delete_quorum_requests_state = {}
 
-        self.hash_ring: HashRing = HashRing()
+        self.placement = placement
+        self.hash_ring: Placement = build_placement(placement=placement)
+        # data, dirty, buffered_since and key_index are shared by the listener, the coordinators and the main thread
+        self.lock = threading.RLock()
+        self.key_index = KeyIndex(data.keys(), self.hash_ring.hash_function)  # the keys of data by ring token
 
         for key in data.keys():
             self.dirty[key] = False
 
     def remove_list_from_node(self, list_id):
-        self.data.pop(list_id, None)
-        self.dirty.pop(list_id, None)
+        with self.lock:
+            if self.data.pop(list_id, None) is not None:
+                self.key_index.remove(list_id)
+            self.dirty.pop(list_id, None)
+            self.buffered_since.pop(list_id, None)
+
+    def write_data(self, list_id, shopping_list: ShoppingList, delta=False):
+        """False when nothing was written, a delta of a list this node doesn't hold is refused
+        since it only has the changes and would be taken for the whole list, and so is a delta made
+        after a compaction the list here hasn't seen"""
+        with self.lock:
+            if not shopping_list:
+                return False
+            if delta and (not self.data.get(list_id) or self.data[list_id][-1].items.missed(shopping_list.items)):
+                return False
+            if self.data.get(list_id):
+                latest = self.data[list_id][-1]
+                if delta:
+                    # fold the delta into the latest version, this only costs the size of the delta
+                    merged = latest.items.merge(shopping_list.items)
+                    if merged is latest.items:
+                        # nothing new, the list stays clean and isn't saved again
+                        return True
+                    self.data[list_id][-1] = ShoppingList(list_id, latest.name, merged)
+                    self.dirty[list_id] = True
+                    return True
+                if latest.items.covers(shopping_list.items):
+                    return True
+            self.dirty[list_id] = True
+            if list_id not in self.data:
+                self.key_index.add(list_id)
+            upsert_list(list_id, shopping_list, self.data)
+            self.apply_write_policy(list_id)
+            return True
 
-    def write_data(self, list_id, shopping_list: ShoppingList):
-        if not shopping_list:
-            return False
-        self.dirty[list_id] = True
-        upsert_list(list_id, shopping_list, self.data)
-        return True
+    def apply_write_policy(self, list_id):
+        """Merges the versions of the list on write, eagerly or once the buffer is full or old enough,
+        so a key never holds more than WRITE_BUFFER_SIZE versions and reads don't pay for older writes"""
+        versions = self.data[list_id]
+        if len(versions) == 1:
+            return
+        since = self.buffered_since.setdefault(list_id, time.time())
+        if WRITE_POLICY == 'eager' or len(versions) >= WRITE_BUFFER_SIZE or time.time() - since >= WRITE_BUFFER_WINDOW:
+            self.merge_shopping_lists(versions)
 
     def read_data(self, list_id):
-        if self.data.get(list_id) is None:
-            return None
-        else:
-            list_name = self.data[list_id][0].name
-            merged_crdt = ShoppingListCRDT.zero()
-            for shopping_list in self.data[list_id]:
-                merged_crdt = merged_crdt.merge(shopping_list.items)
-
-            merged_data = ShoppingList(list_id, list_name, merged_crdt)
-            self.data[list_id] = [merged_data]  # assuming no need to maintain history
+        with self.lock:
+            if self.data.get(list_id) is None:
+                return None
+            else:
+                merged_data = self.merge_shopping_lists(self.data[list_id])  # assuming no need to maintain history
 
-            return json.dumps(merged_data, default=lambda x: x.__dict__)
+        # the stored lists are replaced and never changed in place, so this doesn't need the lock
+        return merged_data.to_wire()
 
     def delete_data(self, list_id):
-        if self.data.get(list_id) is None:
-            return None
-        else:
-            self.remove_list_from_node(list_id)
-            self.delete_shopping_list_database(list_id)
-            return True
+        with self.lock:
+            if self.data.get(list_id) is None:
+                return None
+            else:
+                self.remove_list_from_node(list_id)
+                self.delete_shopping_list_database(list_id)
+                return True
 
     def create_database_and_table(self):
         transformed_name = self.name.replace(' ', '_').replace(":", "_").replace("/", "-")
@@ -100,29 +152,47 @@ class DynamoNode:
 
         conn.close()
 
-        # Convert the JSON strings back to Python dictionaries
+        # rows can hold the binary or the json encoding, depending on the STORAGE_FORMAT they were saved with
 
         for row in data:
-            items_dict = json.loads(row[2])
-            shopping_list = {
-                "id": row[0],
-                "name": row[1],
-                "items": items_dict
-            }
-            self.write_data(shopping_list["id"], ShoppingList.from_dict(shopping_list))
+            if isinstance(row[2], bytes):
+                items = ShoppingListCRDT.from_bytes(row[2])
+            else:
+                items = ShoppingListCRDT.from_dict(json.loads(row[2]))
+            self.write_data(row[0], ShoppingList(row[0], row[1], items))
+            self.dirty[row[0]] = False
 
     def merge_shopping_lists(self, shopping_lists):
-        if len(shopping_lists) == 0:
-            return None
-        list_id = shopping_lists[0].id
-        list_name = shopping_lists[0].name
-        merged_crdt = ShoppingListCRDT.zero()
-        for shopping_list in shopping_lists:
-            merged_crdt = merged_crdt.merge(shopping_list.items)
-
-        merged_data = ShoppingList(list_id, list_name, merged_crdt)
-        self.data[list_id] = [merged_data]
-        return merged_data
+        with self.lock:
+            if len(shopping_lists) == 0:
+                return None
+            list_id = shopping_lists[0].id
+            list_name = shopping_lists[0].name
+            if len(shopping_lists) == 1:
+                merged_data = shopping_lists[0]
+            else:
+                merged_data = ShoppingList(list_id, list_name,
+                                           ShoppingListCRDT.merge_many(shopping_list.items for shopping_list in shopping_lists))
+            self.data[list_id] = [merged_data]
+            self.buffered_since.pop(list_id, None)
+            return merged_data
+
+    def merge_all_data(self):
+        """Collapses the buffered versions of every list. Buffered versions share most of their counters, which
+        merge_many skips, so it is faster here than packing every entry for bulk_merge"""
+        with self.lock:
+            list_ids = [list_id for list_id, shopping_lists in self.data.items() if len(shopping_lists) > 1]
+            merged = [ShoppingListCRDT.merge_many(shopping_list.items for shopping_list in self.data[list_id])
+                      for list_id in list_ids]
+            for list_id, items in zip(list_ids, merged):
+                self.data[list_id] = [ShoppingList(list_id, self.data[list_id][0].name, items)]
+                self.buffered_since.pop(list_id, None)
+
+    @staticmethod
+    def encode_items(items):
+        if STORAGE_FORMAT == 'binary':
+            return items.to_bytes()
+        return items.to_json_string()
 
     def save_all_database_data(self):
         print("saving all database data")
@@ -131,16 +201,16 @@ class DynamoNode:
         conn = sqlite3.connect(os.path.join(db_folder, "node.db"))
         cursor = conn.cursor()
 
-        # Delete all rows from the shopping_list table
-        cursor.execute("DELETE FROM shopping_list")
-
-        for shopping_lists in self.data.values():
-            shopping_list = self.merge_shopping_lists(shopping_lists)
-            shopping_list_dict = shopping_list.to_dict()
-            items_json = shopping_list_dict["items"].to_json_string()
-
-            cursor.execute("INSERT INTO shopping_list (id, name, items) VALUES (?, ?, ?)",
-                           (shopping_list_dict["id"], shopping_list_dict["name"], items_json))
+        # deleted lists are removed from the table by delete_data, so only the changed lists are written
+        with self.lock:
+            self.merge_all_data()
+            for list_id, shopping_lists in self.data.items():
+                if not self.dirty.get(list_id, True):
+                    continue
+                shopping_list = shopping_lists[0]
+                cursor.execute("INSERT or REPLACE INTO shopping_list (id, name, items) VALUES (?, ?, ?)",
+                               (shopping_list.id, shopping_list.name, self.encode_items(shopping_list.items)))
+                self.dirty[list_id] = False
 
         conn.commit()
         conn.close()
@@ -152,11 +222,9 @@ class DynamoNode:
         cursor = conn.cursor()
 
         shopping_list = self.data[list_id][0]
-        shopping_list_dict = shopping_list.to_dict()
-        items_json = shopping_list_dict["items"].to_json_string()
 
         cursor.execute("INSERT or REPLACE INTO shopping_list (id, name, items) VALUES (?, ?, ?)",
-                       (shopping_list_dict["id"], shopping_list_dict["name"], items_json))
+                       (shopping_list.id, shopping_list.name, self.encode_items(shopping_list.items)))
 
         self.dirty[list_id] = False
 
@@ -177,59 +245,90 @@ class DynamoNode:
 
 class Node:
 
-    def __init__(self, node_address):
+    def __init__(self, node_address, weight=DEFAULT_NODE_WEIGHT, placement=PLACEMENT):
         router_addresses = [ROUTER_ADDRESS, ROUTER_BACKUP_ADDRESS]
         # Create a new context and socket for the node
         self.context = zmq.Context()
         self.poller = zmq.Poller()
         self.node_sockets = [""] * len(router_addresses)
         self.address = node_address
+        self.weight = weight
 
         for i in range(len(router_addresses)):
             self.node_sockets[i] = self.context.socket(zmq.DEALER)
             self.node_sockets[i].setsockopt(zmq.IDENTITY, node_address.encode('utf-8'))
             self.node_sockets[i].connect(router_addresses[i])
             # send a first message to the router to register the node
-            self.node_sockets[i].send_json(build_register_request(node_address))
+            self.node_sockets[i].send_json(build_register_request(node_address, weight))
 
             self.poller.register(self.node_sockets[i], zmq.POLLIN)
 
         self.reply_socket = self.context.socket(zmq.PULL)
         self.reply_socket.setsockopt(zmq.IDENTITY, node_address.encode('utf-8'))
         self.reply_socket.bind(f"tcp://*:{port}")
+        # the sockets to the other nodes, kept open between messages
+        self.push_pool = PushPool(self.context)
+        # the router sockets belong to the main thread, the coordinators send their responses through it
+        self.router_replies = self.context.socket(zmq.PULL)
+        self.router_replies.bind(ROUTER_REPLIES_ADDRESS)
+        self.poller.register(self.router_replies, zmq.POLLIN)
+        self.local = threading.local()  # the socket of each coordinator thread to router_replies
 
         self.write_quorum_requests_state = {}
         self.read_quorum_requests_state = {}
         self.delete_quorum_requests_state = {}
-        self.coordinated_quorums_queue = queue.Queue()
+        # the coordinated quorums of different keys run in parallel, the ones of a key in order
+        self.coordinator_pool = KeyOrderedPool(self.coordinate_quorum, COORDINATOR_WORKERS, 'coordinator')
 
         # Create a DynamoNode instance for this node
-        self.dynamo_node = DynamoNode(node_address)
+        self.dynamo_node = DynamoNode(node_address, placement=placement)
 
         self.nodes_health = {}
+        self.health_changed = threading.Condition()  # notified by the listener on each health check response
+        self.health_waiters = {}  # k: node, v: the answered sets of the health checks waiting for it
+        self.failure_detector = FailureDetector()  # suspicion of each peer, from the heartbeats of send_heartbeats
+        self.membership = Membership(node_address, weight)  # the nodes of the ring, spread by gossip
+        self.ring_lock = threading.Lock()  # membership changes come from the router and from gossip
+        self.hints_lock = threading.Lock()  # for write_hints, delete_hints and handoffs
         self.write_hints = {}
         self.delete_hints = {}
+        # k: node, v: {key: (handoff type, time sent or None while waiting for the window)}, until acknowledged
+        self.handoffs = {}
+        # k: list id, v: {replica: (clock, time the clock was first seen)}, for the lists this node is primary of
+        self.replica_activity = {}
+        # k: list id, v: {collection round: time every storage replica was first seen with it}, same lists
+        self.collection_activity = {}
+        self.migrated = set()  # lists handed off to their placement under the new hash function
 
 
     def start(self):
         self.dynamo_node.get_database_data()
+        self.push_pool.start()
 
-        # Deal with requests added tp the queue
-        coordinated_quorums_thread = threading.Thread(target=self.coordinate_quorums,
-                                                      args=(self.coordinated_quorums_queue,))
-        coordinated_quorums_thread.start()
+        # Deal with requests added to the pool
+        self.coordinator_pool.start()
 
         # Deal with messages from other nodes
         reply_thread = threading.Thread(target=self.listen_for_nodes)
         reply_thread.start()
 
+        heartbeat_thread = threading.Thread(target=self.send_heartbeats)
+        heartbeat_thread.start()
+
+        gossip_thread = threading.Thread(target=self.send_gossip)
+        gossip_thread.start()
+
         #every 15 seconds so as to handoff stored hints
         t = time.time()
+        compaction_t = time.time()
+        gc_t = time.time()
+        last_request_t = time.time()
 
         # Start listening for messages from the ROUTER
         while True:
             try:
-                socks = dict(self.poller.poll())
+                # wakes up when idle as well, so the sweeper can run
+                socks = dict(self.poller.poll(GC_IDLE_TIME * 1000))
             except zmq.error.ZMQError:
                 print("Error")
                 break
@@ -237,47 +336,37 @@ class Node:
             for socket in self.node_sockets:
                 if (socks.get(socket) == zmq.POLLIN):
                     self.handle_server_request(socket)
+                    last_request_t = time.time()
+
+            if socks.get(self.router_replies) == zmq.POLLIN:
+                router_index, response = self.router_replies.recv_multipart()
+                self.node_sockets[int(router_index)].send(response)
+
+            if (time.time() - last_request_t > GC_IDLE_TIME and time.time() - gc_t > GC_INTERVAL
+                    and self.coordinator_pool.idle()):
+                self.coordinator_pool.submit(MAINTENANCE_KEY, {"type": MessageType.GC})
+                gc_t = time.time()
 
             if time.time() - t > HINT_CHECK_INTERVAL:
-                # set of keys in both dicts
-                print(f"\n HINTS: {self.write_hints} \n {self.delete_hints} \n")
-                failed_nodes = set(self.write_hints.keys()) | set(self.delete_hints.keys())
                 # check health of failed nodes
-                healthy, _ = self.check_nodes_health(failed_nodes)
-                print(f"Healthy nodes: {healthy}"
-                      f"Write hints: {self.write_hints}")
-                #check for hints
-                nodes_hint_to_delete = []
-                for node in self.write_hints.keys():
-                    if node in healthy:
-                        print(f"Sending hand offs to {node}")
-                        for key in self.write_hints[node]:
-                            print(f"Sending hand offs for key {key}")
-                            self.send_push_message(self.address, node,
-                                                   json.dumps(build_put_handed_off_request(key,
-                                                  self.read_data(key)), default=lambda x: x.__dict__))
-                            self.delete_list_if_not_owned(key)
-                        nodes_hint_to_delete.append(node)
-
-                [self.write_hints.pop(node, None) for node in nodes_hint_to_delete]
-
-
-                nodes_hint_to_delete = []
-                for node in self.delete_hints.keys():
-                    if node in healthy:
-                        for key in self.delete_hints[node]:
-                            self.send_push_message(self.address, node,
-                                                   json.dumps(build_delete_handed_off_request(key)))
-                        nodes_hint_to_delete.append(node)
-                [self.delete_hints.pop(node, None) for node in nodes_hint_to_delete]
+                healthy, _ = self.check_nodes_health(self.hinted_nodes())
+                self.deliver_hints(healthy)
 
+                if self.dynamo_node.hash_ring.previous is not None:
+                    run_steps(self.migrate_lists())
 
                 t = time.time()
 
+            if time.time() - compaction_t > COMPACTION_INTERVAL:
+                # runs in the coordinator pool, after the previous compaction or sweep
+                self.coordinator_pool.submit(MAINTENANCE_KEY, {"type": MessageType.COMPACT})
+                compaction_t = time.time()
+
 
     def handle_server_request(self, socket):
+        self.handle_router_message(socket, socket.recv_json())
 
-        request = socket.recv_json()
+    def handle_router_message(self, socket, request):
         request["origin"] = socket
         print(request)
 
@@ -285,55 +374,27 @@ class Node:
         match get_request_type(request):
 
             case MessageType.COORDINATE_PUT:
-                self.coordinated_quorums_queue.put(request)
+                self.coordinator_pool.submit(request['key'], request)
                 
             case MessageType.COORDINATE_GET:
-                self.coordinated_quorums_queue.put(request)
+                self.coordinator_pool.submit(request['key'], request)
 
             case MessageType.COORDINATE_DELETE:
-                self.coordinated_quorums_queue.put(request)
+                self.coordinator_pool.submit(request['key'], request)
 
             case MessageType.REGISTER_RESPONSE:
-                self.dynamo_node.hash_ring = HashRing([self.address] + request['nodes'])
+                # the nodes the router knows are a seed, gossip brings the rest
+                self.membership.seed(request.get('weights') or dict.fromkeys(request['nodes'], DEFAULT_NODE_WEIGHT))
+                self.update_membership()
 
             case MessageType.ADD_NODE:
-                new_node = request['node']
-                if new_node not in self.dynamo_node.hash_ring.get_all_nodes():
-
-                    self.dynamo_node.hash_ring.add_node(new_node)
-
-                    # check if any lists are stored in this node that should be handed off
-                    for key in self.dynamo_node.data.keys():
-                        if self.check_if_owned(key, new_node):
-                            self.send_push_message(self.address, new_node,
-                                                   json.dumps(build_put_handed_off_request(key,
-                                                   self.read_data(key)), default=lambda x: x.__dict__))
-
-                        self.delete_list_if_not_owned(key)
-
-                    # healthy, _ = self.check_nodes_health(self.dynamo_node.hash_ring.get_other_nodes(self.address))
-                    # if self.write_hints.get(new_node, None) in healthy:
-                    #     for key in self.write_hints[new_node]:
-                    #         self.send_push_message(self.address, new_node,
-                    #                                json.dumps(build_put_handed_off_request(key,
-                    #                                self.read_data(key)), default=lambda x: x.__dict__))
-                    #         self.delete_list_if_not_owned(key)
-                    #
-                    # if self.delete_hints.get(new_node, None) in healthy:
-                    #     for key in self.delete_hints[new_node]:
-                    #         self.send_push_message(self.address, new_node,
-                    #                                json.dumps(build_delete_handed_off_request(key)))
-
-
+                self.membership.seed({request['node']: request.get('weight', DEFAULT_NODE_WEIGHT)})
+                self.update_membership()
 
             case MessageType.REMOVE_NODE:
-                self.dynamo_node.hash_ring.remove_node(request['node'])
-            #     remove from hints if present
-                self.write_hints.pop(request['node'], None)
-                self.delete_hints.pop(request['node'], None)
-
-            #     delete any nodes from this dynamo node that are not owned
-        # TODO when a node is deleted each node can be entitle to more lists, is this feasible?
+                # the router only tells a few nodes, they gossip it to the rest
+                if self.membership.remove(request['node']):
+                    self.update_membership()
 
             case MessageType.HEARTBEAT:
                 response = {
@@ -342,6 +403,170 @@ class Node:
                 }
                 socket.send_json(response)
 
+    def update_membership(self):
+        """Queues the membership to the coordinator pool, so the handoffs and deletes it starts don't hold up
+        the listener or the router messages. Before the node has a ring, it is built right away"""
+        if len(self.dynamo_node.hash_ring.get_all_nodes()) == 0:
+            self.apply_membership()
+        else:
+            self.coordinator_pool.submit(MEMBERSHIP_KEY, {"type": MessageType.MEMBERSHIP})
+
+    def apply_membership(self):
+        """Brings the ring to the nodes of the membership, the lists whose owners changed are handed off"""
+        with self.ring_lock:
+            members = self.membership.members()
+            before = self.dynamo_node.hash_ring
+            current = before.get_all_nodes()
+            if len(current) == 0:
+                # not registered yet, nothing is placed to hand off
+                self.dynamo_node.hash_ring = build_placement(list(members), placement=self.dynamo_node.placement,
+                                                             weights=members)
+                for node in members:
+                    if node != self.address:
+                        self.push_pool.connect(node)
+                return
+
+            added = [node for node in members if node not in current]
+            removed = [node for node in current if node not in members]
+            if len(added) == 0 and len(removed) == 0:
+                return
+            print(f"Membership changed, added {added}, removed {removed}")
+            # the coordinators keep using the ring they started with, so a new one is swapped in
+            ring = before.copy()
+            for node in added:
+                ring.add_node(node, members[node])
+            for node in removed:
+                ring.remove_node(node)
+            self.dynamo_node.hash_ring = ring
+            for node in added:
+                self.push_pool.connect(node)
+            abandoned = set()
+            with self.hints_lock:
+                for node in removed:
+                    self.write_hints.pop(node, None)
+                    self.delete_hints.pop(node, None)
+                    abandoned.update(self.handoffs.pop(node, {}))
+            # the new owners of the ranges that moved get the lists from this node
+            self.hand_off_moved_lists(before)
+            for key in abandoned:
+                self.release_handed_off(key)
+            for node in removed:
+                self.push_pool.drop(node)
+
+    def send_gossip(self):
+        while True:
+            time.sleep(GOSSIP_INTERVAL)
+            self.gossip()
+
+    def gossip(self):
+        """A round of gossip, the membership table goes to a few random peers that answer with theirs"""
+        self.membership.beat()
+        members = self.membership.table()
+        for node in self.membership.pick_peers():
+            self.send_push_message(self.address, node, json.dumps(build_gossip_request(members)))
+
+    def handle_gossip(self, sender_identity, json_request):
+        changed, rejoined = self.membership.merge(json_request['members'])
+        if changed:
+            self.update_membership()
+        if rejoined:
+            # the router removed this node as well
+            for router_index in range(len(self.node_sockets)):
+                self.send_to_router(router_index, build_register_request(self.address, self.weight))
+        if json_request['reply']:
+            self.send_push_message(self.address, sender_identity,
+                                   json.dumps(build_gossip_request(self.membership.table(), reply=False)))
+
+    def hinted_nodes(self):
+        """The nodes with hints waiting for them"""
+        # set of keys in both dicts
+        with self.hints_lock:
+            print(f"\n HINTS: {self.write_hints} \n {self.delete_hints} \n")
+            return (set(self.write_hints.keys()) | set(self.delete_hints.keys())
+                    | {node for node, handoffs in self.handoffs.items() if len(handoffs) > 0})
+
+    def deliver_hints(self, healthy):
+        # the coordinators add hints meanwhile, take the ones of the healthy nodes
+        with self.hints_lock:
+            write_hints = {node: self.write_hints.pop(node) for node in healthy if node in self.write_hints}
+            delete_hints = {node: self.delete_hints.pop(node) for node in healthy if node in self.delete_hints}
+        print(f"Healthy nodes: {healthy}"
+              f"Write hints: {write_hints}")
+        #check for hints
+        for node, keys in write_hints.items():
+            print(f"Sending hand offs to {node}")
+            for key in keys:
+                print(f"Sending hand offs for key {key}")
+                self.hand_off(node, key, MessageType.PUT_HANDED_OFF)
+
+        for node, keys in delete_hints.items():
+            for key in keys:
+                self.hand_off(node, key, MessageType.DELETE_HANDED_OFF)
+
+        # the handoffs whose acks didn't come, the messages may have been dropped while the node was down
+        for node in healthy:
+            self.send_handoffs(node, HANDOFF_TIMEOUT)
+
+    def hand_off(self, node, key, handoff_type):
+        """Queues the handoff of the list to the node, a handed off list is only deleted once the node acknowledges
+        it. At most HANDOFF_WINDOW handoffs to a node are unacknowledged, the others wait for their acks"""
+        with self.hints_lock:
+            self.handoffs.setdefault(node, {})[key] = (handoff_type, None)
+        self.send_handoffs(node)
+
+    def send_handoffs(self, node, timeout=None):
+        """Sends the waiting handoffs to the node that fit in the window, and with a timeout the ones sent
+        longer ago than it"""
+        now = time.time()
+        while True:
+            due = []
+            with self.hints_lock:
+                handoffs = self.handoffs.get(node, {})
+                in_flight = sum(1 for _, sent in handoffs.values() if sent is not None)
+                for key, (handoff_type, sent) in handoffs.items():
+                    if sent is None and in_flight < HANDOFF_WINDOW:
+                        in_flight += 1
+                    elif sent is None or timeout is None or now - sent < timeout:
+                        continue
+                    handoffs[key] = (handoff_type, now)
+                    due.append((key, handoff_type))
+            deleted = []
+            for key, handoff_type in due:
+                if handoff_type == MessageType.PUT_HANDED_OFF:
+                    value = self.dynamo_node.read_data(key)
+                    if value is None:
+                        # deleted since, there is nothing to hand off
+                        deleted.append(key)
+                        continue
+                    request = build_put_handed_off_request(key, value)
+                else:
+                    request = build_delete_handed_off_request(key)
+                self.send_push_message(self.address, node, json.dumps(request))
+            if len(deleted) == 0:
+                return
+            # they won't be acknowledged, their places in the window go to the next handoffs
+            with self.hints_lock:
+                handoffs = self.handoffs.get(node, {})
+                for key in deleted:
+                    handoffs.pop(key, None)
+            timeout = None
+
+    def handed_off(self, node, key):
+        """The node acknowledged the handoff of the list"""
+        with self.hints_lock:
+            handoff = self.handoffs.get(node, {}).pop(key, None)
+        if handoff is not None:
+            if handoff[0] == MessageType.PUT_HANDED_OFF:
+                self.release_handed_off(key)
+            self.send_handoffs(node)
+
+    def release_handed_off(self, key):
+        """Deletes the list once no handoff of it is waiting for an ack, if this node doesn't own it"""
+        with self.hints_lock:
+            if any(key in handoffs for handoffs in self.handoffs.values()):
+                return
+        self.delete_list_if_not_owned(key)
+
     def send_push_message(self, sender_address, receiver_address, message):
         """sender_address comes already encoded"""
         print(f"Sending push message from {sender_address} to {receiver_address}: {message}")
@@ -350,247 +575,478 @@ class Node:
             sender_address = sender_address.encode('utf-8')
         if isinstance(receiver_address, bytes):
             receiver_address = receiver_address.decode('utf-8')
-        push_socket = self.context.socket(zmq.PUSH)
-        push_socket.connect(receiver_address)
-        push_socket.send_multipart([sender_address, message.encode('utf-8')])
-        push_socket.close()
+        self.push_pool.send(receiver_address, [sender_address, message.encode('utf-8')])
 
-    def send_request_to_other_nodes(self, request_type, request, nodes, timeout, max_retries, quorum_size):
+    def quorum_states(self, request_type):
+        if request_type == MessageType.GET:
+            return self.read_quorum_requests_state
+        elif request_type == MessageType.PUT:
+            return self.write_quorum_requests_state
+        elif request_type == MessageType.DELETE:
+            return self.delete_quorum_requests_state
 
+    def send_request_to_other_nodes(self, request_type, request, nodes, timeout, max_retries, quorum_size,
+                                    by_node=False):
+        """The responses, or with by_node the response of each node that replied"""
         quorum_id = request['quorum_id']
         quorum_size = min(quorum_size, len(set(nodes)))
         print(f"Sending request to other nodes with quorum size {quorum_size}")
-        if request_type == MessageType.GET:
-            self.read_quorum_requests_state[quorum_id] = build_quorum_request_state(nodes, timeout, max_retries,
-                                                                                    quorum_size)
-            current_quorum_state = self.read_quorum_requests_state[quorum_id]
-        if request_type == MessageType.PUT:
-            self.write_quorum_requests_state[quorum_id] = build_quorum_request_state(nodes, timeout, max_retries,
-                                                                                     quorum_size)
-            current_quorum_state = self.write_quorum_requests_state[quorum_id]
-        elif request_type == MessageType.DELETE:
-            self.delete_quorum_requests_state[quorum_id] = build_quorum_request_state(nodes, timeout, max_retries,
-                                                                                      quorum_size)
-            current_quorum_state = self.delete_quorum_requests_state[quorum_id]
-
-        start_time = time.time()
-        while time.time() - start_time < timeout and len(current_quorum_state['responses']) < quorum_size:
-            for node in nodes:
-                if not any([current_quorum_state['retry_info'][node] <= max_retries for node in nodes]):
-                    continue
-                if node in current_quorum_state['nodes_with_reply']:
-                    continue
-                if current_quorum_state['retry_info'][node] > max_retries:
-                    continue
-                if time.time() - current_quorum_state['last_retry_time'][node] < MIN_TIME_BETWEEN_RETRIES:
-                    continue
-                current_quorum_state['retry_info'][node] += 1
-                current_quorum_state['last_retry_time'][node] = time.time()
-
-                self.send_push_message(self.address, node,
-                                       json.dumps(request))
-
-        result = current_quorum_state['responses'].copy()
-        if request_type == MessageType.GET:
-            del self.read_quorum_requests_state[quorum_id]
-        elif request_type == MessageType.PUT:
-            del self.write_quorum_requests_state[quorum_id]
-        elif request_type == MessageType.DELETE:
-            del self.delete_quorum_requests_state[quorum_id]
+        quorum_states = self.quorum_states(request_type)
+        quorum_states[quorum_id] = build_quorum_request_state(nodes, timeout, max_retries, quorum_size)
+        current_quorum_state = quorum_states[quorum_id]
+
+        # sleeps until a response arrives or the next send is due, the sends are a timer queue of (due time, node)
+        deadline = time.time() + timeout
+        retries = [(0, node) for node in set(nodes)]
+        arrived = current_quorum_state['arrived']
+        with arrived:
+            while len(current_quorum_state['responses']) < quorum_size:
+                now = time.time()
+                if now >= deadline:
+                    break
+                next_send = self.send_due_requests(request, current_quorum_state, retries, max_retries, now)
+                arrived.wait(min(deadline, next_send) - time.time())
+
+            result = current_quorum_state['responses'].copy()
+            if by_node:
+                result = dict(current_quorum_state['nodes_with_reply'])
+        del quorum_states[quorum_id]
         return result
 
+    def send_due_requests(self, request, current_quorum_state, retries, max_retries, now):
+        """Sends the request to the nodes of the timer queue that are due, returns when the next send is"""
+        while retries and retries[0][0] <= now:
+            _, node = heapq.heappop(retries)
+            if node in current_quorum_state['nodes_with_reply']:
+                continue
+            if current_quorum_state['retry_info'][node] > max_retries:
+                continue
+            current_quorum_state['retry_info'][node] += 1
+            current_quorum_state['last_retry_time'][node] = now
+
+            self.send_push_message(self.address, node,
+                                   json.dumps(request))
+            heapq.heappush(retries, (now + MIN_TIME_BETWEEN_RETRIES, node))
+        return retries[0][0] if retries else float('inf')
+
     def send_put_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size):
         return self.send_request_to_other_nodes(MessageType.PUT, request, nodes, timeout, max_retries, quorum_size)
 
-    def send_get_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size):
-        return self.send_request_to_other_nodes(MessageType.GET, request, nodes, timeout, max_retries, quorum_size)
+    def send_get_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size, by_node=False):
+        return self.send_request_to_other_nodes(MessageType.GET, request, nodes, timeout, max_retries, quorum_size,
+                                                by_node)
 
     def send_delete_request_to_other_nodes(self, request, nodes, timeout, max_retries, quorum_size):
         return self.send_request_to_other_nodes(MessageType.DELETE, request, nodes, timeout, max_retries, quorum_size)
 
+    def send_heartbeats(self):
+        while True:
+            self.heartbeat_peers()
+            time.sleep(HEARTBEAT_INTERVAL)
+
+    def heartbeat_peers(self):
+        """Sends a health check to every peer, their responses feed the failure detector"""
+        peers = self.dynamo_node.hash_ring.get_other_nodes(self.address)
+        for node in set(self.failure_detector.watched()) - set(peers):
+            self.failure_detector.forget(node)
+        for node in peers:
+            self.failure_detector.watch(node)
+            self.send_push_message(self.address, node, json.dumps({"type": MessageType.HEALTH_CHECK}))
+
+    def suspected_replicas(self, ring, primary_node_index):
+        """The suspected nodes of the preference list of a key, read from the failure detector without messages,
+        the other nodes are only looked at when substitutes have to be picked"""
+        unhealthy = self.failure_detector.suspected(ring.get_preference_list(primary_node_index))
+        if len(unhealthy) > 0:
+            unhealthy = self.failure_detector.suspected(ring.get_other_nodes(self.address))
+        return unhealthy
+
     def check_nodes_health(self, nodes):
+        """Sends a health check to the nodes and waits for their answers. Each call has its own set of the nodes
+        that answered, so the main loop and the coordinators can check the same nodes at once"""
         nodes_set = set(nodes)
+        answered = set()
+        with self.health_changed:
+            for node in nodes_set:
+                self.health_waiters.setdefault(node, []).append(answered)
         for node in nodes_set:
             self.send_push_message(self.address, node, json.dumps({"type": MessageType.HEALTH_CHECK}))
 
-        start_time = time.time()
-        all_ok = False
-        while time.time() - start_time < HEALTH_CHECK_TIMEOUT:
-            if all([self.nodes_health.get(node, False) for node in nodes_set]):
-                all_ok = True
-                break
+        with self.health_changed:
+            all_ok = self.health_changed.wait_for(lambda: len(answered) == len(nodes_set), HEALTH_CHECK_TIMEOUT)
+            healthy = [node for node in nodes_set if node in answered]
+            unhealthy = [node for node in nodes_set if node not in answered]
+            for node in unhealthy:
+                waiting = [waiter for waiter in self.health_waiters.get(node, []) if waiter is not answered]
+                if len(waiting) > 0:
+                    self.health_waiters[node] = waiting
+                else:
+                    self.health_waiters.pop(node, None)
+                self.nodes_health[node] = False
 
         if not all_ok:
             print("Some nodes are not healthy.", file=sys.stderr)
-            print("Unhealthy nodes: ")
-            [print(node) for node in nodes_set if not self.nodes_health.get(node, False)]
+            print(f"Unhealthy nodes: {unhealthy}")
+        return healthy, unhealthy
 
-        healthy = []
-        unhealthy = []
-        [healthy.append(node) if self.nodes_health.get(node, False) else unhealthy.append(node) for node in nodes_set]
-        for node in nodes_set: self.nodes_health[node] = False
 
-        return healthy, unhealthy
+    def coordinate_quorum(self, task):
+        """Runs on the coordinator pool, the tasks of a key one at a time"""
+        run_steps(self.coordination(task))
 
+    def coordination(self, task):
+        """The steps of a coordinator task, each wait for other nodes is yielded as (method, args), see run_steps"""
+        # membership changes swap in a new ring, the task sticks to the one it started with
+        ring = self.dynamo_node.hash_ring
+        match task["type"]:
+            case MessageType.COORDINATE_PUT:
+                quorum_id = task["quorum_id"]
+                key = task["key"]
+                value = task["value"]
+                delta = task.get("delta", False)
+                primary_node, primary_node_index = ring.get_node(key)
+
+                if primary_node != self.address:
+                    print("I am not the primary node for this key", file=sys.stderr)
+                    # assuming hash ring is updated
+                    with self.hints_lock:
+                        upsert_list(primary_node, key, self.write_hints)
 
-    def coordinate_quorums(self, tasks_queue):
-        print("coordinating quorums")
-        while True:
-            task = tasks_queue.get()
-            if task is None:  # poison pill
-                break
 
-            match task["type"]:
-                case MessageType.COORDINATE_PUT:
-                    quorum_id = task["quorum_id"]
-                    key = task["key"]
-                    value = task["value"]
-                    primary_node, primary_node_index = self.dynamo_node.hash_ring.get_node(key)
+                unhealthy = self.suspected_replicas(ring, primary_node_index)
+                replicas, failed, substitutes = ring.get_replica_nodes(primary_node, primary_node_index, unhealthy)
+                print(f"Replicas: {replicas}, failed: {failed}, substitutes: {substitutes}")
+                self.send_hints(key, failed, substitutes, build_write_hint_request)
 
-                    if primary_node != self.address:
-                        print("I am not the primary node for this key", file=sys.stderr)
-                        # assuming hash ring is updated
-                        upsert_list(primary_node, key, self.write_hints)
 
 
-                    healthy, unhealthy = self.check_nodes_health(self.dynamo_node.hash_ring.get_other_nodes(self.address))
-                    replicas, failed, substitutes = self.dynamo_node.hash_ring.get_replica_nodes(primary_node, primary_node_index, unhealthy)
-                    print(f"Replicas: {replicas}, failed: {failed}, substitutes: {substitutes}")
-                    substitutes = [substitute for substitute in substitutes if substitute != self.address]
-                    if len(failed) > 0:
-                        print(f"Failed count: {len(failed)}")
-                        # send message to substitutes for the failed nodes
-                        for idx, substitute in enumerate(substitutes[:len(failed)]):
-                            self.send_push_message(self.address, substitute,
-                                                   json.dumps(build_write_hint_request(key, failed[idx])))
-
-
-
-                    server_socket = task["origin"]
-                    request_to_replicas = build_put_request(key, value, quorum_id)
-
-                    result = ([self.dynamo_node.write_data(key, ShoppingList.from_dict(json.loads(value)))] +
-                              self.send_put_request_to_other_nodes(request_to_replicas, replicas, 5, 1,
-                                                                   W_QUORUM))
-
-                    print(result)
-                    quorum_size = min(W_QUORUM, len(set(replicas)) + 1)
-                    if len(result) < quorum_size:
-                        result = False
-                    else:
-                        result = True
-                    print("Result after quorum consensus: ", result)
-
-                    response_to_router = build_quorum_put_response(quorum_id, result)
-                    server_socket.send_json(response_to_router)
-
-                case MessageType.COORDINATE_GET:
-                    quorum_id = task["quorum_id"]
-                    key = task["key"]
-
-                    primary_node, primary_node_index = self.dynamo_node.hash_ring.get_node(key)
-
-                    if primary_node != self.address:
-                        print("I am not the primary node for this key", file=sys.stderr)
-                        # assuming hash ring is updated, the node is just down for the moment, no action
-
-                    healthy, unhealthy = self.check_nodes_health(
-                        self.dynamo_node.hash_ring.get_other_nodes(self.address))
-                    replicas, failed, substitutes = self.dynamo_node.hash_ring.get_replica_nodes(primary_node,
-                                                                                                 primary_node_index,
-                                                                                                 unhealthy)
-
-                    replicas = [replica for replica in replicas if replica != self.address]
-                    server_socket = task["origin"]
-                    request_to_replicas = build_get_request(key, quorum_id)
-
-                    tmp_result = ([self.read_data(key)] +
-                              self.send_get_request_to_other_nodes(request_to_replicas, replicas, 5, 1,
-                                                                   R_QUORUM))
-
-                    print(tmp_result)
-                    # exclude Nones from the list
-                    result = [item for item in tmp_result if item is not None]
-                    quorum_size = min(R_QUORUM, len(set(replicas)) + 1)  # there is no guarantee that the failed nodes will be able to reply
-                    if len(result) < quorum_size:
-                        result = False
-                    else:
-                        shopping_lists = [ShoppingList.from_dict(json.loads(shopping_list)) for shopping_list in result]
-                        merged_shopping_list = self.dynamo_node.merge_shopping_lists(shopping_lists)
-                        if merged_shopping_list is None:
-                            result = False
-                        else:
-                            result = json.dumps(merged_shopping_list, default=lambda x: x.__dict__)
-                    print("Result  after quorum consensus: ", result)
-
-                    response_to_router = build_quorum_get_response(quorum_id, result)
-                    server_socket.send_json(response_to_router)
-
-                case MessageType.COORDINATE_DELETE:
-                    quorum_id = task["quorum_id"]
-                    key = task["key"]
-
-                    primary_node, primary_node_index = self.dynamo_node.hash_ring.get_node(key)
-
-                    if primary_node != self.address:
-                        print("I am not the primary node for this key", file=sys.stderr)
-                        # assume primary node is down and hash ring is correct,
-                        # so we create a delete hint for the primary node
+                request_to_replicas = build_put_request(key, value, quorum_id, delta)
+
+                result = ([self.write_data(key, value, delta)] +
+                          (yield self.send_put_request_to_other_nodes, (request_to_replicas, replicas, 5, 1,
+                                                                        W_QUORUM)))
+
+                print(result)
+                quorum_size = min(W_QUORUM, len(set(replicas)) + 1)
+                # the replicas that refused a delta don't count, the client then sends the whole list
+                if len([written for written in result if written]) < quorum_size:
+                    result = False
+                else:
+                    result = True
+                print("Result after quorum consensus: ", result)
+
+                response_to_router = build_quorum_put_response(quorum_id, result)
+                self.reply_to_router(task, response_to_router)
+
+            case MessageType.COORDINATE_GET:
+                quorum_id = task["quorum_id"]
+                key = task["key"]
+
+                primary_node, primary_node_index = ring.get_node(key)
+
+                if primary_node != self.address:
+                    print("I am not the primary node for this key", file=sys.stderr)
+                    # assuming hash ring is updated, the node is just down for the moment, no action
+
+                unhealthy = self.suspected_replicas(ring, primary_node_index)
+                replicas, failed, substitutes = ring.get_replica_nodes(primary_node, primary_node_index, unhealthy)
+
+                replicas = [replica for replica in replicas if replica != self.address]
+                request_to_replicas = build_get_request(key, quorum_id)
+
+                local = self.read_data(key)
+                answers = yield self.send_get_request_to_other_nodes, (request_to_replicas, replicas, 5, 1, R_QUORUM,
+                                                                       True)
+                tmp_result = [local] + list(answers.values())
+
+                print(tmp_result)
+                # exclude Nones from the list
+                result = [item for item in tmp_result if item is not None]
+                quorum_size = min(R_QUORUM, len(set(replicas)) + 1)  # there is no guarantee that the failed nodes will be able to reply
+                if len(result) == 0 and ring.previous is not None:
+                    # not handed off to its new placement yet, any copy from the previous one will do
+                    result = yield from self.read_previous_placement(key, unhealthy)
+                    quorum_size = min(quorum_size, 1)
+                result = self.read_result(result, quorum_size)
+                print("Result  after quorum consensus: ", result)
+                self.repair_replicas(key, result, local, answers)
+
+                response_to_router = build_quorum_get_response(quorum_id, result)
+                self.reply_to_router(task, response_to_router)
+
+            case MessageType.COORDINATE_DELETE:
+                quorum_id = task["quorum_id"]
+                key = task["key"]
+
+                primary_node, primary_node_index = ring.get_node(key)
+
+                if primary_node != self.address:
+                    print("I am not the primary node for this key", file=sys.stderr)
+                    # assume primary node is down and hash ring is correct,
+                    # so we create a delete hint for the primary node
+                    with self.hints_lock:
                         upsert_list(primary_node, key, self.delete_hints)
 
-                    healthy, unhealthy = self.check_nodes_health(
-                        self.dynamo_node.hash_ring.get_other_nodes(self.address))
-                    replicas, failed, substitutes = self.dynamo_node.hash_ring.get_replica_nodes(primary_node,
-                                                                                                 primary_node_index,
-                                                                                                 unhealthy)
+                unhealthy = self.suspected_replicas(ring, primary_node_index)
+                replicas, failed, substitutes = ring.get_replica_nodes(primary_node, primary_node_index, unhealthy)
+
+                self.send_hints(key, failed, substitutes, build_delete_hint_request)
+
+                request_to_replicas = build_delete_request(key, quorum_id)
+
+                result = ([self.dynamo_node.delete_data(key)] +
+                          (yield self.send_delete_request_to_other_nodes, (request_to_replicas, replicas, 5, 1,
+                                                                           R_QUORUM)))
 
-                    substitutes = [substitute for substitute in substitutes if substitute != self.address]
+                print(result)
+                quorum_size = min(R_QUORUM, len(set(replicas)) + 1 - len(failed))  # there is no guarantee that the substitute nodes had the list
+                if len(result) < quorum_size:
+                    result = False
+                else:
+                    result = True
 
-                    if len(failed) > 0:
-                        print(f"Failed count: {len(failed)}")
-                        # send message to substitutes for the failed nodes
-                        for idx, substitute in enumerate(substitutes[:len(failed)]):
-                            self.send_push_message(self.address, substitute,
-                                                   json.dumps(build_delete_hint_request(key, failed[idx])))
+                response_to_router = build_quorum_delete_response(quorum_id, result)
+                self.reply_to_router(task, response_to_router)
 
-                    request_to_replicas = build_delete_request(key, quorum_id)
+            case MessageType.COMPACT:
+                yield from self.compact_lists()
 
-                    result = ([self.dynamo_node.delete_data(key)] +
-                              self.send_delete_request_to_other_nodes(request_to_replicas, replicas, 5, 1,
-                                                                      R_QUORUM))
+            case MessageType.GC:
+                yield from self.collect_lists()
 
-                    print(result)
-                    quorum_size = min(R_QUORUM, len(set(replicas)) + 1 - len(failed))  # there is no guarantee that the substitute nodes had the list
-                    if len(result) < quorum_size:
-                        result = False
-                    else:
-                        result = True
+            case MessageType.MEMBERSHIP:
+                self.apply_membership()
+
+    def send_hints(self, key, failed, substitutes, build_hint_request):
+        substitutes = [substitute for substitute in substitutes if substitute != self.address]
+        if len(failed) > 0:
+            print(f"Failed count: {len(failed)}")
+            # send message to substitutes for the failed nodes
+            for idx, substitute in enumerate(substitutes[:len(failed)]):
+                self.send_push_message(self.address, substitute,
+                                       json.dumps(build_hint_request(key, failed[idx])))
+
+    def read_result(self, result, quorum_size):
+        """The merge of the lists read, or False without a quorum"""
+        if len(result) < quorum_size:
+            return False
+        shopping_lists = [ShoppingList.from_wire(shopping_list) for shopping_list in result]
+        merged_shopping_list = self.dynamo_node.merge_shopping_lists(shopping_lists)
+        if merged_shopping_list is None:
+            return False
+        return merged_shopping_list.to_wire()
 
-                    server_socket = task["origin"]
-                    response_to_router = build_quorum_delete_response(quorum_id, result)
-                    server_socket.send_json(response_to_router)
+    def repair_replicas(self, key, merged, local, answers):
+        """Read repair, the merged list is written back to the replicas that answered with an older list or none,
+        answers has the response of each replica that replied. The ones that didn't reply in time are left to
+        the hints"""
+        if merged is False:
+            return
+        digest = ShoppingList.from_wire(merged).digest()
+        stale = [replica for replica, answer in answers.items()
+                 if answer is None or ShoppingList.from_wire(answer).digest() != digest]
+        if self.check_if_owned(key) and (local is None or ShoppingList.from_wire(local).digest() != digest):
+            self.dynamo_node.write_data(key, ShoppingList.from_wire(merged))
+        if stale:
+            print(f"Repairing list {key} on {stale}")
+        for replica in stale:
+            self.send_push_message(self.address, replica, json.dumps(build_put_request(key, merged, NULL_QUORUM_ID)))
+
+    def reply_to_router(self, task, response):
+        self.send_to_router(self.node_sockets.index(task["origin"]), response)
+
+    def send_to_router(self, router_index, message):
+        """Hands the message to the main thread, which owns the router sockets"""
+        socket = getattr(self.local, 'router_replies', None)
+        if socket is None:
+            socket = self.local.router_replies = self.context.socket(zmq.PUSH)
+            socket.connect(ROUTER_REPLIES_ADDRESS)
+        socket.send_multipart([str(router_index).encode('utf-8'), json.dumps(message).encode('utf-8')])
+
+    def primary_keys(self):
+        ring = self.dynamo_node.hash_ring
+        with self.dynamo_node.lock:
+            keys = list(self.dynamo_node.data.keys())
+        return [key for key in keys if ring.get_node(key)[0] == self.address]
+
+    def read_all_replicas(self, key, unhealthy):
+        """Reads the list from every replica, returns the replicas, the local list and the state of each replica,
+        or None when some replica is down or doesn't answer"""
+        local_and_replicas = self.local_and_replicas(key, unhealthy)
+        if local_and_replicas is None:
+            return None
+        local, replicas = local_and_replicas
+        responses = yield self.send_get_request_to_other_nodes, (build_get_request(key, str(uuid.uuid4())), replicas,
+                                                                 5, 1, len(replicas))
+        return self.replica_states(local, replicas, responses)
+
+    def local_and_replicas(self, key, unhealthy):
+        """The local list and the other replicas of the key, or None when some replica is down"""
+        ring = self.dynamo_node.hash_ring
+        primary_node, primary_node_index = ring.get_node(key)
+        replicas, failed, _ = ring.get_replica_nodes(primary_node, primary_node_index, unhealthy)
+        if len(failed) > 0:
+            return None
+        replicas = list(set(replicas) - {self.address})
+        with self.dynamo_node.lock:
+            if key not in self.dynamo_node.data:
+                return None
+            return self.dynamo_node.merge_shopping_lists(self.dynamo_node.data[key]), replicas
+
+    def replica_states(self, local, replicas, responses):
+        if len(responses) < len(replicas) or None in responses:
+            return None
+        return replicas, local, [local.items] + [ShoppingList.from_wire(response).items for response in responses]
+
+    def write_all_replicas(self, key, shopping_list, replicas):
+        self.dynamo_node.write_data(key, shopping_list)
+        result = yield self.send_put_request_to_other_nodes, (
+            build_put_request(key, shopping_list.to_wire(), str(uuid.uuid4())), replicas, 5, 1, len(replicas))
+        # replicas that missed it still converge, merging aligns the older states
+        print(f"List {key} written to {len(result) + 1} replicas")
+
+    def compact_lists(self):
+        """Compaction round over the lists this node is the primary of"""
+        primary_keys = self.compaction_keys()
+        if len(primary_keys) == 0:
+            return
+        healthy, unhealthy = yield self.check_nodes_health, (self.dynamo_node.hash_ring.get_other_nodes(self.address),)
+        for key in primary_keys:
+            yield from self.compact_list(key, unhealthy)
+
+    def compaction_keys(self):
+        primary_keys = self.primary_keys()
+        self.replica_activity = {key: self.replica_activity.get(key, {}) for key in primary_keys}
+        return primary_keys
+
+    def compact_list(self, key, unhealthy):
+        """Reads the list from all its replicas and retires the replica ids that every replica has seen
+        with the same clock for RETIRE_AFTER seconds, the compacted list is then written to all of them"""
+        # every live replica must have observed what gets archived
+        read = yield from self.read_all_replicas(key, unhealthy)
+        if read is None:
+            return
+        replicas, local, states = read
+        compacted = self.compacted_list(key, local, states)
+        if compacted is not None:
+            yield from self.write_all_replicas(key, compacted, replicas)
+
+    def compacted_list(self, key, local, states):
+        """The compacted list, or None when no replica can be retired yet"""
+        merged = ShoppingListCRDT.merge_many(states)
+
+        now = time.time()
+        activity = self.replica_activity[key]
+        retired = {}
+        for replica, clock in merged.version.items():
+            seen_clock, since = activity.get(replica, (None, now))
+            if seen_clock != clock:
+                activity[replica] = (clock, now)
+            elif now - since >= RETIRE_AFTER and all(state.version.get(replica, 0) == clock for state in states):
+                retired[replica] = clock
+        if len(retired) == 0:
+            return None
+
+        print(f"Compacting list {key}, retiring {list(retired)}")
+        for replica in retired:
+            activity.pop(replica)
+        return ShoppingList(key, local.name, merged.compact(retired))
+
+    def collect_lists(self):
+        """Sweeps the deleted items of the lists this node is the primary of, runs when the node is idle"""
+        primary_keys = self.collection_keys()
+        if len(primary_keys) == 0:
+            return
+        healthy, unhealthy = yield self.check_nodes_health, (self.dynamo_node.hash_ring.get_other_nodes(self.address),)
+        for key in primary_keys:
+            yield from self.collect_list(key, unhealthy)
+
+    def collection_keys(self):
+        # only lists with tombstones or absorbed totals are worth a round of reads
+        with self.dynamo_node.lock:
+            primary_keys = [key for key in self.primary_keys() if key in self.dynamo_node.data
+                            and any(shopping_list.items.absorbed or
+                                    any(counter.value() == 0 for counter in shopping_list.items.counters.values())
+                                    for shopping_list in self.dynamo_node.data[key])]
+        self.collection_activity = {key: self.collection_activity.get(key, {}) for key in primary_keys}
+        return primary_keys
+
+    def collect_list(self, key, unhealthy):
+        """Removes the items at zero once every storage replica has the same version of the list. Clients are
+        replicas too and may still hold the items, their states are brought to the collection by the absorbed
+        totals when they merge, see ShoppingListCRDT.drop_collected. The totals of a round are dropped once
+        every storage replica has had it for RETIRE_AFTER seconds, like compaction a client that hasn't synced
+        for that long is taken for gone"""
+        read = yield from self.read_all_replicas(key, unhealthy)
+        if read is None:
+            return
+        replicas, local, states = read
+        collected = self.collected_list(key, local, states)
+        if collected is not None:
+            yield from self.write_all_replicas(key, collected, replicas)
+
+    def collected_list(self, key, local, states):
+        """The list without its items at zero and its expired absorbed totals, or None when there is nothing to
+        drop. Items are only collected when the replicas have the same version"""
+        merged = ShoppingListCRDT.merge_many(states)
+        ids = set()
+        if all(state.version == states[0].version for state in states):
+            ids = {id for id, counter in merged.counters.items() if counter.value() == 0}
+
+        now = time.time()
+        activity = self.collection_activity[key]
+        seen = min(state.seen_round() for state in states)
+        expired = merged.expired
+        for round in sorted({round for round, _ in merged.absorbed.values() if round <= seen}):
+            if now - activity.setdefault(round, now) < RETIRE_AFTER:
+                break
+            expired = round
+        if len(ids) == 0 and expired == merged.expired:
+            return None
+
+        if ids:
+            print(f"Collecting {len(ids)} deleted items of list {key}")
+            merged = merged.collect(ids)
+        if expired > merged.expired:
+            print(f"Dropping the absorbed totals of list {key} up to round {expired}")
+            merged = merged.expire(expired)
+            for round in [round for round in activity if round <= expired]:
+                activity.pop(round)
+        return ShoppingList(key, local.name, merged)
 
 
     def handle_request_response(self, request_type_quorums_state, json_request):
         request_id = json_request['quorum_id']
         if request_id == NULL_QUORUM_ID:
-            # write the value with dynamo node
-            if json_request['value']:
+            # write the value with dynamo node, the answers to the read repairs have nothing to write
+            if request_type_quorums_state is self.read_quorum_requests_state and json_request['value']:
                 print(f"Receiving missing list {json_request}")
-                self.dynamo_node.write_data(json_request['key'], ShoppingList.from_dict(json.loads(json_request['value'])))
-        elif request_id in request_type_quorums_state:
-            if json_request['address'] not in request_type_quorums_state[request_id]['nodes_with_reply']:
-                request_type_quorums_state[request_id]['nodes_with_reply'].add(json_request['address'])
-                request_type_quorums_state[request_id]['responses'].append(json_request['value'])
-                request_type_quorums_state[request_id]['retry_info'][json_request['address']] += 1
+                self.dynamo_node.write_data(json_request['key'], ShoppingList.from_wire(json_request['value']))
+        elif (state := request_type_quorums_state.get(request_id)) is not None:
+            # a single lookup, the coordinator may remove the state meanwhile
+            self.response_arrived(state, json_request)
         else:
             print(f"{request_type_quorums_state}::Received a response for a request that was already processed")
 
+    def response_arrived(self, state, json_request):
+        with state['arrived']:
+            if self.record_response(state, json_request):
+                state['arrived'].notify_all()
+
+    @staticmethod
+    def record_response(state, json_request):
+        """Adds the response to the quorum state, False if its node had already replied"""
+        if json_request['address'] in state['nodes_with_reply']:
+            return False
+        state['nodes_with_reply'][json_request['address']] = json_request['value']
+        state['responses'].append(json_request['value'])
+        state['retry_info'][json_request['address']] += 1
+        return True
+
     def handle_request(self, message_type, json_request, sender_identity):
         key = json_request['key']
         if message_type == MessageType.PUT:
-            value = json_request['value']
-            value = self.dynamo_node.write_data(key, ShoppingList.from_dict(json.loads(value)))
+            value = self.write_data(key, json_request['value'], json_request.get('delta', False))
         elif message_type == MessageType.GET:
             value = self.read_data(key)
         elif message_type == MessageType.DELETE:
@@ -610,70 +1066,82 @@ class Node:
         print("listening for nodes")
         while True:
             sender_identity, message = self.reply_socket.recv_multipart()
-            json_request = json.loads(message)
-            print(sender_identity)
-            print(json_request)
-            print('\n\n')
-
-            match get_request_type(json_request):
-                case MessageType.PUT_RESPONSE:
-                    self.handle_request_response(self.write_quorum_requests_state, json_request)
-                    continue
+            self.handle_node_message(sender_identity, json.loads(message))
 
-                case MessageType.GET_RESPONSE:
-                    self.handle_request_response(self.read_quorum_requests_state, json_request)
-                    continue
-
-                case MessageType.DELETE_RESPONSE:
-                    self.handle_request_response(self.delete_quorum_requests_state, json_request)
-                    continue
+    def handle_node_message(self, sender_identity, json_request):
+        print(sender_identity)
+        print(json_request)
+        print('\n\n')
 
-                case MessageType.PUT:
-                    self.handle_request(MessageType.PUT, json_request, sender_identity)
-                    continue
+        match get_request_type(json_request):
+            case MessageType.PUT_RESPONSE:
+                self.handle_request_response(self.write_quorum_requests_state, json_request)
 
-                case MessageType.GET:
-                    self.handle_request(MessageType.GET, json_request, sender_identity)
-                    continue
+            case MessageType.GET_RESPONSE:
+                self.handle_request_response(self.read_quorum_requests_state, json_request)
 
-                case MessageType.DELETE:
-                    self.handle_request(MessageType.DELETE, json_request, sender_identity)
-                    continue
+            case MessageType.DELETE_RESPONSE:
+                self.handle_request_response(self.delete_quorum_requests_state, json_request)
 
-                case MessageType.WRITE_HINT:
-                    # store the hint
-                    print("RECEIVING WRITE-HINT FROM ", sender_identity.decode('utf-8'))
-                    key = json_request['key']
-                    node = json_request['node']
-                    upsert_list(node, key, self.write_hints)
+            case MessageType.PUT:
+                self.handle_request(MessageType.PUT, json_request, sender_identity)
 
-                case MessageType.DELETE_HINT:
-                    # store the hint
-                    key = json_request['key']
-                    node = json_request['node']
-                    upsert_list(node, key, self.delete_hints)
+            case MessageType.GET:
+                self.handle_request(MessageType.GET, json_request, sender_identity)
 
-                case MessageType.PUT_HANDED_OFF:
-                    key = json_request['key']
-                    value = json_request['value']
-                    self.dynamo_node.write_data(key, ShoppingList.from_dict(json.loads(value)))
-                    continue
+            case MessageType.DELETE:
+                self.handle_request(MessageType.DELETE, json_request, sender_identity)
 
-                case MessageType.DELETE_HANDED_OFF:
-                    key = json_request['key']
-                    self.dynamo_node.delete_data(key)
-                    continue
+            case MessageType.WRITE_HINT:
+                # store the hint
+                print("RECEIVING WRITE-HINT FROM ", sender_identity.decode('utf-8'))
+                key = json_request['key']
+                node = json_request['node']
+                with self.hints_lock:
+                    upsert_list(node, key, self.write_hints)
 
-                case MessageType.HEALTH_CHECK:
-                    # If a HEALTH_CHECK message is received, send a HEALTH_CHECK_RESPONSE message
-                    response = {"type": MessageType.HEALTH_CHECK_RESPONSE}
-                    self.send_push_message(self.address, sender_identity,
-                                           json.dumps(response))
-                    continue
+            case MessageType.DELETE_HINT:
+                # store the hint
+                key = json_request['key']
+                node = json_request['node']
+                with self.hints_lock:
+                    upsert_list(node, key, self.delete_hints)
 
-                case MessageType.HEALTH_CHECK_RESPONSE:
-                    self.nodes_health[sender_identity.decode('utf-8')] = True
-                    continue
+            case MessageType.PUT_HANDED_OFF:
+                key = json_request['key']
+                value = json_request['value']
+                self.dynamo_node.write_data(key, ShoppingList.from_wire(value))
+                self.send_push_message(self.address, sender_identity,
+                                       json.dumps(build_handed_off_response(MessageType.PUT_HANDED_OFF, key)))
+
+            case MessageType.DELETE_HANDED_OFF:
+                key = json_request['key']
+                self.dynamo_node.delete_data(key)
+                self.send_push_message(self.address, sender_identity,
+                                       json.dumps(build_handed_off_response(MessageType.DELETE_HANDED_OFF, key)))
+
+            case MessageType.PUT_HANDED_OFF_RESPONSE | MessageType.DELETE_HANDED_OFF_RESPONSE:
+                self.handed_off(sender_identity.decode('utf-8'), json_request['key'])
+
+            case MessageType.HEALTH_CHECK:
+                # If a HEALTH_CHECK message is received, send a HEALTH_CHECK_RESPONSE message
+                response = {"type": MessageType.HEALTH_CHECK_RESPONSE}
+                self.send_push_message(self.address, sender_identity,
+                                       json.dumps(response))
+
+            case MessageType.HEALTH_CHECK_RESPONSE:
+                self.record_health(sender_identity.decode('utf-8'))
+
+            case MessageType.GOSSIP:
+                self.handle_gossip(sender_identity.decode('utf-8'), json_request)
+
+    def record_health(self, node):
+        self.failure_detector.heartbeat(node)
+        with self.health_changed:
+            self.nodes_health[node] = True
+            for answered in self.health_waiters.pop(node, []):
+                answered.add(node)
+            self.health_changed.notify_all()
 
     def update_health_statuses(self, healthy, unhealthy):
         for node in unhealthy:
@@ -687,44 +1155,90 @@ class Node:
     def get_unhealthy_nodes(self, nodes):
         return [node for node in nodes if not self.nodes_health.get(node, False)]
 
+    def hand_off_moved_lists(self, before):
+        """Sends the lists whose owners changed since the before placement to the nodes that gained them,
+        with the ring only the keys in the token ranges that moved are looked at. A list this node no longer
+        owns is deleted once all the nodes that gained it acknowledged it"""
+        with self.dynamo_node.lock:
+            moved = self.dynamo_node.hash_ring.moved_keys(before, self.dynamo_node.key_index)
+        print(f"Handing off {len(moved)} of {len(self.dynamo_node.data)} lists")
+        for key, gained in moved:
+            gained = [node for node in gained if node != self.address]
+            for node in gained:
+                self.hand_off(node, key, MessageType.PUT_HANDED_OFF)
+            if len(gained) == 0:
+                self.release_handed_off(key)
+
     def delete_list_if_not_owned(self, key):
-        primary_node, primary_node_pos = self.dynamo_node.hash_ring.get_node(key)
-        replicas = self.dynamo_node.hash_ring.get_ideal_replica_nodes(primary_node, primary_node_pos)
-        if self.address not in replicas:
+        if not self.check_if_owned(key):
             self.dynamo_node.delete_data(key)
 
     def check_if_owned(self, key, node=None):
+        """While migrating the hash function, a node owns the lists of both placements"""
         if node is None:
             node = self.address
-        primary_node, primary_node_pos = self.dynamo_node.hash_ring.get_node(key)
-        replicas = self.dynamo_node.hash_ring.get_ideal_replica_nodes(primary_node, primary_node_pos)
-        return node in replicas
+        return self.dynamo_node.hash_ring.is_owner(key, node)
+
+    def read_previous_placement(self, key, unhealthy):
+        previous_owners = [node for node in self.dynamo_node.hash_ring.previous.get_owners(key)
+                           if node != self.address and node not in unhealthy]
+        responses = yield self.send_get_request_to_other_nodes, (build_get_request(key, str(uuid.uuid4())),
+                                                                 previous_owners, 5, 1, 1)
+        return [response for response in responses if response is not None]
+
+    def migrate_lists(self):
+        """While the hash function is being changed, hands off each list this node holds to the nodes
+        of its new placement, once they are all up"""
+        with self.dynamo_node.lock:
+            keys = [key for key in self.dynamo_node.data.keys() if key not in self.migrated]
+        if len(keys) == 0:
+            return
+        healthy, _ = yield self.check_nodes_health, (self.dynamo_node.hash_ring.get_other_nodes(self.address),)
+        for key in keys:
+            owners = [node for node in self.dynamo_node.hash_ring.get_owners(key) if node != self.address]
+            if any(node not in healthy for node in owners):
+                continue
+            for node in owners:
+                self.hand_off(node, key, MessageType.PUT_HANDED_OFF)
+            self.migrated.add(key)
+
+    def write_data(self, key, value, delta=False):
+        """Writes the list from the wire, a refused delta makes this node ask a replica for the whole list"""
+        written = self.dynamo_node.write_data(key, ShoppingList.from_wire(value), delta)
+        if not written and delta and self.check_if_owned(key):
+            self.fetch_list(key)
+        return written
 
     def read_data(self, key):
         result = self.dynamo_node.read_data(key)
         if result is None and self.check_if_owned(key):
-            # ask other nodes for the list
-            primary_node, primary_node_pos = self.dynamo_node.hash_ring.get_node(key)
-            replicas, _, _ = self.dynamo_node.hash_ring.get_replica_nodes(primary_node, primary_node_pos)
-            replicas = [replica for replica in replicas if replica != self.address]
-            if len(replicas) > 0:
-                chosen_replica = replicas[0]
-                print(f"Asking {chosen_replica} for missing list")
-                self.send_push_message(self.address, chosen_replica,
-                                       json.dumps(build_get_request(key, NULL_QUORUM_ID)))
+            self.fetch_list(key)
 
         return result
 
+    def fetch_list(self, key):
+        # ask other nodes for the list
+        ring = self.dynamo_node.hash_ring
+        primary_node, primary_node_pos = ring.get_node(key)
+        replicas, _, _ = ring.get_replica_nodes(primary_node, primary_node_pos)
+        replicas = [replica for replica in replicas if replica != self.address]
+        if len(replicas) > 0:
+            chosen_replica = replicas[0]
+            print(f"Asking {chosen_replica} for the list")
+            self.send_push_message(self.address, chosen_replica,
+                                   json.dumps(build_get_request(key, NULL_QUORUM_ID)))
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python node.py <port>")
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python node.py <port> [weight]")
         sys.exit(1)
 
     port = sys.argv[1]
     node_address = f"tcp://localhost:{port}"
+    weight = float(sys.argv[2]) if len(sys.argv) == 3 else DEFAULT_NODE_WEIGHT
 
-    node: Node = Node(node_address)
+    node: Node = Node(node_address, weight)
 
     # ensure that at exit the database is saved
     atexit.register(node.dynamo_node.save_all_database_data)
@@ -0,0 +1,81 @@
+# Long lived PUSH sockets to the other nodes, instead of connecting a new socket for every message
+import queue
+import threading
+
+import zmq
+
+from utils import PUSH_HWM, PUSH_LINGER
+
+
+class PushPool:
+    """One PUSH socket per peer, all owned by the sender thread since zmq sockets can't be shared between threads.
+    The other threads only queue the operations, so a message costs a put and not a tcp connect.
+    A peer that is down keeps up to PUSH_HWM messages queued, zmq reconnects and delivers them when it is back,
+    past that the messages to it are dropped instead of blocking the sends to the other peers, so every message
+    that must arrive is resent until it is answered: the quorums retry and the handoffs wait for their acks.
+    Without threaded, the operations run on the calling thread, for a caller that is the only user of the pool"""
+    def __init__(self, context, hwm=PUSH_HWM, linger=PUSH_LINGER, threaded=True):
+        self.context = context
+        self.threaded = threaded
+        self.hwm = hwm
+        self.linger = linger
+        self.sockets = {}  # k: peer address, v: PUSH socket connected to it, only used by the sender thread
+        self.outbox = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, operation, address=None, frames=None):
+        if self.threaded:
+            self.outbox.put((operation, address, frames))
+        else:
+            self.apply(operation, address, frames)
+
+    def send(self, address, frames):
+        self.submit('send', address, frames)
+
+    def connect(self, address):
+        """Opens the socket to a peer ahead of its first message"""
+        self.submit('connect', address)
+
+    def drop(self, address):
+        self.submit('drop', address)
+
+    def stop(self):
+        self.submit('stop')
+
+    def socket(self, address):
+        socket = self.sockets.get(address)
+        if socket is None:
+            socket = self.context.socket(zmq.PUSH)
+            socket.setsockopt(zmq.SNDHWM, self.hwm)
+            socket.setsockopt(zmq.LINGER, self.linger)
+            socket.connect(address)
+            self.sockets[address] = socket
+        return socket
+
+    def run(self):
+        while True:
+            operation, address, frames = self.outbox.get()
+            self.apply(operation, address, frames)
+            if operation == 'stop':
+                return
+
+    def apply(self, operation, address, frames):
+        match operation:
+            case 'send':
+                try:
+                    self.socket(address).send_multipart(frames, zmq.NOBLOCK)
+                except zmq.Again:
+                    print(f"Dropped message to {address}, {self.hwm} messages already queued")
+            case 'connect':
+                self.socket(address)
+            case 'drop':
+                socket = self.sockets.pop(address, None)
+                if socket is not None:
+                    socket.close()
+            case 'stop':
+                for socket in self.sockets.values():
+                    socket.close()
+                self.sockets.clear()
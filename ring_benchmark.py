@@ -0,0 +1,178 @@
+# Benchmarks for the hash ring lookups
+# usage: python ring_benchmark.py [lookups]
+#        python ring_benchmark.py report [keys] [hash function] > report.json
+# the report measures the balance, key movement, lookup throughput and memory of each placement engine for each
+# number of nodes and vnodes (REPLICA_COUNT), as json so runs can be compared
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from uuid import uuid4
+
+from hash_ring import HASH_FUNCTIONS, PLACEMENTS, build_placement
+from utils import HASH_FUNCTION, REPLICA_COUNT, N
+
+NODE_COUNTS = [10, 100, 1000]
+VNODE_COUNTS = [24, 256]
+REPORT_NODE_COUNTS = [5, 10, 50, 100]
+REPORT_VNODE_COUNTS = [1, 8, 24, 64, 256]
+
+
+def build_ring(nodes, vnodes, hash_function='sha256', placement='ring'):
+    return build_placement([f"tcp://localhost:{6000 + i}" for i in range(nodes)], vnodes, placement,
+                           hash_function=hash_function, previous_hash_function=None)
+
+
+def get_node_pos_linear(ring, key):
+    """get_node_pos as it was before the bisect, a scan over the hex digests"""
+    hash_key = f"{ring.hash_key(key):064x}"
+    for i, ring_key in enumerate(ring.hex_keys):
+        if hash_key <= ring_key:
+            return i
+    return 0
+
+
+def lookups_per_second(fn, keys):
+    start = time.perf_counter()
+    for key in keys:
+        fn(key)
+    return len(keys) / (time.perf_counter() - start)
+
+
+def benchmark_lookups(lookups):
+    print(f"HashRing.get_node_pos, {lookups} random keys (the linear scan runs on a 1% sample)")
+    print(f"{'nodes':>6} {'vnodes':>7} {'bisect (/s)':>12} {'linear (/s)':>12} {'speedup':>8}")
+    keys = [str(uuid4()) for _ in range(lookups)]
+    sample = keys[:max(lookups // 100, 10)]
+    for nodes in NODE_COUNTS:
+        for vnodes in VNODE_COUNTS:
+            ring = build_ring(nodes, vnodes)
+            ring.hex_keys = [f"{key:064x}" for key in ring.sorted_keys]
+            assert all(ring.get_node_pos(key) == get_node_pos_linear(ring, key) for key in sample)
+            fast = lookups_per_second(ring.get_node_pos, keys)
+            linear = lookups_per_second(lambda key: get_node_pos_linear(ring, key), sample)
+            print(f"{nodes:>6} {vnodes:>7} {fast:>12.0f} {linear:>12.0f} {fast / linear:>7.1f}x")
+
+
+def benchmark_hash_functions(lookups, nodes=100, vnodes=24, hot_keys=1000):
+    print(f"HashRing.get_node, {nodes} nodes x {vnodes} vnodes, {lookups} lookups of distinct keys "
+          f"and of {hot_keys} repeated keys")
+    print(f"{'hash':>8} {'uncached (/s)':>14} {'distinct (/s)':>14} {'repeated (/s)':>14}")
+    keys = [str(uuid4()) for _ in range(lookups)]
+    hot = [keys[i % hot_keys] for i in range(lookups)]
+    for name, token in HASH_FUNCTIONS.items():
+        ring = build_ring(nodes, vnodes, name)
+        uncached = lookups_per_second(lambda key: ring.ring[ring.sorted_keys[ring.get_node_pos_of_token(token(key))]],
+                                      keys)
+        distinct = lookups_per_second(ring.get_node, keys)
+        repeated = lookups_per_second(ring.get_node, hot)
+        print(f"{name:>8} {uncached:>14.0f} {distinct:>14.0f} {repeated:>14.0f}")
+
+
+def imbalance(counts):
+    """stddev over mean and max over mean of the keys per node, 0 and 1 when perfectly balanced"""
+    mean = statistics.mean(counts)
+    return statistics.pstdev(counts) / mean, max(counts) / mean
+
+
+def moved_fraction(before, after, keys):
+    """Fraction of the keys whose primary and whose owners changed between two rings"""
+    primary = owners = 0
+    for key in keys:
+        if before.get_node(key)[0] != after.get_node(key)[0]:
+            primary += 1
+        if set(before.get_owners(key)) != set(after.get_owners(key)):
+            owners += 1
+    return primary / len(keys), owners / len(keys)
+
+
+def ring_memory(nodes, vnodes, keys, hash_function, placement):
+    """Bytes held by a placement once built and after looking up the owners of every key, with what it caches"""
+    tracemalloc.start()
+    ring = build_ring(nodes, vnodes, hash_function, placement)
+    for key in keys:
+        ring.get_owners(key)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak
+
+
+def report_ring(nodes, vnodes, keys, hash_function, placement='ring'):
+    ring = build_ring(nodes, vnodes, hash_function, placement)
+    node_keys = {node: 0 for node in ring.nodes}
+    owner_keys = {node: 0 for node in ring.nodes}
+    for key in keys:
+        node_keys[ring.get_node(key)[0]] += 1
+        for node in ring.get_owners(key):
+            owner_keys[node] += 1
+    primary_stddev, primary_max = imbalance(list(node_keys.values()))
+    owner_stddev, owner_max = imbalance(list(owner_keys.values()))
+
+    # a new node joins, then one of the original nodes leaves
+    joined = build_ring(nodes, vnodes, hash_function, placement)
+    joined.add_node(f"tcp://localhost:{6000 + nodes}")
+    add_primary, add_owners = moved_fraction(ring, joined, keys)
+    left = build_ring(nodes, vnodes, hash_function, placement)
+    left.remove_node("tcp://localhost:6000")
+    remove_primary, remove_owners = moved_fraction(ring, left, keys)
+
+    lookups = build_ring(nodes, vnodes, hash_function, placement)
+    throughput = lookups_per_second(lookups.get_node, keys)
+    memory, peak_memory = ring_memory(nodes, vnodes, keys, hash_function, placement)
+    return {
+        "placement": placement,
+        "nodes": nodes,
+        "vnodes": vnodes,
+        "tokens": sum(ring.token_count(node) for node in ring.nodes),
+        "primary_stddev_over_mean": primary_stddev,
+        "primary_max_over_mean": primary_max,
+        "owners_stddev_over_mean": owner_stddev,
+        "owners_max_over_mean": owner_max,
+        "token_space_max_share": max(ring.ownership().values()) * nodes,
+        "add_moved_primary": add_primary,
+        "add_moved_owners": add_owners,
+        "add_ideal_primary": 1 / (nodes + 1),
+        "add_ideal_owners": min(1, (N + 1) / (nodes + 1)),
+        "remove_moved_primary": remove_primary,
+        "remove_moved_owners": remove_owners,
+        "remove_ideal_primary": 1 / nodes,
+        "remove_ideal_owners": min(1, (N + 1) / nodes),
+        "lookups_per_second": throughput,
+        "memory_bytes": memory,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def report(keys, hash_function=HASH_FUNCTION):
+    """Each placement measured for every REPORT_NODE_COUNTS, and the ring for every REPORT_VNODE_COUNTS, with the
+    first uncached lookups of each key, the shares are relative to a perfectly even placement"""
+    keys = [str(uuid4()) for _ in range(keys)]
+    results = []
+    for placement in PLACEMENTS:
+        for nodes in REPORT_NODE_COUNTS:
+            # only the ring has vnodes
+            for vnodes in REPORT_VNODE_COUNTS if placement == 'ring' else [0]:
+                print(f"{placement}, {nodes} nodes x {vnodes} vnodes", file=sys.stderr)
+                results.append(report_ring(nodes, vnodes, keys, hash_function, placement))
+    return {
+        "hash_function": hash_function,
+        "replica_count": REPLICA_COUNT,
+        "keys": len(keys),
+        "python": platform.python_version(),
+        "results": results,
+    }
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        keys = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+        hash_function = sys.argv[3] if len(sys.argv) > 3 else HASH_FUNCTION
+        print(json.dumps(report(keys, hash_function), indent=2))
+        sys.exit(0)
+
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    benchmark_lookups(lookups)
+    print()
+    benchmark_hash_functions(lookups)
@@ -1,14 +1,14 @@
 # Start of server.py
 import json
 import queue
+import random
 import sys
 from uuid import uuid4
-import matplotlib.pyplot as plt
 
 import zmq
 import threading
 
-from hash_ring import HashRing
+from hash_ring import build_placement
 from utils import *
 from bstar_utils import *
 import time
@@ -21,9 +21,11 @@ class Router:
     address: str -> str with bind address
     nodes: list -> list of nodes (default [] and router discovers the nodes)
     replica_count: int -> number of replicas
+    placement: str -> placement engine of hash_ring.PLACEMENTS, the same as the nodes
     '''
 
-    def __init__(self, primary: bool, address: str, nodes=[], replica_count=3):
+    def __init__(self, primary: bool, address: str, nodes=[], replica_count=3, placement=PLACEMENT,
+                 balance_report=False):
         self._context = zmq.Context()
 
         self.fsm = BStarState(0, 0, 0)
@@ -42,7 +44,9 @@ class Router:
 
         self.nodes = nodes
         self.activity = {}  # for heartbeats and potentially other things
-        self.hash_ring = HashRing(nodes, replica_count)
+        self.hash_ring = build_placement(nodes, replica_count, placement)
+        # the report walks the whole placement, only for debugging
+        self.balance_report = balance_report
         self.tasks_queue = queue.Queue()
         self.heavy_tasks_queue = queue.Queue()
 
@@ -71,25 +75,26 @@ class Router:
         self.send_state_at = int(time.time() * 1000 + HEARTBEAT_BSTAR)
 
 
-    def add_node(self, node_address):
+    def add_node(self, node_address, weight=DEFAULT_NODE_WEIGHT):
         if node_address in self.nodes:
             return
-        print(f"Adding node {node_address}\n")
-        for node in self.nodes:
-            self.router_socket.send_multipart([node.encode('utf-8'),
-                                               json.dumps(build_add_node_request(node_address)).encode('utf-8')])
-        self.hash_ring.add_node(node_address)
+        print(f"Adding node {node_address} with weight {weight}\n")
+        # the other nodes learn about it from its gossip
+        self.hash_ring.add_node(node_address, weight)
+        if self.balance_report:
+            self.hash_ring.print_balance_report()
         self.activity[node_address] = {}
         self.activity[node_address]['last_time_active'] = time.time()
         self.activity[node_address]['immediately_available'] = False
         self.nodes.append(node_address)
 
     def remove_node(self, node_address):
-        for node in self.nodes:
-            self.router_socket.send_multipart([node.encode('utf-8'),
-                                               json.dumps(build_remove_node_request(node_address)).encode('utf-8')])
         self.activity.pop(node_address)
         self.nodes.remove(node_address)
+        # a few nodes are enough, gossip spreads the removal to the rest
+        for node in random.sample(self.nodes, min(GOSSIP_FANOUT, len(self.nodes))):
+            self.router_socket.send_multipart([node.encode('utf-8'),
+                                               json.dumps(build_remove_node_request(node_address)).encode('utf-8')])
         self.hash_ring.remove_node(node_address)
 
     def listen(self, socket: zmq.Socket):
@@ -110,10 +115,11 @@ class Router:
 
                 case MessageType.REGISTER:
                     previous_nodes = self.nodes.copy()
-                    self.add_node(task['address'])
+                    self.add_node(task['address'], task.get('weight', DEFAULT_NODE_WEIGHT))
                     # send a response to the node, include the current nodes to configure the hashring
+                    weights = {node: self.hash_ring.weights[node] for node in previous_nodes}
                     self.router_socket.send_multipart([task['address'].encode('utf-8'),
-                                                       json.dumps(build_register_response(previous_nodes)).encode('utf-8')])
+                                                       json.dumps(build_register_response(previous_nodes, weights)).encode('utf-8')])
                     continue
 
                 case MessageType.COORDINATE_PUT_RESPONSE:
@@ -175,7 +181,7 @@ class Router:
                 case MessageType.PUT:
                     shopping_list = task['value']
                     key = task['key']
-                    self.put(key, shopping_list, task['address'])
+                    self.put(key, shopping_list, task['address'], task.get('delta', False))
 
                 case MessageType.GET:
                     key = task['key']
@@ -291,7 +297,7 @@ class Router:
             pass
 
 
-    def _process_request(self, key, value, client_address, request_type):
+    def _process_request(self, key, value, client_address, request_type, delta=False):
         primary_node, pos = self.hash_ring.get_node(key)
         replicas = self.hash_ring.get_replica_nodes(primary_node, pos)[0]
         coordinator = self.elect_coordinator(primary_node, replicas)
@@ -309,7 +315,7 @@ class Router:
         forwarded_quorums[quorum_id][coordinator] += 1
         forwarded_quorums[quorum_id]['client_address'] = client_address
 
-        request = self._build_request(request_type, key, value, quorum_id)
+        request = self._build_request(request_type, key, value, quorum_id, delta)
         print("Sending request to coordinator: ", request, coordinator)
         self.router_socket.send_multipart([coordinator.encode('utf-8'), json.dumps(request).encode('utf-8')])
 
@@ -318,8 +324,8 @@ class Router:
     def get(self, key, client_address):
         self._process_request(key, None, client_address, MessageType.GET)
 
-    def put(self, key, value, client_address):
-        self._process_request(key, value, client_address, MessageType.PUT)
+    def put(self, key, value, client_address, delta=False):
+        self._process_request(key, value, client_address, MessageType.PUT, delta)
 
     def delete(self, key, client_address):
         self._process_request(key, None, client_address, MessageType.DELETE)
@@ -332,11 +338,11 @@ class Router:
         elif request_type == MessageType.DELETE:
             return self.forwarded_delete_quorums
 
-    def _build_request(self, request_type, key, value, quorum_id):
+    def _build_request(self, request_type, key, value, quorum_id, delta=False):
         if request_type == MessageType.GET:
             return build_quorum_get_request(key, quorum_id)
         elif request_type == MessageType.PUT:
-            return build_quorum_put_request(key, value, quorum_id)
+            return build_quorum_put_request(key, value, quorum_id, delta)
         elif request_type == MessageType.DELETE:
             return build_quorum_delete_request(key, quorum_id)
 
@@ -368,42 +374,19 @@ class Router:
         return coordinator
 
 
-def hash_ring_testing(hash_table):
-    reversed_hash_table = {}
-    for key, value in hash_table.hash_ring.ring.items():
-        reversed_hash_table.setdefault(value, []).append(key)
-    i = 0
-    for node, keys in reversed_hash_table.items():
-        plt.clf()
-        plt.plot([hash_table.hash_ring.sorted_keys.index(x) for x in keys], [int(x, 16) for x in keys], '.', label=node)
-        plt.show()
-    plt.clf()
-    for node, keys in reversed_hash_table.items():
-        plt.plot([hash_table.hash_ring.sorted_keys.index(x) for x in keys], [int(x, 16) for x in keys], '.', label=node)
-    plt.show()
-    positions = []
-    # for 1000 random strings of length 10, plot the distribution of the positions of the got node in the ring
-    for i in range(100000):
-        key = str(uuid4())
-        positions.append(hash_table.hash_ring.get_node_pos(key))
-        # print(get_node_pos(key))
-    l = len(hash_table.hash_ring.sorted_keys)
-    plt.clf()
-    plt.hist(positions, bins=l)
-    plt.show()
-    print('Plotting done')
-
-
 def main():
     # Arguments can be either of:
     #     -p  primary server, at ROUTER_BIND_ADDRESS
     #     -b  backup server, at ROUTER_BACKUP_BIND_ADDRESS
+    # and -r to print the ownership balance of the nodes on every registration
+    balance_report = '-r' in sys.argv
     if '-p' in sys.argv:
-        hash_table = Router(primary=True, address=ROUTER_BIND_ADDRESS, replica_count=24)
+        hash_table = Router(primary=True, address=ROUTER_BIND_ADDRESS, replica_count=24, balance_report=balance_report)
     elif '-b' in sys.argv:
-        hash_table = Router(primary=False, address=ROUTER_BACKUP_BIND_ADDRESS, replica_count=24)
+        hash_table = Router(primary=False, address=ROUTER_BACKUP_BIND_ADDRESS, replica_count=24,
+                            balance_report=balance_report)
     else:
-        print("Usage: server.py { -p | -b }\n")
+        print("Usage: server.py { -p | -b } [-r]\n")
         return
 
     hash_table.expose()
@@ -412,9 +395,6 @@ def main():
     # change to latin-1
     sys.stdin = open(sys.stdin.fileno(), mode='r', encoding='latin-1', buffering=True)
 
-    # if input('Test the hash ring? (y/n) ').lower() == 'y':
-    #     hash_ring_testing(hash_table)
-
 
 if __name__ == "__main__":
     # asyncio.run(main())
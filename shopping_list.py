@@ -1,10 +1,15 @@
+import base64
 import json
 from uuid import uuid4, UUID
 
 import requests
 import hashlib
 
-from crdt import ShoppingListCRDT
+from crdt import ShoppingListCRDT, to_serializable, BINARY_MAGIC, BINARY_FORMAT_VERSION, write_string, read_string, \
+    read_binary_header, digest_of
+from utils import WIRE_FORMAT
+
+WIRE_BINARY_PREFIX = "b64:"  # binary values travel as base64 inside the json messages, json values start with {
 
 
 class ShoppingList:
@@ -17,8 +22,7 @@ class ShoppingList:
 
         if isinstance(items, list):
             self.items = ShoppingListCRDT.zero()
-            for item in items:
-                self.add_item(item, replica_id)
+            self.add_items(items, replica_id)
         else:
             self.items = items
 
@@ -28,28 +32,44 @@ class ShoppingList:
     def item_exists(self, item_name: str):
         return item_name in [item_name for item_name in self.items.counters]
 
+    # the mutators return the delta of the change, so callers can ship only what changed
+
     def add_item(self, item: tuple[str, int], replica_id: str):
         if item[0] in [item_name for item_name in self.items.counters]:
             raise ValueError(f"Item with name {item[0]} already exists in shopping list.")
         else:
-            self.items = self.items.inc(item[0], replica_id, item[1])
+            return self.apply_delta(self.items.inc_delta(item[0], replica_id, item[1]))
 
-    def remove_item(self, item: tuple[str, int] | str):
+    def add_items(self, items: list[tuple[str, int]], replica_id: str):
+        """Same as add_item for many items, the edits are applied in place and the CRDT is frozen once"""
+        with self.items.mutate() as builder:
+            for item in items:
+                if item[0] in builder:
+                    raise ValueError(f"Item with name {item[0]} already exists in shopping list.")
+                builder.inc(item[0], replica_id, item[1])
+        self.items = builder.result
+        return builder.delta()
+
+    def remove_item(self, item: tuple[str, int] | str, replica_id: str = None):
         if isinstance(item, tuple):
             item = item[0]
-        self.items = self.items.delete(item)
+        return self.apply_delta(self.items.delete_delta(item, replica_id))
 
     def change_item_quantity(self, item: tuple[str, int], replica_id: str):
         """item is a tuple of the form (item_name, delta)"""
         if item[0] not in [item_name for item_name in self.items.counters]:
             raise ValueError(f"Item with name {item[0]} does not exist in shopping list.")
         elif item[1] > 0:
-            self.items = self.items.inc(item[0], replica_id, item[1])
+            return self.apply_delta(self.items.inc_delta(item[0], replica_id, item[1]))
         else:
             if self.items.value(item[0]) + item[1] < 0:
-                self.items = self.items.dec(item[0], replica_id, self.items.value(item[0]))
+                return self.apply_delta(self.items.dec_delta(item[0], replica_id, self.items.value(item[0])))
             else:
-                self.items = self.items.dec(item[0], replica_id, -item[1])
+                return self.apply_delta(self.items.dec_delta(item[0], replica_id, -item[1]))
+
+    def apply_delta(self, delta: ShoppingListCRDT):
+        self.items = self.items.merge(delta)
+        return delta
 
     def get_number_of_items(self):
         return len(self.items.counters)
@@ -63,13 +83,46 @@ class ShoppingList:
         }
 
     def to_json_string(self):
-        return json.dumps(self, indent=2, default=lambda x: x.__dict__)
+        return json.dumps(self, indent=2, default=to_serializable)
 
     @staticmethod
     def from_dict(d: dict):
         parsed_items = ShoppingListCRDT.from_dict(d['items'])
         return ShoppingList(d['id'], d['name'], parsed_items)
 
+    def digest(self):
+        """Stable hash of the list, see ShoppingListCRDT.digest"""
+        return digest_of('l', self.id, self.name, self.items.digest())
+
+    def to_bytes(self):
+        out = bytearray(BINARY_MAGIC)
+        out.append(BINARY_FORMAT_VERSION)
+        write_string(out, self.id)
+        write_string(out, self.name)
+        self.items.write_binary(out)
+        return bytes(out)
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        format_version, pos = read_binary_header(data)
+        id, pos = read_string(data, pos)
+        name, pos = read_string(data, pos)
+        items, _ = ShoppingListCRDT.read_binary(data, pos, format_version)
+        return ShoppingList(id, name, items)
+
+    def to_wire(self):
+        """The value of the list in messages, in the format set by WIRE_FORMAT"""
+        if WIRE_FORMAT == 'binary':
+            return WIRE_BINARY_PREFIX + base64.b64encode(self.to_bytes()).decode('ascii')
+        return json.dumps(self, default=to_serializable)
+
+    @staticmethod
+    def from_wire(value: str):
+        """Reads both formats, so nodes and clients with different WIRE_FORMAT still understand each other"""
+        if value.startswith(WIRE_BINARY_PREFIX):
+            return ShoppingList.from_bytes(base64.b64decode(value[len(WIRE_BINARY_PREFIX):]))
+        return ShoppingList.from_dict(json.loads(value))
+
     def print_items(self):
         if(len(self.items.counters) == 0):
             print(f"{self.name} is empty")
@@ -1,5 +1,6 @@
 # Auxiliary functions for the main script
 # enum for request types
+import threading
 import time
 import uuid
 from enum import Enum, IntEnum, StrEnum
@@ -16,10 +17,40 @@ TIMEOUT_THRESHOLD = 60
 MONITOR_INTERVAL = 25
 MIN_TIME_BETWEEN_RETRIES = 1
 HEALTH_CHECK_TIMEOUT = 0.15
+HEARTBEAT_INTERVAL = 0.5  # seconds between the health checks a node sends to all its peers for the failure detector
+HEARTBEAT_WINDOW = 100  # intervals between heartbeats kept per peer
+PHI_THRESHOLD = 8.0  # suspicion over which a peer is treated as down
+MIN_HEARTBEAT_STD = 0.1  # floor of the deviation of the intervals, so a steady peer isn't suspected on the first delay
+ACCEPTABLE_HEARTBEAT_PAUSE = 0.3  # seconds added to the mean interval, covers GC pauses and busy listeners
 COORDINATOR_HEALTH_CHECK_TIMEOUT = 0.3
 REPLICA_COUNT = 24
+HASH_FUNCTION = 'sha256'  # placement hash of the ring, one of hash_ring.HASH_FUNCTIONS
+# to change HASH_FUNCTION, set this to the old one until the lists are handed off, lists placed with it stay readable
+PREVIOUS_HASH_FUNCTION = None
+KEY_TOKEN_CACHE_SIZE = 65536  # tokens of recently looked up keys kept by each ring
+DEFAULT_NODE_WEIGHT = 1.0  # a node gets round(weight * REPLICA_COUNT) tokens in the ring
+PLACEMENT = 'ring'  # 'ring' for consistent hashing with vnodes or 'rendezvous', see hash_ring.PLACEMENTS
 NULL_QUORUM_ID = 'NULL_QUORUM_ID'
 HINT_CHECK_INTERVAL = 10
+HANDOFF_WINDOW = 100  # handoffs to a node sent and not yet acknowledged, the others wait for the acks
+HANDOFF_TIMEOUT = 5  # seconds after which an unacknowledged handoff is sent again
+WIRE_FORMAT = 'binary'  # format of the shopping lists in messages, 'binary' or 'json'
+STORAGE_FORMAT = 'binary'  # format of the shopping lists stored by the nodes, 'binary' or 'json'
+COMPACTION_INTERVAL = 600  # seconds between the compaction rounds of a node
+RETIRE_AFTER = 7 * 24 * 3600  # seconds without operations before a replica id is folded into the archived entry
+GC_IDLE_TIME = 5  # seconds without requests from the routers before a node sweeps deleted items
+GC_INTERVAL = 60  # minimum seconds between two sweeps
+WRITE_POLICY = 'buffered'  # 'eager' merges every write into the stored list, 'buffered' keeps up to WRITE_BUFFER_SIZE versions
+WRITE_BUFFER_SIZE = 8  # versions of a list kept before they are merged
+WRITE_BUFFER_WINDOW = 2  # seconds after which the buffered versions of a list are merged on the next write
+PUSH_HWM = 1000  # messages queued per peer before new ones to it are dropped, quorums and handoffs are resent
+PUSH_LINGER = 1000  # milliseconds the messages still queued to a peer are kept once its socket is closed
+COORDINATOR_WORKERS = 8  # threads coordinating the quorums of a node, each key is coordinated by one at a time
+MAINTENANCE_KEY = '~maintenance'  # key of the compaction and sweep tasks in the coordinator pool
+MEMBERSHIP_KEY = '~membership'  # key of the membership changes in the coordinator pool, applied in order
+ROUTER_REPLIES_ADDRESS = 'inproc://router-replies'
+GOSSIP_INTERVAL = 1  # seconds between the gossip rounds of a node
+GOSSIP_FANOUT = 2  # peers a node gossips with each round, also the nodes the router tells about a removal
 
 class MessageType(StrEnum):
     GET = 'GET'
@@ -52,6 +83,10 @@ class MessageType(StrEnum):
     PUT_HANDED_OFF_RESPONSE = 'PUT_HANDED_OFF_RESPONSE'
     DELETE_HANDED_OFF = 'DELETE_HANDED_OFF'
     DELETE_HANDED_OFF_RESPONSE = 'DELETE_HANDED_OFF_RESPONSE'
+    COMPACT = 'COMPACT'
+    GC = 'GC'
+    MEMBERSHIP = 'MEMBERSHIP'
+    GOSSIP = 'GOSSIP'
 
 
 
@@ -73,23 +108,26 @@ def build_quorum_get_request(key, quorum_id):
     }
 
 
-def build_put_request(key, value, quorum_id=''):
-    """given a key and a value, return a json for a put request of that key and value"""
+def build_put_request(key, value, quorum_id='', delta=False):
+    """given a key and a value, return a json for a put request of that key and value
+    delta is True when the value only carries the changes to the list and not its full state"""
     return {
         "type": MessageType.PUT,
         "key": key,
         "value": value,
-        "quorum_id": quorum_id
+        "quorum_id": quorum_id,
+        "delta": delta
     }
 
 
-def build_quorum_put_request(key, value, quorum_id):
+def build_quorum_put_request(key, value, quorum_id, delta=False):
     """given a key and a value, return a json for a put request of that key and value"""
     return {
         "type": MessageType.COORDINATE_PUT,
         "key": key,
         "value": value,
         "quorum_id": quorum_id,
+        "delta": delta
     }
 
 
@@ -146,35 +184,41 @@ def build_quorum_request_state(nodes, timeout, max_retries, quorum_size):
     """given a list of nodes, return a dictionary with the state of the request"""
     return {
         # "id": f"{uuid.uuid4()}",
-        "nodes_with_reply": set(),
+        "nodes_with_reply": {},  # k: node, v: its response
         "retry_info": {node: 0 for node in nodes},
         "responses": [],
         "timeout": timeout,
         "max_retries": max_retries,
         "quorum_size": quorum_size,
-        "last_retry_time": {node: 0 for node in nodes}
+        "last_retry_time": {node: 0 for node in nodes},
+        # notified by the listener as the responses arrive
+        "arrived": threading.Condition()
     }
 
 
-def build_register_request(address):
-    """given an address, return a json for a register request of that address"""
+def build_register_request(address, weight=DEFAULT_NODE_WEIGHT):
+    """given an address, return a json for a register request of that address
+    the weight is the capacity of the node relative to the others"""
     return {
         "type": MessageType.REGISTER,
-        "address": address
+        "address": address,
+        "weight": weight
     }
 
-def build_register_response(nodes):
+def build_register_response(nodes, weights=None):
     """given an address, return a json for a register request of that address"""
     return {
         "type": MessageType.REGISTER_RESPONSE,
-        "nodes": nodes
+        "nodes": nodes,
+        "weights": weights or {}
     }
 
-def build_add_node_request(node):
+def build_add_node_request(node, weight=DEFAULT_NODE_WEIGHT):
     """given an node, return a json for a register request of that node"""
     return {
         "type": MessageType.ADD_NODE,
-        "node": node
+        "node": node,
+        "weight": weight
     }
 
 def build_remove_node_request(node):
@@ -186,6 +230,15 @@ def build_remove_node_request(node):
 
 
 
+def build_gossip_request(members, reply=True):
+    """return a json with the membership table of the sender, reply asks the receiver to answer with its own"""
+    return {
+        "type": MessageType.GOSSIP,
+        "members": members,
+        "reply": reply
+    }
+
+
 def build_heartbeat_request():
     """return a json for a heartbeat request"""
     return {
@@ -230,6 +283,13 @@ def build_delete_handed_off_request(key):
         "key": key
     }
 
+def build_handed_off_response(request_type, key):
+    """return a json acknowledging a handoff of the key, the sender keeps the list until it arrives"""
+    return {
+        "type": request_type + "_RESPONSE",
+        "key": key
+    }
+
 
 def get_quorum_value(values, quorum_size):
     """given a list values and a quorum size, return the value that appears in at least quorum_size values"""